@@ -0,0 +1,221 @@
+''' benchmarks the precipitation processing steps on synthetic PRISM rasters and a
+    synthetic model mesh, so throughput can be measured without arcpy or real data
+
+usage:
+    python PrecipBenchmark.py --resolutions 4km 800m --elements 1000 10000 50000
+    python PrecipBenchmark.py --save-baseline PrecipBenchmarkBaseline.json
+    python PrecipBenchmark.py --baseline PrecipBenchmarkBaseline.json
+'''
+import os, sys, time, json, shutil, platform, argparse, tempfile, tracemalloc
+import numpy as np
+
+from PrecipProcessingTools import (WriteBilRaster, WritePolygonShapefile, ReadBilHeader, GetAllRastersFromFolders,
+                                   ScanRasterCatalog, OrderFilesByDate, CalculateAreaWeightMatrix,
+                                   AreaWeightValuesFromRasters, WritePrecipFile, ReadPrecipFile, PeakMemory, CurrentMemory,
+                                   GetWindowBytes)
+
+# extent and cell size of the PRISM grids for the conterminous United States
+PRISMGrids = {'4km': {'numRows': 621, 'numCols': 1405, 'cellSize': 1.0/24.0},
+              '800m': {'numRows': 3105, 'numCols': 7025, 'cellSize': 1.0/120.0}}
+PRISMxMin = -125.0208333333333
+PRISMyMax = 49.9375 + 1.0/48.0
+PRISMNoData = -9999
+
+# the synthetic mesh covers about the extent of the Central Valley
+meshExtent = (-122.5, 35.0, -119.0, 40.5)
+
+def WriteSyntheticRasters(outDir, resolution, numMonths, startYear=2000):
+    ''' writes numMonths synthetic PRISM precipitation rasters in millimeters to
+        one folder per year of outDir and returns their paths in date order.
+        rasters already written are reused '''
+    grid = PRISMGrids[resolution]
+    numRows, numCols, cellSize = grid['numRows'], grid['numCols'], grid['cellSize']
+
+    # a smooth field wetter to the north and near the coast, with the area off
+    # the coast set to nodata as in PRISM rasters
+    x = PRISMxMin + (np.arange(numCols) + 0.5)*cellSize
+    y = PRISMyMax - (np.arange(numRows) + 0.5)*cellSize
+    baseValues = (20.0 + 15.0*np.sin(np.radians(8.0*x))[np.newaxis, :]*np.cos(np.radians(10.0*y))[:, np.newaxis] +
+                  0.8*(y[:, np.newaxis] - 25.0) + 0.5*(x[np.newaxis, :] + 125.0)).astype(np.float32)
+    offshore = (x[np.newaxis, :] < -124.6 + 0.02*(y[:, np.newaxis] - 25.0))
+
+    rasterFiles = []
+    for month in range(numMonths):
+        year = startYear + month // 12
+        yearDir = os.path.join(outDir, str(year))
+        if not os.path.isdir(yearDir):
+            os.makedirs(yearDir)
+        outRaster = os.path.join(yearDir, 'prism_ppt_us_{0}_{1}{2:02d}.bil'.format(resolution, year, month % 12 + 1))
+        if not os.path.exists(outRaster):
+            values = baseValues*np.float32(1.0 + 0.8*np.cos(2.0*np.pi*(month % 12)/12.0))
+            values[offshore] = PRISMNoData
+            WriteBilRaster(outRaster, values, PRISMxMin, PRISMyMax, cellSize, PRISMNoData)
+        rasterFiles.append(outRaster)
+
+    return rasterFiles
+
+def WriteSyntheticMesh(outShapefile, numElements, triangles=False, seed=0):
+    ''' writes a synthetic model mesh of about numElements quadrilateral elements to a
+        shapefile with an ElementID field and returns the number of elements. if
+        triangles is True, every other quadrilateral is split into two triangles '''
+    xMin, yMin, xMax, yMax = meshExtent
+    aspect = (xMax - xMin)/(yMax - yMin)
+    numQuads = numElements*2//3 if triangles else numElements
+    numX = max(int(round(np.sqrt(numQuads*aspect))), 1)
+    numY = max(int(round(numQuads/float(numX))), 1)
+
+    # interior nodes are moved up to a fifth of an element so edges do not
+    # follow the raster grid
+    nodeX, nodeY = np.meshgrid(np.linspace(xMin, xMax, numX + 1), np.linspace(yMin, yMax, numY + 1))
+    random = np.random.default_rng(seed)
+    nodeX[1:-1, 1:-1] += random.uniform(-0.2, 0.2, (numY - 1, numX - 1))*(xMax - xMin)/numX
+    nodeY[1:-1, 1:-1] += random.uniform(-0.2, 0.2, (numY - 1, numX - 1))*(yMax - yMin)/numY
+    nodes = np.stack([nodeX, nodeY], axis=-1)
+
+    # clockwise corners of each quadrilateral
+    bottomLeft, topLeft = nodes[:-1, :-1].reshape(-1, 2), nodes[1:, :-1].reshape(-1, 2)
+    topRight, bottomRight = nodes[1:, 1:].reshape(-1, 2), nodes[:-1, 1:].reshape(-1, 2)
+
+    polygons = []
+    for i in range(numX*numY):
+        if triangles and i % 2 == 1:
+            polygons.append([np.array([bottomLeft[i], topLeft[i], topRight[i], bottomLeft[i]])])
+            polygons.append([np.array([bottomLeft[i], topRight[i], bottomRight[i], bottomLeft[i]])])
+        else:
+            polygons.append([np.array([bottomLeft[i], topLeft[i], topRight[i], bottomRight[i], bottomLeft[i]])])
+
+    WritePolygonShapefile(outShapefile, np.arange(1, len(polygons) + 1), polygons, 'ElementID')
+
+    return len(polygons)
+
+def RunStage(results, stageName, func, numMonths=None, traceMemory=False):
+    ''' runs one benchmark stage, records its wall time, CPU time, memory and
+        throughput in results and returns the result of func. processPeakRSS is
+        the peak of the whole benchmark so far, endRSS the memory after the stage '''
+    if traceMemory:
+        tracemalloc.start()
+    startWall = time.perf_counter()
+    startCPU = time.process_time()
+
+    result = func()
+
+    stage = {'wall': time.perf_counter() - startWall,
+             'cpu': time.process_time() - startCPU,
+             'processPeakRSS': PeakMemory(),
+             'endRSS': CurrentMemory()}
+    if traceMemory:
+        stage['peakTraced'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if numMonths is not None:
+        stage['monthsPerSecond'] = numMonths/stage['wall'] if stage['wall'] > 0 else None
+    results[stageName] = stage
+
+    print("  {0:<24}{1:>10.3f} s{2}".format(stageName, stage['wall'],
+          "{0:>12.1f} months/s".format(stage['monthsPerSecond']) if stage.get('monthsPerSecond') else ""))
+
+    return result
+
+def BenchmarkCase(workspace, resolution, numElements, numMonths, triangles=False, blockSize=120, traceMemory=False):
+    ''' benchmarks discovery, ordering, area weighting, writing and reading of an
+        IWFM precipitation file for one raster resolution and mesh size '''
+    rasterDir = os.path.join(workspace, 'rasters_{0}'.format(resolution))
+    meshFile = os.path.join(workspace, 'mesh_{0}{1}.shp'.format(numElements, '_tri' if triangles else ''))
+    outFile = os.path.join(workspace, 'precip_{0}_{1}.dat'.format(resolution, numElements))
+
+    rasterFiles = WriteSyntheticRasters(rasterDir, resolution, numMonths)
+    actualElements = WriteSyntheticMesh(meshFile, numElements, triangles)
+    print("{0} rasters, {1} elements, {2} months".format(resolution, actualElements, numMonths))
+
+    results = {}
+    catalogFile = os.path.join(workspace, 'catalog_{0}.json'.format(resolution))
+    if os.path.exists(catalogFile):
+        os.remove(catalogFile)
+
+    RunStage(results, 'discovery', lambda: GetAllRastersFromFolders(rasterDir), numMonths, traceMemory)
+    RunStage(results, 'discoveryCatalogNew', lambda: ScanRasterCatalog(rasterDir, catalogFile), numMonths, traceMemory)
+    RunStage(results, 'discoveryCatalog', lambda: ScanRasterCatalog(rasterDir, catalogFile), numMonths, traceMemory)
+    orderedRasters = RunStage(results, 'ordering', lambda: OrderFilesByDate(rasterFiles), numMonths, traceMemory)
+
+    rasterFiles = orderedRasters['FileNames'].tolist()
+    textDates = orderedRasters['TextDate'].tolist()
+    header = ReadBilHeader(rasterFiles[0])
+    weights = RunStage(results, 'weights', lambda: CalculateAreaWeightMatrix(meshFile, 'ElementID', header),
+                       None, traceMemory)
+    values = RunStage(results, 'areaWeighting',
+                      lambda: np.concatenate(list(AreaWeightValuesFromRasters(rasterFiles, weights, 'millimeters', 'inches', blockSize))),
+                      numMonths, traceMemory)
+    RunStage(results, 'writing', lambda: WritePrecipFile(outFile, textDates, values, 'inches'), numMonths, traceMemory)
+    RunStage(results, 'reading', lambda: ReadPrecipFile(outFile), numMonths, traceMemory)
+
+    # bytes read from each raster, so job plans can estimate their runtime from the read throughput
+    return {'resolution': resolution, 'elements': actualElements, 'months': numMonths,
+            'bytesPerRaster': GetWindowBytes(header, weights.window), 'stages': results}
+
+def CompareToBaseline(benchmark, baseline, tolerance=0.2, minSeconds=1.0):
+    ''' prints the stages slower than the baseline by more than tolerance (a
+        fraction of the baseline time) and by more than minSeconds, so the
+        timer noise of short stages is not reported, and returns the number
+        of regressions '''
+    regressions = 0
+    for caseName, case in benchmark['cases'].items():
+        baselineCase = baseline['cases'].get(caseName)
+        if baselineCase is None:
+            print("{0} is not in the baseline".format(caseName))
+            continue
+        for stageName, stage in case['stages'].items():
+            baselineStage = baselineCase['stages'].get(stageName)
+            if baselineStage is None or baselineStage['wall'] <= 0:
+                continue
+            ratio = stage['wall']/baselineStage['wall']
+            regressed = ratio > 1.0 + tolerance and stage['wall'] - baselineStage['wall'] > minSeconds
+            status = "REGRESSION" if regressed else "ok"
+            if regressed:
+                regressions += 1
+            print("  {0:<14}{1:<24}{2:>10.3f} s{3:>10.3f} s{4:>8.2f}x  {5}".format(caseName, stageName, stage['wall'],
+                                                                                baselineStage['wall'], ratio, status))
+
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="benchmark precipitation processing on synthetic data")
+    parser.add_argument('--workspace', help="folder for the synthetic data, kept between runs (default: temporary folder)")
+    parser.add_argument('--resolutions', nargs='+', default=['4km'], choices=sorted(PRISMGrids))
+    parser.add_argument('--elements', nargs='+', type=int, default=[1000, 10000])
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--triangles', action='store_true', help="split every other mesh element into two triangles")
+    parser.add_argument('--block-size', type=int, default=120, help="rasters area weighted in each matrix product")
+    parser.add_argument('--trace-memory', action='store_true', help="record the peak python allocations of each stage with tracemalloc")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--save-baseline', help="write the results to this JSON baseline file")
+    parser.add_argument('--baseline', help="compare the results to this JSON baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown relative to the baseline reported as a regression")
+    parser.add_argument('--min-seconds', type=float, default=1.0, help="slowdown in seconds below which a stage is not reported as a regression")
+    args = parser.parse_args()
+
+    workspace = args.workspace if args.workspace else tempfile.mkdtemp(prefix='PrecipBenchmark')
+    if not os.path.isdir(workspace):
+        os.makedirs(workspace)
+
+    benchmark = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'cases': {}}
+    for resolution in args.resolutions:
+        for numElements in args.elements:
+            caseName = "{0}_{1}".format(resolution, numElements)
+            benchmark['cases'][caseName] = BenchmarkCase(workspace, resolution, numElements, args.months,
+                                                         args.triangles, args.block_size, args.trace_memory)
+
+    for outFile in [args.output, args.save_baseline]:
+        if outFile:
+            with open(outFile, 'w') as f:
+                json.dump(benchmark, f, indent=2)
+
+    if not args.workspace:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print("Comparing to {0}".format(args.baseline))
+        if CompareToBaseline(benchmark, baseline, args.tolerance, args.min_seconds) > 0:
+            sys.exit(1)
@@ -1,37 +1,126 @@
 #############################################################
 # Import Modules
 #############################################################
-import arcpy, os, sys, re, datetime, glob, time
+import os, sys, re, datetime, glob, time, argparse
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
+import hashlib
+import json
+import shutil
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+
+# arcpy is only available where ArcGIS is installed and licensed. Functions
+# that work directly on BIL rasters do not need it, so allow the module to be
+# imported on machines without it.
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+# used to measure memory and I/O for run reports when available
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# job configuration files of the command line can be TOML or YAML
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# used by the native backend to read feature classes other than shapefiles
+try:
+    import pyogrio
+    import shapely
+except ImportError:
+    pyogrio = None
+    shapely = None
+
+# the geoprocessing steps run with one of two backends. 'arcpy' uses the ArcGIS
+# tools and 'native' uses numpy and the BIL and shapefile readers of this module,
+# so it runs without ArcGIS, e.g. on many Linux cores. the backend is selected
+# with the PRECIP_BACKEND environment variable so worker processes use the same one
+backendNames = ('arcpy', 'native')
 
 #############################################################
 # Define Functions to use in the main program
 #############################################################
+def GetBackend():
+    ''' returns the name of the backend in use. it is set by the PRECIP_BACKEND
+        environment variable and defaults to arcpy where it is installed '''
+    backendName = os.environ.get('PRECIP_BACKEND', 'arcpy' if arcpy is not None else 'native').lower()
+    if backendName not in backendNames:
+        raise ValueError("PRECIP_BACKEND must be one of {0}, not {1}".format(backendNames, backendName))
+    if backendName == 'arcpy' and arcpy is None:
+        raise ValueError("the arcpy backend requires ArcGIS. set PRECIP_BACKEND to native")
+
+    return backendName
+
+def SetBackend(backendName):
+    ''' selects the backend for this process and the worker processes it starts '''
+    backendName = backendName.lower()
+    if backendName not in backendNames:
+        raise ValueError("backend must be one of {0}, not {1}".format(backendNames, backendName))
+    if backendName == 'arcpy' and arcpy is None:
+        raise ValueError("the arcpy backend requires ArcGIS")
+
+    os.environ['PRECIP_BACKEND'] = backendName
+
+    # workers already started keep the backend they were started with
+    CloseProcessPool()
+
+def UseArcpy():
+    ''' checks if the geoprocessing steps use the arcpy backend '''
+    return GetBackend() == 'arcpy'
+
+def DescribeWorkspace(inWorkspace):
+    ''' returns the data type of a workspace, "Workspace" for a geodatabase,
+        "Folder" or "TextFile", with one Describe, or None if it is none of
+        these or does not exist '''
+    if not UseArcpy():
+        if os.path.isdir(inWorkspace):
+            return "Workspace" if inWorkspace.rstrip('\\/').lower().endswith('.gdb') else "Folder"
+        if os.path.isfile(inWorkspace) and os.path.splitext(inWorkspace)[1].lower() in ('.txt', '.csv'):
+            return "TextFile"
+        return None
+
+    try:
+        dataType = arcpy.Describe(inWorkspace).dataType
+    except (IOError, OSError, RuntimeError):
+        return None
+
+    return dataType if dataType in ("Workspace", "Folder", "TextFile") else None
+
 def IsGeodatabase(inWorkspace):
     ''' checks if the workspace provided is a geodatabase '''
-    workspaceDescription = arcpy.Describe(inWorkspace)
-    if workspaceDescription.dataType == "Workspace":
-        return True
-    else:
-        return False
+    return DescribeWorkspace(inWorkspace) == "Workspace"
 
 def IsFolder(inWorkspace):
     ''' checks if the workspace provided is a Folder '''
-    workspaceDescription = arcpy.Describe(inWorkspace)
-    if workspaceDescription.dataType == "Folder":
-        return True
-    else:
-        return False
+    return DescribeWorkspace(inWorkspace) == "Folder"
 
 def IsTextFile(inWorkspace):
     ''' checks if the workspace provided is a text file '''
-    workspaceDescription = arcpy.Describe(inWorkspace)
-    if workspaceDescription.dataType == "TextFile":
-        return True
-    else:
-        return False
+    return DescribeWorkspace(inWorkspace) == "TextFile"
 
 def GetAllRastersFromFolders(inWorkspace):
     ''' generates a list of all rasters in subfolders of the parent directory '''
@@ -57,8 +146,16 @@ def GetAllRastersFromFolders(inWorkspace):
 
 def GetAllRastersFromGeodatabase(inWorkspace):
     ''' generates a list of all rasters in geodatabase '''
-    arcpy.env.workspace = inWorkspace
-    listRasters = arcpy.ListRasters('*', 'All')
+    if not UseArcpy():
+        raise ValueError("rasters in geodatabases such as {0} require the arcpy backend".format(inWorkspace))
+
+    # walk the top level of the geodatabase instead of setting the global
+    # arcpy.env.workspace and listing it, which other code may be using. the
+    # rasters are returned with their paths since the workspace is not set
+    listRasters = []
+    for dirPath, dirNames, fileNames in arcpy.da.Walk(inWorkspace, datatype="RasterDataset"):
+        listRasters = [os.path.join(dirPath, fileName) for fileName in fileNames]
+        break
 
     return sorted(listRasters)
 
@@ -71,6 +168,140 @@ def GetAllRastersFromFile(inTextFile):
 
     return sorted(listRasters)
 
+def ListWorkspaceRasters(inWorkspace, dataType):
+    ''' returns the rasters of a workspace of the data type returned by DescribeWorkspace '''
+    if dataType == "Folder":
+        return GetAllRastersFromFolders(inWorkspace)
+    if dataType == "Workspace":
+        return GetAllRastersFromGeodatabase(inWorkspace)
+    if dataType == "TextFile":
+        return GetAllRastersFromFile(inWorkspace)
+
+    raise ValueError("{0} is not a folder, geodatabase or text file of rasters".format(inWorkspace))
+
+def GetWorkspaceModifiedTime(inWorkspace, dataType):
+    ''' returns the latest modified time of a workspace. rasters are listed from
+        the subfolders of a folder too, so their modified times are included '''
+    modifiedTime = os.path.getmtime(inWorkspace)
+    if dataType == "Folder":
+        for entry in os.scandir(inWorkspace):
+            if entry.is_dir():
+                modifiedTime = max(modifiedTime, entry.stat().st_mtime)
+
+    return modifiedTime
+
+class WorkspaceScanCache(object):
+    ''' caches the data types and rasters of the input workspaces of the
+        toolbox dialogs, whose updateParameters runs on every parameter edit
+
+    Each workspace is described once, and the rasters of folders and text
+    files are listed in a background thread so the dialog stays responsive
+    while e.g. a PRISM archive on a network drive is scanned. Geodatabases
+    are listed with arcpy, which is only used from the thread of the dialog.
+    A listing, or the error of a scan that failed, is kept until the
+    modified time of the workspace, or of a subfolder of a folder, changes.
+    Modified times are checked at most every recheckSeconds.
+    '''
+
+    def __init__(self, numThreads=2, recheckSeconds=2.0):
+        self.numThreads = numThreads
+        self.recheckSeconds = recheckSeconds
+        self.dataTypes = {}
+        self.modifiedTimes = {}
+        self.listings = {}
+        self.failures = {}
+        self.scans = {}
+        self.scanPool = None
+
+    def GetDataType(self, inWorkspace):
+        ''' returns the data type of a workspace, described the first time it is
+            seen. paths that do not exist yet are described again next time '''
+        if inWorkspace not in self.dataTypes:
+            dataType = DescribeWorkspace(inWorkspace)
+            if dataType is None:
+                return None
+            self.dataTypes[inWorkspace] = dataType
+
+        return self.dataTypes[inWorkspace]
+
+    def GetModifiedTime(self, inWorkspace, dataType):
+        ''' returns the modified time of a workspace, checked at most every recheckSeconds '''
+        now = time.time()
+        checked = self.modifiedTimes.get(inWorkspace)
+        if checked is None or now - checked[0] >= self.recheckSeconds:
+            checked = (now, GetWorkspaceModifiedTime(inWorkspace, dataType))
+            self.modifiedTimes[inWorkspace] = checked
+
+        return checked[1]
+
+    def GetRasters(self, inWorkspaces, wait=False):
+        ''' returns the rasters of the workspaces listed so far and whether all of
+            them are listed. workspaces not listed yet, or modified since they
+            were, are scanned in the background, or before returning if wait '''
+        rasters = []
+        complete = True
+        for inWorkspace in inWorkspaces:
+            dataType = self.GetDataType(inWorkspace)
+            if dataType is None:
+                continue
+
+            modifiedTime = self.GetModifiedTime(inWorkspace, dataType)
+            listing = self.listings.get(inWorkspace)
+            if listing is not None and listing[0] == modifiedTime:
+                rasters.extend(listing[1])
+                continue
+            failure = self.failures.get(inWorkspace)
+            if failure is not None and failure[0] == modifiedTime:
+                continue
+
+            if dataType == "Workspace":
+                # arcpy is not used from the threads of the scan pool, where it
+                # would race with the dialog over e.g. arcpy.env.workspace
+                rasters.extend(self.StoreScan(inWorkspace, modifiedTime, ListWorkspaceRasters, inWorkspace, dataType))
+                continue
+
+            scan = self.scans.get(inWorkspace)
+            if scan is None or scan[0] != modifiedTime:
+                if self.scanPool is None:
+                    self.scanPool = ThreadPool(processes=self.numThreads)
+                scan = (modifiedTime, self.scanPool.apply_async(ListWorkspaceRasters, (inWorkspace, dataType)))
+                self.scans[inWorkspace] = scan
+
+            if wait or scan[1].ready():
+                del self.scans[inWorkspace]
+                rasters.extend(self.StoreScan(inWorkspace, modifiedTime, scan[1].get))
+            else:
+                complete = False
+
+        return rasters, complete
+
+    def StoreScan(self, inWorkspace, modifiedTime, scanFunction, *args):
+        ''' keeps the rasters listed by scanFunction, or the error it raised, until
+            the workspace is modified. returns the rasters, or none if it failed '''
+        try:
+            workspaceRasters = scanFunction(*args)
+        except Exception as scanError:
+            # reported by GetScanErrors instead of raising into the dialog
+            self.failures[inWorkspace] = (modifiedTime, str(scanError))
+            return []
+
+        self.failures.pop(inWorkspace, None)
+        self.listings[inWorkspace] = (modifiedTime, workspaceRasters)
+        return workspaceRasters
+
+    def GetScanErrors(self, inWorkspaces):
+        ''' returns a message for each of the workspaces whose last scan failed '''
+        messages = []
+        for inWorkspace in inWorkspaces:
+            failure = self.failures.get(inWorkspace)
+            if failure is not None:
+                messages.append("{0}: {1}".format(inWorkspace, failure[1]))
+
+        return messages
+
+# shared by the dialogs of the toolboxes for as long as ArcGIS keeps the module loaded
+workspaceScanCache = WorkspaceScanCache()
+
 def GetListOfFeatureClasses(inWorkspace):
     ''' returns a list of feature classes in the provided location '''
     listFeatureClasses = glob.glob(os.path.join(inWorkspace, '*.shp'))
@@ -116,6 +347,27 @@ def LengthUnitConversionFactor(inUnits, outUnits):
     if inUnits == 'millimeters' and outUnits == 'millimeters':
         return 1.0
 
+# temperature units and the scale and offset converting each one to celsius
+temperatureUnits = {'celsius': (1.0, 0.0),
+                    'fahrenheit': (5.0/9.0, -32.0*5.0/9.0),
+                    'kelvin': (1.0, -273.15)}
+
+def UnitConversion(inUnits, outUnits):
+    ''' returns the scale and offset converting values between two length or
+        temperature units, as outValue = inValue*scale + offset '''
+    if inUnits in temperatureUnits or outUnits in temperatureUnits:
+        if inUnits not in temperatureUnits or outUnits not in temperatureUnits:
+            raise ValueError("cannot convert {0} to {1}".format(inUnits, outUnits))
+        inScale, inOffset = temperatureUnits[inUnits]
+        outScale, outOffset = temperatureUnits[outUnits]
+        return inScale/outScale, (inOffset - outOffset)/outScale
+
+    conversionFactor = LengthUnitConversionFactor(inUnits, outUnits)
+    if conversionFactor is None:
+        raise ValueError("cannot convert {0} to {1}".format(inUnits, outUnits))
+
+    return conversionFactor, 0.0
+
 def FACTRN(outUnits):
     if outUnits == 'feet':
         return 1.0
@@ -143,8 +395,218 @@ def MakeDirectory(dirLocation, dirName):
 
     return dirPath
 
+BilHeader = namedtuple('BilHeader', ['numRows', 'numCols', 'numBands', 'numBits', 'pixelType',
+                                     'byteOrder', 'layout', 'skipBytes', 'bandRowBytes',
+                                     'totalRowBytes', 'xMin', 'yMin', 'xMax', 'yMax',
+                                     'cellSizeX', 'cellSizeY', 'noData', 'dtype',
+                                     'spatialReference'])
+
+def IsNativeRaster(inRaster):
+    ''' checks if the raster is a BIL file with a header that can be read without arcpy '''
+    rasterBaseName, rasterExt = os.path.splitext(inRaster)
+    return rasterExt.lower() == '.bil' and os.path.exists(rasterBaseName + '.hdr')
+
+def ReadBilHeader(inRaster):
+    ''' parses the .hdr file of a BIL raster, and its .blw and .prj files if they
+        exist, into a BilHeader of its grid, pixel layout, extent and nodata value '''
+    rasterBaseName = os.path.splitext(inRaster)[0]
+
+    keywords = {}
+    with open(rasterBaseName + '.hdr', 'r') as f:
+        for line in f:
+            items = line.split()
+            if len(items) >= 2:
+                keywords[items[0].upper()] = items[1]
+
+    numRows = int(keywords['NROWS'])
+    numCols = int(keywords['NCOLS'])
+    numBands = int(keywords.get('NBANDS', 1))
+    numBits = int(keywords.get('NBITS', 8))
+    pixelType = keywords.get('PIXELTYPE', 'UNSIGNEDINT').upper()
+    byteOrder = keywords.get('BYTEORDER', 'I').upper()
+    layout = keywords.get('LAYOUT', 'BIL').upper()
+    skipBytes = int(keywords.get('SKIPBYTES', 0))
+
+    if numBits not in (8, 16, 32, 64):
+        raise ValueError("{0}-bit pixels are not supported: {1}".format(numBits, inRaster))
+
+    if pixelType == 'FLOAT':
+        dtypeCode = 'f'
+    elif pixelType == 'SIGNEDINT':
+        dtypeCode = 'i'
+    else:
+        dtypeCode = 'u'
+
+    if byteOrder == 'M':
+        dtype = np.dtype('>{0}{1}'.format(dtypeCode, numBits // 8))
+    else:
+        dtype = np.dtype('<{0}{1}'.format(dtypeCode, numBits // 8))
+
+    bandRowBytes = int(keywords.get('BANDROWBYTES', numCols * dtype.itemsize))
+    totalRowBytes = int(keywords.get('TOTALROWBYTES', numBands * bandRowBytes))
+
+    # ULXMAP and ULYMAP are the coordinates of the center of the upper left pixel
+    cellSizeX = float(keywords.get('XDIM', 1.0))
+    cellSizeY = float(keywords.get('YDIM', 1.0))
+    ulxMap = float(keywords.get('ULXMAP', 0.0))
+    ulyMap = float(keywords.get('ULYMAP', numRows - 1))
+
+    # a world file takes precedence over the header
+    worldFile = rasterBaseName + '.blw'
+    if os.path.exists(worldFile):
+        with open(worldFile, 'r') as f:
+            worldValues = [float(line) for line in f if line.strip()]
+        cellSizeX = worldValues[0]
+        cellSizeY = -worldValues[3]
+        ulxMap = worldValues[4]
+        ulyMap = worldValues[5]
+
+    noData = keywords.get('NODATA')
+    if noData is not None:
+        noData = float(noData)
+
+    spatialReference = None
+    if os.path.exists(rasterBaseName + '.prj'):
+        with open(rasterBaseName + '.prj', 'r') as f:
+            spatialReference = f.read().strip()
+
+    xMin = ulxMap - cellSizeX/2.0
+    yMax = ulyMap + cellSizeY/2.0
+    xMax = xMin + numCols*cellSizeX
+    yMin = yMax - numRows*cellSizeY
+
+    return BilHeader(numRows, numCols, numBands, numBits, pixelType, byteOrder, layout,
+                     skipBytes, bandRowBytes, totalRowBytes, xMin, yMin, xMax, yMax,
+                     cellSizeX, cellSizeY, noData, dtype, spatialReference)
+
+def ReadBilRaster(inRaster, band=1, header=None):
+    ''' maps one band (starting at 1) of a BIL raster into memory as a read-only
+        (numRows, numCols) array, so pixels are only read when accessed '''
+    if header is None:
+        header = ReadBilHeader(inRaster)
+
+    if band < 1 or band > header.numBands:
+        raise ValueError("band {0} is not in {1}, which has {2} band(s)".format(band, inRaster, header.numBands))
+
+    if header.bandRowBytes != header.numCols*header.dtype.itemsize or \
+       header.totalRowBytes != header.numBands*header.bandRowBytes:
+        raise ValueError("rows padded with extra bytes are not supported: {0}".format(inRaster))
+
+    # band interleaved by line stores one row of every band before the next row
+    if header.layout == 'BSQ':
+        rasterShape = (header.numBands, header.numRows, header.numCols)
+    elif header.layout == 'BIP':
+        rasterShape = (header.numRows, header.numCols, header.numBands)
+    else:
+        rasterShape = (header.numRows, header.numBands, header.numCols)
+
+    rasterArray = np.memmap(inRaster, dtype=header.dtype, mode='r', offset=header.skipBytes, shape=rasterShape)
+
+    if header.layout == 'BSQ':
+        return rasterArray[band - 1]
+    elif header.layout == 'BIP':
+        return rasterArray[:, :, band - 1]
+    else:
+        return rasterArray[:, band - 1, :]
+
+def GetPixelWindow(gridHeader, extent):
+    ''' returns the (rowStart, rowEnd, colStart, colEnd) window of the raster pixels
+        touching an (xMin, yMin, xMax, yMax) extent, clipped to the raster '''
+    xMin, yMin, xMax, yMax = extent
+    colStart = int(np.floor((xMin - gridHeader.xMin)/gridHeader.cellSizeX))
+    colEnd = int(np.ceil((xMax - gridHeader.xMin)/gridHeader.cellSizeX))
+    rowStart = int(np.floor((gridHeader.yMax - yMax)/gridHeader.cellSizeY))
+    rowEnd = int(np.ceil((gridHeader.yMax - yMin)/gridHeader.cellSizeY))
+
+    rowStart = min(max(rowStart, 0), gridHeader.numRows)
+    rowEnd = min(max(rowEnd, rowStart), gridHeader.numRows)
+    colStart = min(max(colStart, 0), gridHeader.numCols)
+    colEnd = min(max(colEnd, colStart), gridHeader.numCols)
+
+    return rowStart, rowEnd, colStart, colEnd
+
+def GetPixelWindowFromIndices(pixelIndices, numCols):
+    ''' returns the (rowStart, rowEnd, colStart, colEnd) window covering flat pixel indices '''
+    if len(pixelIndices) == 0:
+        return 0, 0, 0, 0
+
+    rows = pixelIndices // numCols
+    cols = pixelIndices % numCols
+
+    return int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1
+
+def ReadBilWindow(inRaster, window, band=1, header=None):
+    ''' reads a (rowStart, rowEnd, colStart, colEnd) window of one band of a BIL
+        raster in native byte order, reading only the bytes of the window '''
+    if header is None:
+        header = ReadBilHeader(inRaster)
+
+    if header.layout != 'BIL':
+        rowStart, rowEnd, colStart, colEnd = window
+        windowValues = ReadBilRaster(inRaster, band, header)[rowStart:rowEnd, colStart:colEnd]
+        return windowValues.astype(header.dtype.newbyteorder('='))
+
+    rowStart, rowEnd, colStart, colEnd = window
+    itemSize = header.dtype.itemsize
+    windowValues = np.empty((rowEnd - rowStart, colEnd - colStart), dtype=header.dtype)
+    windowBuffer = windowValues.reshape(-1).view(np.uint8)
+    spanBytes = (colEnd - colStart)*itemSize
+    firstOffset = header.skipBytes + rowStart*header.totalRowBytes + (band - 1)*header.bandRowBytes + colStart*itemSize
+
+    with open(inRaster, 'rb', buffering=0) as f:
+        if spanBytes == header.totalRowBytes:
+            # the window spans whole rows, so read it at once
+            f.seek(firstOffset)
+            f.readinto(windowBuffer)
+        else:
+            for i in range(rowEnd - rowStart):
+                f.seek(firstOffset + i*header.totalRowBytes)
+                f.readinto(windowBuffer[i*spanBytes:(i + 1)*spanBytes])
+
+    return windowValues.astype(header.dtype.newbyteorder('='), copy=False)
+
+def WriteBilRaster(outRaster, values, xMin, yMax, cellSize, noData=-9999, prjText=None):
+    ''' writes (rows x columns) values as a single band float32 BIL raster with its
+        .hdr file, and a .prj file if prjText is given, and returns its path '''
+    values = np.asarray(values, dtype='<f4')
+    numRows, numCols = values.shape
+    values.tofile(outRaster)
+
+    # the header gives the center of the upper left pixel
+    basePath = os.path.splitext(outRaster)[0]
+    with open(basePath + '.hdr', 'w') as f:
+        f.write("BYTEORDER      I\n"
+                "LAYOUT         BIL\n"
+                "NROWS          {0}\n"
+                "NCOLS          {1}\n"
+                "NBANDS         1\n"
+                "NBITS          32\n"
+                "BANDROWBYTES   {2}\n"
+                "TOTALROWBYTES  {2}\n"
+                "PIXELTYPE      FLOAT\n"
+                "ULXMAP         {3!r}\n"
+                "ULYMAP         {4!r}\n"
+                "XDIM           {5!r}\n"
+                "YDIM           {5!r}\n"
+                "NODATA         {6}\n".format(numRows, numCols, 4*numCols, xMin + cellSize/2.0, yMax - cellSize/2.0, cellSize, noData))
+
+    if prjText is not None:
+        with open(basePath + '.prj', 'w') as f:
+            f.write(prjText)
+
+    return outRaster
+
 def GetPropertiesFromRaster(inRaster):
     ''' returns raster properties from raster object '''
+    # BIL rasters with a header are read directly without opening them in arcpy
+    if IsNativeRaster(inRaster):
+        header = ReadBilHeader(inRaster)
+        return (os.path.basename(inRaster), header.numRows, header.numCols,
+                header.xMin, header.yMin, header.xMax, header.yMax)
+
+    if not UseArcpy():
+        raise ValueError("{0} is not a BIL raster with a header and requires the arcpy backend".format(inRaster))
+
     # Instantiate a raster object for the raster to access its properties
     rasterDataset = arcpy.sa.Raster(inRaster)
     
@@ -162,9 +624,227 @@ def GetPropertiesFromRaster(inRaster):
     
     return inRasterName, numRows, numCols, xMin, yMin, xMax, yMax
 
-def ClipRaster(inRaster, clipFeature, outWorkspace):
+# files that make up a dataset besides the one named, by the extension of its name
+datasetSidecars = {'.shp': ['.shx', '.dbf', '.prj', '.cpg'],
+                   '.bil': ['.hdr', '.prj']}
+
+def GetDatasetFiles(inDataset):
+    ''' returns the files of a dataset that exist, e.g. the .shp, .shx and .dbf
+        files of a shapefile. a feature class in a geodatabase is represented by
+        the geodatabase folder '''
+    basePath, ext = os.path.splitext(inDataset)
+    if os.path.isfile(inDataset):
+        return [inDataset] + [basePath + sidecar for sidecar in datasetSidecars.get(ext.lower(), [])
+                              if os.path.isfile(basePath + sidecar)]
+
+    parentPath = os.path.dirname(inDataset)
+    while parentPath and os.path.dirname(parentPath) != parentPath:
+        if parentPath.lower().endswith('.gdb') and os.path.isdir(parentPath):
+            return [parentPath]
+        parentPath = os.path.dirname(parentPath)
+
+    return []
+
+def HashFile(inFile, blockSize=2**20):
+    ''' returns the hexadecimal sha1 hash of the contents of a file '''
+    fileHash = hashlib.sha1()
+    with open(inFile, 'rb') as f:
+        for block in iter(partial(f.read, blockSize), b''):
+            fileHash.update(block)
+
+    return fileHash.hexdigest()
+
+def FingerprintDataset(inDataset, hashContents=False):
+    ''' returns the size and modification time of each file of a dataset, and
+        the hash of its contents if hashContents is True, or None if the dataset
+        does not exist '''
+    datasetFiles = GetDatasetFiles(inDataset)
+    if len(datasetFiles) == 0:
+        return None
+
+    fingerprint = {}
+    for datasetFile in datasetFiles:
+        fileStat = os.stat(datasetFile)
+        fingerprint[datasetFile] = {'size': fileStat.st_size if os.path.isfile(datasetFile) else None,
+                                    'mtime': fileStat.st_mtime_ns}
+        if hashContents and os.path.isfile(datasetFile):
+            fingerprint[datasetFile]['sha1'] = HashFile(datasetFile)
+
+    return fingerprint
+
+def DeleteDataset(inDataset):
+    ''' deletes a dataset written by a geoprocessing step, including files left
+        by a step that did not finish '''
+    if UseArcpy() and arcpy.Exists(inDataset):
+        arcpy.Delete_management(inDataset)
+
+    basePath = os.path.splitext(inDataset)[0]
+    for datasetFile in glob.glob(glob.escape(basePath) + '.*'):
+        if os.path.isfile(datasetFile):
+            os.remove(datasetFile)
+
+class StageManifest(object):
+    ''' records the geoprocessing steps completed for one raster in a JSON file
+
+    Each step is recorded with the fingerprint of its inputs, its parameters,
+    its output and the fingerprint of the output once it finished. A step is
+    only skipped when all of these still match, so a step interrupted before
+    it was recorded, a changed source raster or an output modified since is
+    done again. A redone step changes its output, which in turn no longer
+    matches the inputs recorded by the steps after it, so they are redone too.
+    '''
+
+    def __init__(self, manifestFile, hashContents=False):
+        self.manifestFile = manifestFile
+        self.hashContents = hashContents
+        self.steps = None
+
+    def GetSteps(self):
+        ''' returns the records of the steps, reading them from the file once '''
+        if self.steps is None:
+            self.steps = {}
+            if os.path.exists(self.manifestFile):
+                try:
+                    with open(self.manifestFile, 'r') as f:
+                        manifest = json.load(f)
+                except ValueError:
+                    manifest = {}
+                if manifest.get('version') == 1:
+                    self.steps = manifest['steps']
+
+        return self.steps
+
+    def Write(self):
+        ''' writes the manifest. the file is replaced in one step so an
+            interrupted write does not corrupt it '''
+        tempFile = '{0}.{1}.tmp'.format(self.manifestFile, os.getpid())
+        with open(tempFile, 'w') as f:
+            json.dump({'version': 1, 'steps': self.GetSteps()}, f, indent=1)
+        os.replace(tempFile, self.manifestFile)
+
+    def IsComplete(self, step, inputs, params, output):
+        ''' checks if a step was completed with the same inputs and parameters
+            and its output is unchanged '''
+        record = self.GetSteps().get(step)
+        if record is None or record['status'] != 'complete':
+            return False
+        if record['output'] != output or record['params'] != params:
+            return False
+        if record['inputs'] != {inDataset: FingerprintDataset(inDataset, self.hashContents) for inDataset in inputs}:
+            return False
+
+        return record['outputFingerprint'] == FingerprintDataset(output, self.hashContents)
+
+    def Record(self, step, inputs, params, output):
+        ''' records a completed step and writes the manifest '''
+        self.GetSteps()[step] = {'status': 'complete',
+                                 'inputs': {inDataset: FingerprintDataset(inDataset, self.hashContents) for inDataset in inputs},
+                                 'params': params,
+                                 'output': output,
+                                 'outputFingerprint': FingerprintDataset(output, self.hashContents),
+                                 'completed': datetime.datetime.now().isoformat()}
+        self.Write()
+
+    def Invalidate(self, step):
+        ''' removes the record of a step before it is redone '''
+        if self.GetSteps().pop(step, None) is not None:
+            self.Write()
+
+def GetStageManifest(manifestDir, inRaster, hashContents=False):
+    ''' returns the StageManifest of a raster in the manifest folder. the file is
+        named by the raster and a hash of its path, so rasters of the same name
+        in different folders have separate manifests '''
+    rasterName = os.path.splitext(os.path.basename(inRaster))[0]
+    pathHash = hashlib.sha1(os.path.abspath(inRaster).encode('utf-8')).hexdigest()[:8]
+
+    return StageManifest(os.path.join(manifestDir, "{0}_{1}.json".format(rasterName, pathHash)), hashContents)
+
+def RunStep(manifest, step, inputs, params, output, stepFunc):
+    ''' runs a geoprocessing step writing output unless it can be skipped
+
+    Without a manifest, the step is skipped if its output exists. With a
+    StageManifest, it is skipped only if the manifest shows it completed with
+    the same inputs and parameters and an unchanged output. Otherwise any
+    existing output is deleted, the step is run and recorded as complete.
+    '''
+    if manifest is None:
+        if not os.path.exists(output):
+            stepFunc()
+        return output
+
+    if manifest.IsComplete(step, inputs, params, output):
+        return output
+
+    manifest.Invalidate(step)
+    DeleteDataset(output)
+    stepFunc()
+    manifest.Record(step, inputs, params, output)
+
+    return output
+
+def SaveStepValues(manifest, step, inputs, params, valuesFunc):
+    ''' runs a step calculating an array with RunStep, saving the array next to
+        the manifest so it is still valid after the intermediates are deleted,
+        and returns the path of the .npz file '''
+    valuesFile = "{0}_{1}.npz".format(os.path.splitext(manifest.manifestFile)[0], step)
+
+    def SaveValues():
+        values = valuesFunc()
+        tempFile = '{0}.{1}.tmp.npz'.format(valuesFile, os.getpid())
+        np.savez(tempFile, values=values)
+        os.replace(tempFile, valuesFile)
+
+    return RunStep(manifest, step, inputs, params, valuesFile, SaveValues)
+
+def GetDatasetBytes(inDataset):
+    ''' returns the bytes on disk of the files of a dataset, including sidecar
+        files such as spatial indexes and metadata '''
+    basePath = os.path.splitext(inDataset)[0]
+    return sum([os.path.getsize(datasetFile) for datasetFile in glob.glob(glob.escape(basePath) + '.*')
+                if os.path.isfile(datasetFile)])
+
+class IntermediateFiles(object):
+    ''' counts the steps that still need each intermediate dataset of a raster and
+        deletes it as soon as the last of them has finished
+
+    The bytes on disk of the intermediates in use are tracked, so the peak
+    disk use of processing one raster can be measured. If keep is True,
+    nothing is deleted.
+    '''
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.consumers = {}
+        self.datasetBytes = {}
+        self.bytesInUse = 0
+        self.peakBytes = 0
+
+    def Add(self, dataset, numConsumers):
+        ''' registers a dataset needed by numConsumers steps and returns it '''
+        self.consumers[dataset] = self.consumers.get(dataset, 0) + numConsumers
+        if dataset not in self.datasetBytes:
+            self.datasetBytes[dataset] = GetDatasetBytes(dataset)
+            self.bytesInUse += self.datasetBytes[dataset]
+            self.peakBytes = max(self.peakBytes, self.bytesInUse)
+
+        return dataset
+
+    def Release(self, dataset):
+        ''' records that a step needing a dataset has finished, deleting the
+            dataset if no other step needs it '''
+        self.consumers[dataset] -= 1
+        if self.consumers[dataset] > 0:
+            return
+
+        del self.consumers[dataset]
+        self.bytesInUse -= self.datasetBytes.pop(dataset)
+        if not self.keep:
+            DeleteDataset(dataset)
+
+def ClipRaster(inRaster, clipFeature, outWorkspace, manifest=None):
     ''' clips a raster to the geometry of the boundary of the feature class
-        provided and returns the name of the clipped raster '''
+        provided and returns the name of the clipped raster. the step is
+        skipped if recorded as complete in the StageManifest given '''
     
     # Use the input raster name to generate a default output name
     inRasterName, inRasterExt = os.path.splitext(os.path.basename(inRaster))
@@ -172,11 +852,21 @@ def ClipRaster(inRaster, clipFeature, outWorkspace):
     outRasterName = "{0}_clip.bil".format(inRasterName)
     outClipRaster = os.path.join(outWorkspace, outRasterName)
     
-    if not os.path.exists(outClipRaster):
-        # Clip raster to geometry of the feature class specified by the user
-        arcpy.Clip_management(inRaster, "#", outClipRaster, clipFeature, "#", "NONE")
-    
-    return outClipRaster
+    def Clip():
+        if UseArcpy():
+            # Clip raster to geometry of the feature class specified by the user
+            arcpy.Clip_management(inRaster, "#", outClipRaster, clipFeature, "#", "NONE")
+        else:
+            # keep the pixels touching the extent of the feature class, as Clip
+            # does without clipping geometry
+            header = ReadBilHeader(inRaster)
+            window = GetPixelWindow(header, GetFeatureExtent(clipFeature))
+            WriteBilRaster(outClipRaster, ReadBilWindow(inRaster, window, header=header),
+                           header.xMin + window[2]*header.cellSizeX, header.yMax - window[0]*header.cellSizeY,
+                           header.cellSizeX, header.noData if header.noData is not None else -9999,
+                           header.spatialReference)
+
+    return RunStep(manifest, 'clip', [inRaster, clipFeature], {'backend': GetBackend()}, outClipRaster, Clip)
 
 def ClipRasterMulti(inputList):
     ''' clips a raster to the geometry of the boundary of the feature class
@@ -187,19 +877,21 @@ def ClipRasterMulti(inputList):
     
     return ClipRaster(inRaster, clipFeature, outWorkspace)
 
-def ConvertRasterToPoints(inRaster, outWorkspace):
-    ''' converts a raster to points and returns the name of the point feature class '''
+def ConvertRasterToPoints(inRaster, outWorkspace, manifest=None):
+    ''' converts a raster to points and returns the name of the point feature class.
+        the step is skipped if recorded as complete in the StageManifest given '''
     
     # Use the input raster name to generate a default output name
     inRasterName = os.path.splitext(os.path.basename(inRaster))[0]
     outPointFeatureName = "{0}.shp".format(inRasterName)
     outPointFeature = os.path.join(outWorkspace, outPointFeatureName)
     
-    if not os.path.exists(outPointFeature):
-        # Convert raster to point feature class
-        arcpy.RasterToPoint_conversion(inRaster, outPointFeature, "Value")
-    
-    return outPointFeature
+    if not UseArcpy():
+        raise ValueError("ConvertRasterToPoints requires the arcpy backend. IntersectRaster calculates the same values with the native backend")
+
+    # Convert raster to point feature class
+    return RunStep(manifest, 'points', [inRaster], {'field': "Value"}, outPointFeature,
+                   partial(arcpy.RasterToPoint_conversion, inRaster, outPointFeature, "Value"))
 
 def ConvertRasterToPointsMulti(inputDataList):
     ''' converts a raster to points and returns the name of the point feature class '''
@@ -208,8 +900,9 @@ def ConvertRasterToPointsMulti(inputDataList):
     
     return ConvertRasterToPoints(inRaster, outWorkspace)
 
-def CreateFishnetFeature(inRaster, outWorkspace):
-    ''' creates a polyline fishnet feature class and returns it's name '''
+def CreateFishnetFeature(inRaster, outWorkspace, manifest=None):
+    ''' creates a polyline fishnet feature class and returns it's name. the step
+        is skipped if recorded as complete in the StageManifest given '''
     
     # Get properties from raster dataset for use in generating fishnet
     inRasterName, numRows, numCols, xMin, yMin, xMax, yMax = GetPropertiesFromRaster(inRaster)
@@ -228,21 +921,25 @@ def CreateFishnetFeature(inRaster, outWorkspace):
     originCoordinate = "{0} {1}".format(xMin, yMin)
     yAxisCoordinate = "{0} {1}".format(xMin, yMax)
     
-    if not os.path.exists(outFishnetFeature):
-        # Create fishnet using clipped rasters
-        arcpy.CreateFishnet_management(outFishnetFeature,
-                                       originCoordinate,
-                                       yAxisCoordinate,
-                                       0,
-                                       0,
-                                       numRows,
-                                       numCols,
-                                       "#",
-                                       "NO_LABELS",
-                                       inRaster,
-                                       "POLYLINE")
-    
-    return outFishnetFeature
+    if not UseArcpy():
+        raise ValueError("CreateFishnetFeature requires the arcpy backend. IntersectRaster calculates the same values with the native backend")
+
+    # Create fishnet using clipped rasters
+    return RunStep(manifest, 'fishnet', [inRaster],
+                   {'origin': originCoordinate, 'yAxis': yAxisCoordinate, 'numRows': numRows, 'numCols': numCols},
+                   outFishnetFeature,
+                   partial(arcpy.CreateFishnet_management,
+                           outFishnetFeature,
+                           originCoordinate,
+                           yAxisCoordinate,
+                           0,
+                           0,
+                           numRows,
+                           numCols,
+                           "#",
+                           "NO_LABELS",
+                           inRaster,
+                           "POLYLINE"))
 
 def CreateFishnetFeatureMulti(inputDataList):
     ''' creates a polyline fishnet feature class and returns it's name '''
@@ -252,24 +949,27 @@ def CreateFishnetFeatureMulti(inputDataList):
     
     return CreateFishnetFeature(inRaster, outWorkspace)
 
-def ConvertFishnetToPolygon(inFishnetFeature, inPointFeature, outWorkspace):
+def ConvertFishnetToPolygon(inFishnetFeature, inPointFeature, outWorkspace, manifest=None):
     ''' converts the fishnet polyline features to polygons and assigns
-        values from the point feature class to the polygons as attributes '''
+        values from the point feature class to the polygons as attributes.
+        the step is skipped if recorded as complete in the StageManifest given '''
     
     # Define name and location of output polygon feature class
     inFishnetName = os.path.basename(inFishnetFeature)
     outFeatureName = inFishnetName.replace("_fishnet", "")
     outPolygonFeature = os.path.join(outWorkspace, outFeatureName)
 
-    if not os.path.exists(outPolygonFeature):
-        # Convert Features to Polygons
-        arcpy.FeatureToPolygon_management(inFishnetFeature,
-                                          outPolygonFeature,
-                                          "#",
-                                          "ATTRIBUTES",
-                                          inPointFeature)
+    if not UseArcpy():
+        raise ValueError("ConvertFishnetToPolygon requires the arcpy backend. IntersectRaster calculates the same values with the native backend")
 
-    return outPolygonFeature
+    # Convert Features to Polygons
+    return RunStep(manifest, 'polygon', [inFishnetFeature, inPointFeature], {'attributes': "ATTRIBUTES"}, outPolygonFeature,
+                   partial(arcpy.FeatureToPolygon_management,
+                           inFishnetFeature,
+                           outPolygonFeature,
+                           "#",
+                           "ATTRIBUTES",
+                           inPointFeature))
 
 def ConvertFishnetToPolygonMulti(inputList):
     ''' converts the fishnet polyline features to polygons and assigns
@@ -279,8 +979,9 @@ def ConvertFishnetToPolygonMulti(inputList):
     
     return ConvertFishnetToPolygon(inFishnetFeature, inPointFeature, outWorkspace)
 
-def IntersectFeatures(referenceFeatureClass, targetFeatureClass, outWorkspace):
-    ''' generates a new feature class that is the result of intersecting two input feature classes '''
+def IntersectFeatures(referenceFeatureClass, targetFeatureClass, outWorkspace, manifest=None):
+    ''' generates a new feature class that is the result of intersecting two input feature classes.
+        the step is skipped if recorded as complete in the StageManifest given '''
 
     # Define name and location of output intersection feature class
     inFeatureClassName, inFeatureClassExt = os.path.splitext(os.path.basename(targetFeatureClass))
@@ -290,11 +991,12 @@ def IntersectFeatures(referenceFeatureClass, targetFeatureClass, outWorkspace):
     # list features to intersect for input to Intersect tool
     intersectFeatures = [referenceFeatureClass, targetFeatureClass]
 
-    if not os.path.exists(outIntersectFeature):
-        # Intersect Features
-        arcpy.Intersect_analysis(intersectFeatures, outIntersectFeature)
+    if not UseArcpy():
+        raise ValueError("IntersectFeatures requires the arcpy backend. IntersectRaster calculates the same values with the native backend")
 
-    return outIntersectFeature
+    # Intersect Features
+    return RunStep(manifest, 'intersect', intersectFeatures, {}, outIntersectFeature,
+                   partial(arcpy.Intersect_analysis, intersectFeatures, outIntersectFeature))
 
 def IntersectFeaturesMulti(inputList):
     ''' generates a new feature class that is the result of intersecting two input feature classes '''
@@ -303,13 +1005,626 @@ def IntersectFeaturesMulti(inputList):
     
     return IntersectFeatures(referenceFeatureClass, targetFeatureClass, outWorkspace)
 
-def MultiProcess(func, funcArgList):
-    ''' wrapper function to create a processing pool and map a function to it '''
-    pool = mp.Pool(processes=mp.cpu_count() - 1)
-    resultList = pool.map(func, funcArgList)
-    pool.close()
+# area weights already used by IntersectRaster in this process
+workerAreaWeights = {}
+
+def IntersectRaster(inRaster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir=None,
+                    scratchWorkspace=None, keepIntermediates=False, returnDiskUsage=False):
+    ''' runs the clip, points, fishnet, polygon and intersect steps for one raster
+        and returns the area weighted values for each polygon of aoiFeature
+
+    The intermediate files are written to the Clipped, Points, Fishnet,
+    Polygon and Intersect directories of scratchWorkspace, or of outWorkspace
+    if it is None, which must already exist as made by
+    WritePrecipFileFromIntersect. Each one is deleted as soon as the steps
+    using it have finished, unless keepIntermediates is True. If
+    returnDiskUsage is True, the peak bytes of intermediate files on disk
+    are returned with the values. If manifestDir is given, the steps
+    completed for the raster are recorded in its StageManifest there and
+    only invalid or missing steps are run. The values are kept next to the
+    manifest as its last step, so a raster whose values are still valid is
+    not processed again even though its intermediates were deleted, and
+    no intermediate bytes are returned for it. With the native backend, the
+    values are calculated with the exact area of each pixel within each
+    polygon instead, the result the steps approximate, using area weights
+    cached in the Weights directory of outWorkspace.
+    '''
+    if not UseArcpy():
+        header = ReadBilHeader(inRaster)
+        weightsKey = (aoiFeature, aoiIDField, GetGridDefinition(header))
+        if weightsKey not in workerAreaWeights:
+            weightsDir = MakeDirectory(outWorkspace, "Weights")
+            workerAreaWeights[weightsKey] = GetAreaWeightMatrix(aoiFeature, aoiIDField, header, weightsDir)
+
+        values = AreaWeightValuesFromRaster(inRaster, workerAreaWeights[weightsKey], inUnits, outUnits)
+        return (values, 0) if returnDiskUsage else values
+
+    manifest = GetStageManifest(manifestDir, inRaster) if manifestDir is not None else None
+    if scratchWorkspace is None:
+        scratchWorkspace = outWorkspace
+
+    # each intermediate is added with the number of steps that use it and
+    # released as each of them finishes
+    intermediates = IntermediateFiles(keepIntermediates)
+
+    def CalculateValues():
+        clipRaster = intermediates.Add(ClipRaster(inRaster, aoiFeature, os.path.join(scratchWorkspace, "Clipped"), manifest), 2)
+        pointFeature = intermediates.Add(ConvertRasterToPoints(clipRaster, os.path.join(scratchWorkspace, "Points"), manifest), 1)
+        intermediates.Release(clipRaster)
+        fishnetFeature = intermediates.Add(CreateFishnetFeature(clipRaster, os.path.join(scratchWorkspace, "Fishnet"), manifest), 1)
+        intermediates.Release(clipRaster)
+        polygonFeature = intermediates.Add(ConvertFishnetToPolygon(fishnetFeature, pointFeature, os.path.join(scratchWorkspace, "Polygon"), manifest), 1)
+        intermediates.Release(fishnetFeature)
+        intermediates.Release(pointFeature)
+        intersectFeature = intermediates.Add(IntersectFeatures(aoiFeature, polygonFeature, os.path.join(scratchWorkspace, "Intersect"), manifest), 1)
+        intermediates.Release(polygonFeature)
+
+        values = AreaWeightValuesFromFeatureClass(intersectFeature, inUnits, outUnits, aoiIDField, 'grid_code', 'SHAPE@AREA')
+        intermediates.Release(intersectFeature)
+        return values
+
+    if manifest is None:
+        values = CalculateValues()
+    else:
+        valuesFile = SaveStepValues(manifest, 'values', [inRaster, aoiFeature],
+                                    {'aoiIDField': aoiIDField, 'inUnits': inUnits, 'outUnits': outUnits}, CalculateValues)
+        with np.load(valuesFile) as valuesData:
+            values = valuesData['values']
+
+    return (values, intermediates.peakBytes) if returnDiskUsage else values
+
+def IntersectRasterMulti(inputList):
+    ''' runs the clip, points, fishnet, polygon and intersect steps for one raster
+        and returns the area weighted values for each polygon of aoiFeature '''
+    # unpack list of input variables
+    inRaster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir, scratchWorkspace, keepIntermediates = inputList
+
+    return IntersectRaster(inRaster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir,
+                           scratchWorkspace, keepIntermediates)
+
+def IntersectRasterDiskUsageMulti(inputList):
+    ''' runs IntersectRasterMulti for one raster and returns its values with the
+        peak bytes of its intermediate files on disk '''
+    inRaster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir, scratchWorkspace, keepIntermediates = inputList
+
+    return IntersectRaster(inRaster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir,
+                           scratchWorkspace, keepIntermediates, returnDiskUsage=True)
+
+def PeakMemory():
+    ''' returns the peak resident memory of the process in bytes, or None if it
+        cannot be measured on this platform '''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes and macOS reports bytes
+        return peak if sys.platform == 'darwin' else peak*1024
+
+    if psutil is not None:
+        memoryInfo = psutil.Process().memory_info()
+        return getattr(memoryInfo, 'peak_wset', memoryInfo.rss)
+
+    return None
+
+def CurrentMemory():
+    ''' returns the resident memory of the process now in bytes, or None if it
+        cannot be measured on this platform. unlike PeakMemory it goes down again
+        when memory is freed, so it can be compared between stages of a run '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+def AvailableMemory():
+    ''' returns the bytes of memory available to start new processes without
+        swapping, or None if it cannot be measured on this platform '''
+    if psutil is not None:
+        return psutil.virtual_memory().available
+
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as f:
+            memoryInfo = dict([line.split(':') for line in f if ':' in line])
+        if 'MemAvailable' in memoryInfo:
+            return int(memoryInfo['MemAvailable'].split()[0])*1024
+
+    return None
+
+def ProcessIOCounters():
+    ''' returns the bytes read and written by the process so far, or (None, None)
+        if they cannot be measured on this platform. reads served from the
+        operating system cache are included '''
+    if psutil is not None:
+        try:
+            ioCounters = psutil.Process().io_counters()
+            return getattr(ioCounters, 'read_chars', ioCounters.read_bytes), getattr(ioCounters, 'write_chars', ioCounters.write_bytes)
+        except (AttributeError, NotImplementedError, psutil.Error):
+            pass
+
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io', 'r') as f:
+            ioCounters = dict([line.split(':') for line in f if ':' in line])
+        return int(ioCounters['rchar']), int(ioCounters['wchar'])
+
+    return None, None
+
+def FormatDuration(seconds):
+    ''' formats a number of seconds as H:MM:SS '''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+class StageReport(object):
+    ''' measurements of one stage of a run. created and timed by RunReport, and
+        updated with the tasks of the stage as they finish '''
+
+    def __init__(self, name, total=None, useProgressor=False):
+        self.name = name
+        self.total = total
+        self.useProgressor = useProgressor and arcpy is not None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytesRead = None
+        self.bytesWritten = None
+        self.processPeakMemory = None
+        self.endMemory = None
+        self.tasksCompleted = 0
+        self.tasksFailed = 0
+        self.taskWall = 0.0
+        self.taskCPU = 0.0
+        self.maxQueueDepth = 0
+        self.queueDepthTotal = 0
+        self.queueDepthCount = 0
+        self.blockSize = None
+        self.blockSizeReduced = False
+        self.firstStart = None
+        self.lastProgressUpdate = 0.0
+
+    def Start(self):
+        ''' records the start of the stage and shows a progressor for it '''
+        if self.firstStart is None:
+            self.firstStart = time.time()
+            if self.useProgressor:
+                if self.total:
+                    arcpy.SetProgressor("step", self.name, 0, self.total, 1)
+                else:
+                    arcpy.SetProgressor("default", self.name)
+
+    def TaskDone(self, count=1):
+        ''' records finished tasks and updates the progressor '''
+        self.tasksCompleted += count
+
+        # the progressor label shows the time left at the rate of the tasks so far
+        now = time.time()
+        if self.useProgressor and self.total and now - self.lastProgressUpdate >= 0.5:
+            self.lastProgressUpdate = now
+            arcpy.SetProgressorPosition(min(self.tasksCompleted, self.total))
+            # no rate is known until a task completes, e.g. when a block of no rows is counted
+            if self.tasksCompleted > 0:
+                elapsed = now - self.firstStart
+                remaining = elapsed/self.tasksCompleted*(self.total - self.tasksCompleted)
+                arcpy.SetProgressorLabel("{0}: {1} of {2}, about {3} left".format(self.name, self.tasksCompleted, self.total,
+                                                                                 FormatDuration(remaining)))
+
+    def TaskTime(self, taskWall, taskCPU):
+        ''' records the wall and CPU time a task took in a worker '''
+        self.taskWall += taskWall
+        self.taskCPU += taskCPU
+
+    def TaskFailed(self, count=1):
+        ''' records failed tasks '''
+        self.tasksFailed += count
+
+    def QueueDepth(self, depth):
+        ''' records the number of tasks waiting in a queue of the stage '''
+        self.maxQueueDepth = max(self.maxQueueDepth, depth)
+        self.queueDepthTotal += depth
+        self.queueDepthCount += 1
+
+    def BlockSize(self, blockSize, reduced=False):
+        ''' records the number of items the stage processes at once, and whether
+            it was reduced because memory went over the budget '''
+        self.blockSize = blockSize
+        self.blockSizeReduced = self.blockSizeReduced or reduced
+
+    def ToDict(self):
+        ''' returns the measurements of the stage for the JSON report '''
+        return {'name': self.name,
+                'wall': self.wall,
+                'cpu': self.cpu,
+                'cpuUtilization': self.cpu/self.wall if self.wall > 0 else None,
+                'bytesRead': self.bytesRead,
+                'bytesWritten': self.bytesWritten,
+                'processPeakMemory': self.processPeakMemory,
+                'endMemory': self.endMemory,
+                'tasksTotal': self.total,
+                'tasksCompleted': self.tasksCompleted,
+                'tasksFailed': self.tasksFailed,
+                'taskWall': self.taskWall,
+                'taskCPU': self.taskCPU,
+                'maxQueueDepth': self.maxQueueDepth,
+                'meanQueueDepth': self.queueDepthTotal/float(self.queueDepthCount) if self.queueDepthCount > 0 else None,
+                'blockSize': self.blockSize,
+                'blockSizeReduced': self.blockSizeReduced}
+
+class RunReport(object):
+    ''' collects the wall time, CPU time, bytes read and written, memory,
+        tasks and queue depths of each stage of a run and writes them to a
+        JSON report
+
+    Stages are timed with the Stage context manager, or with TimeIterator for
+    a stage producing values consumed by another. Times are exclusive: a
+    stage timed inside another is not counted in the outer stage, so e.g. the
+    writing stage only counts the time spent writing and not the time spent
+    area weighting the rasters it writes.
+    '''
+
+    def __init__(self, reportFile=None, useProgressor=False):
+        self.reportFile = reportFile
+        self.useProgressor = useProgressor
+        self.stages = {}
+        self.activeSections = []
+        self.warnings = []
+        self.startTime = time.time()
+        self.startCPU = time.process_time()
+
+    def GetStage(self, name, total=None):
+        ''' returns the StageReport of a stage, creating it if needed '''
+        if name not in self.stages:
+            self.stages[name] = StageReport(name, total, self.useProgressor)
+        elif total is not None:
+            self.stages[name].total = total
+
+        return self.stages[name]
+
+    def Warn(self, message):
+        ''' prints a warning and keeps it with the run, so e.g. the toolboxes can
+            show it with arcpy.AddWarning '''
+        print(message)
+        self.warnings.append(message)
+
+    def StartSection(self, stage):
+        bytesRead, bytesWritten = ProcessIOCounters()
+        stage.Start()
+        self.activeSections.append({'stage': stage, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                                    'bytesRead': bytesRead, 'bytesWritten': bytesWritten,
+                                    'childWall': 0.0, 'childCPU': 0.0, 'childRead': 0, 'childWritten': 0})
+
+    def EndSection(self):
+        section = self.activeSections.pop()
+        stage = section['stage']
+        bytesRead, bytesWritten = ProcessIOCounters()
+
+        wall = time.perf_counter() - section['wall']
+        cpu = time.process_time() - section['cpu']
+        read = bytesRead - section['bytesRead'] if bytesRead is not None else 0
+        written = bytesWritten - section['bytesWritten'] if bytesWritten is not None else 0
+
+        stage.wall += wall - section['childWall']
+        stage.cpu += cpu - section['childCPU']
+        if bytesRead is not None:
+            stage.bytesRead = (stage.bytesRead or 0) + read - section['childRead']
+            stage.bytesWritten = (stage.bytesWritten or 0) + written - section['childWritten']
+        # the peak is of the whole process so far, not of this stage. the
+        # resident memory at the end of the stage shows what the stage kept
+        stage.processPeakMemory = PeakMemory()
+        stage.endMemory = CurrentMemory()
+
+        # the time of this section is not counted in the section it ran in
+        if len(self.activeSections) > 0:
+            parent = self.activeSections[-1]
+            parent['childWall'] += wall
+            parent['childCPU'] += cpu
+            parent['childRead'] += read
+            parent['childWritten'] += written
+
+    @contextmanager
+    def Stage(self, name, total=None):
+        ''' times the code run in a with block as a stage and yields its StageReport '''
+        stage = self.GetStage(name, total)
+        self.StartSection(stage)
+        try:
+            yield stage
+        except BaseException:
+            stage.TaskFailed()
+            raise
+        finally:
+            self.EndSection()
+            if stage.useProgressor:
+                arcpy.ResetProgressor()
+
+    def TimeIterator(self, name, iterable, total=None, countFunc=None):
+        ''' yields the items of iterable, timing the production of each one as part
+            of a stage. countFunc returns the number of tasks each item completes,
+            e.g. the number of rows of a block of values, and defaults to one '''
+        stage = self.GetStage(name, total)
+        iterator = iter(iterable)
+        while True:
+            self.StartSection(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except BaseException:
+                stage.TaskFailed()
+                raise
+            finally:
+                self.EndSection()
+            stage.TaskDone(countFunc(item) if countFunc is not None else 1)
+            yield item
+
+    def ToDict(self):
+        ''' returns the report of the run as a dictionary '''
+        return {'start': datetime.datetime.fromtimestamp(self.startTime).isoformat(),
+                'wall': time.time() - self.startTime,
+                'cpu': time.process_time() - self.startCPU,
+                'peakMemory': PeakMemory(),
+                'warnings': self.warnings,
+                'stages': [stage.ToDict() for stage in self.stages.values()]}
+
+    def Write(self, reportFile=None):
+        ''' writes the JSON report of the run and returns its path '''
+        reportFile = reportFile if reportFile is not None else self.reportFile
+        if reportFile is None:
+            return None
+
+        with open(reportFile, 'w') as f:
+            json.dump(self.ToDict(), f, indent=2)
+
+        return reportFile
+
+    def Summary(self):
+        ''' returns a line for each stage with its time, CPU use and data read and written '''
+        lines = []
+        for stage in self.stages.values():
+            lines.append("{0:<20}{1:>10.1f} s wall {2:>6.0%} CPU {3:>10} read {4:>10} written {5:>7} tasks{6}{7}".format(
+                stage.name, stage.wall, stage.cpu/stage.wall if stage.wall > 0 else 0.0,
+                "{0:.1f} MB".format(stage.bytesRead/1e6) if stage.bytesRead is not None else "-",
+                "{0:.1f} MB".format(stage.bytesWritten/1e6) if stage.bytesWritten is not None else "-",
+                stage.tasksCompleted, " ({0} failed)".format(stage.tasksFailed) if stage.tasksFailed else "",
+                " (over the memory budget, {0} at once)".format(stage.blockSize) if stage.blockSizeReduced else ""))
+
+        return "\n".join(lines)
+
+def RunTimedTask(timedTask):
+    ''' runs a function in a worker and returns its result with the wall and CPU
+        time it took and the peak memory of the worker, so the time of each
+        task can be reported and the memory of later tasks budgeted '''
+    func, data = timedTask
+    startWall = time.perf_counter()
+    startCPU = time.process_time()
+    result = func(data)
+
+    return result, time.perf_counter() - startWall, time.process_time() - startCPU, PeakMemory()
+
+# rough memory use of the geoprocessing of one raster in a worker, used to
+# budget the first tasks of a run until the memory of finished tasks is measured
+workerBaseBytes = 250*2**20
+intersectBytesPerCell = 2*2**10
+intersectBytesPerFeature = 8*2**10
+
+class MemoryBudget(object):
+    ''' a memory budget for a run, used to choose the number of workers and the
+        number of rasters processed at once. a task is estimated until the peak
+        memory of the tasks that finished is measured '''
+
+    def __init__(self, budgetBytes=None, fraction=0.8):
+        if budgetBytes is None:
+            availableBytes = AvailableMemory()
+            budgetBytes = int(availableBytes*fraction) if availableBytes is not None else None
+        self.budgetBytes = budgetBytes
+        self.estimatedTaskBytes = None
+        self.measuredTaskBytes = None
+        self.lastPeakBytes = PeakMemory()
+
+    def EstimateTask(self, taskBytes):
+        ''' sets the estimated bytes of a task, used until tasks are measured '''
+        self.estimatedTaskBytes = taskBytes
+
+    def MeasureTask(self, peakBytes):
+        ''' records the peak memory of a worker measured after a task '''
+        if peakBytes is not None:
+            self.measuredTaskBytes = max(self.measuredTaskBytes or 0, peakBytes)
+
+    def GetTaskBytes(self):
+        ''' returns the measured bytes of a task, or the estimate until one is measured '''
+        return self.measuredTaskBytes if self.measuredTaskBytes is not None else self.estimatedTaskBytes
+
+    def MaxTasks(self, maxTasks):
+        ''' returns the number of tasks that fit in the budget at once, from 1 to maxTasks '''
+        taskBytes = self.GetTaskBytes()
+        if self.budgetBytes is None or not taskBytes:
+            return maxTasks
+
+        return int(min(max(self.budgetBytes // taskBytes, 1), maxTasks))
+
+    def GetNumWorkers(self, numWorkers=None):
+        ''' returns the number of worker processes to start, at most numWorkers,
+            which defaults to one less than the number of CPUs '''
+        if numWorkers is None:
+            numWorkers = max(mp.cpu_count() - 1, 1)
+
+        return self.MaxTasks(numWorkers)
+
+    def GetBlockSize(self, itemBytes, maxBlockSize, usedBytes=0):
+        ''' returns the number of items of itemBytes each, e.g. rasters stacked
+            in a block, that fit in the budget besides usedBytes, from 1 to maxBlockSize '''
+        if self.budgetBytes is None or itemBytes <= 0:
+            return maxBlockSize
+
+        return int(min(max((self.budgetBytes - usedBytes) // itemBytes, 1), maxBlockSize))
+
+    def IsExceeded(self):
+        ''' checks if the peak memory of this process went over the budget
+            since the last check. the peak never goes down, so only a new
+            peak counts '''
+        peakBytes = PeakMemory()
+        exceeded = self.budgetBytes is not None and peakBytes is not None and \
+                   peakBytes > self.budgetBytes and peakBytes > (self.lastPeakBytes or 0)
+        self.lastPeakBytes = peakBytes
+
+        return exceeded
+
+def EstimateIntersectTaskBytes(inRaster, aoiFeature):
+    ''' estimates the peak memory of a worker clipping, vectorizing and
+        intersecting a raster with the area of interest, from the cells of the
+        raster inside the extent of the area of interest and its feature count '''
+    rasterName, numRows, numCols, xMin, yMin, xMax, yMax = GetPropertiesFromRaster(inRaster)
+    aoiXMin, aoiYMin, aoiXMax, aoiYMax = GetFeatureExtent(aoiFeature)
+
+    # only the part of the raster covering the area of interest is vectorized
+    overlapWidth = max(min(xMax, aoiXMax) - max(xMin, aoiXMin), 0.0)
+    overlapHeight = max(min(yMax, aoiYMax) - max(yMin, aoiYMin), 0.0)
+    overlapFraction = overlapWidth*overlapHeight/((xMax - xMin)*(yMax - yMin)) if xMax > xMin and yMax > yMin else 1.0
+    numCells = int(numRows*numCols*overlapFraction)
+
+    return workerBaseBytes + numCells*intersectBytesPerCell + GetFeatureCount(aoiFeature)*intersectBytesPerFeature
+
+# one pool of worker processes is shared by every parallel step of a run, so
+# workers are only started, and arcpy only initialized in them, once
+processPool = None
+processPoolSize = None
+
+def InitializeWorker():
+    ''' prepares a worker process of the processing pool. the Spatial Analyst
+        extension is checked out once per worker instead of once per task '''
+    if UseArcpy():
+        arcpy.CheckOutExtension("Spatial")
+
+def GetProcessPool(numWorkers=None):
+    ''' returns the shared processing pool, starting it if needed. the pool is
+        restarted if a different number of workers is requested '''
+    global processPool, processPoolSize
+
+    if numWorkers is None:
+        numWorkers = max(mp.cpu_count() - 1, 1)
+
+    if processPool is not None and processPoolSize != numWorkers:
+        CloseProcessPool()
+
+    if processPool is None:
+        processPool = mp.Pool(processes=numWorkers, initializer=InitializeWorker)
+        processPoolSize = numWorkers
+
+    return processPool
+
+def CloseProcessPool():
+    ''' closes the shared processing pool and waits for its workers to exit '''
+    global processPool, processPoolSize
+
+    if processPool is not None:
+        processPool.close()
+        processPool.join()
+    processPool = None
+    processPoolSize = None
+
+def RunIndexedTask(indexedTask):
+    ''' runs a function in a worker and returns its result with the index of the task '''
+    index, func, funcArgs = indexedTask
+    return index, func(funcArgs)
+
+def MultiProcess(func, funcArgList, numWorkers=None, chunksize=None):
+    ''' maps a module level function to a list of inputs with the shared processing
+        pool and returns the results in the order of the inputs '''
+    funcArgList = list(funcArgList)
+    pool = GetProcessPool(numWorkers)
+    if chunksize is None:
+        chunksize = max(len(funcArgList) // (4*processPoolSize), 1)
+
+    resultList = [None]*len(funcArgList)
+    indexedTasks = [(i, func, funcArgs) for i, funcArgs in enumerate(funcArgList)]
+    for index, result in pool.imap_unordered(RunIndexedTask, indexedTasks, chunksize):
+        resultList[index] = result
+
     return resultList
 
+def PipelineMap(computeFunc, items, readFunc=None, numReaders=4, numWorkers=None, maxPending=None, stage=None, budget=None):
+    ''' yields computeFunc of the data readFunc reads for each item, in the order of
+        items. reads run in threads and computes in the shared processing pool, with
+        at most maxPending items in the pipeline so a slow consumer holds back reads '''
+    if numWorkers is None:
+        numWorkers = max(mp.cpu_count() - 1, 1)
+    if computeFunc is None:
+        numWorkers = 0
+    if maxPending is None:
+        maxPending = 4*max(numReaders, numWorkers)
+
+    readPool = ThreadPool(processes=numReaders)
+    computePool = GetProcessPool(numWorkers) if numWorkers > 0 else None
+
+    def ReadAndSubmit(item):
+        data = readFunc(item) if readFunc is not None else item
+        if computePool is not None:
+            if stage is not None or budget is not None:
+                return computePool.apply_async(RunTimedTask, ((computeFunc, data),))
+            return computePool.apply_async(computeFunc, (data,))
+        return computeFunc(data) if computeFunc is not None else data
+
+    try:
+        itemIterator = iter(items)
+        pending = deque()
+        for item in itemIterator:
+            pending.append(readPool.apply_async(ReadAndSubmit, (item,)))
+            if len(pending) >= maxPending:
+                break
+
+        while pending:
+            if stage is not None:
+                stage.QueueDepth(len(pending))
+            result = pending.popleft().get()
+            if computePool is not None:
+                result = result.get()
+                if stage is not None or budget is not None:
+                    result, taskWall, taskCPU, taskPeakMemory = result
+                    if stage is not None:
+                        stage.TaskTime(taskWall, taskCPU)
+                    if budget is not None:
+                        budget.MeasureTask(taskPeakMemory)
+
+            # start the next item before handing this result to the consumer
+            maxItems = budget.MaxTasks(maxPending) if budget is not None else len(pending) + 1
+            if len(pending) < maxItems:
+                for item in itemIterator:
+                    pending.append(readPool.apply_async(ReadAndSubmit, (item,)))
+                    if len(pending) >= maxItems:
+                        break
+
+            yield result
+
+        readPool.close()
+        readPool.join()
+    finally:
+        # the processing pool is shared and left running for the next step
+        readPool.terminate()
+
+# patterns of the dates in raster file names, in the order they are tried, with
+# the time step of the rasters named with each. compiled once when the module
+# is imported. daily dates are tried first so they are not read as YYYYMM
+fileDateExpressions = [
+    # YYYYMMDD, e.g. daily PRISM rasters
+    (re.compile(r"(?<!\d)(?:19|20)\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])(?!\d)"), '%Y%m%d', 'daily'),
+    # YYYYMM
+    (re.compile(r"19\d{2}0?[1-9](?!\d+)"
+                r"|19\d{2}1?[0-2](?!\d+)"
+                r"|20\d{2}0?[1-9](?!\d+)"
+                r"|20\d{2}1[0-2](?!\d+)"), '%Y%m', 'monthly'),
+    # YYYY_MM
+    (re.compile(r"19\d{2}_0?[1-9](?!\d+)"
+                r"|19\d{2}_1[0-2](?!\d+)"
+                r"|20\d{2}_0?[1-9](?!\d+)"
+                r"|20\d{2}_1[0-2](?!\d+)"), '%Y_%m', 'monthly'),
+    # YYYYmon
+    (re.compile(r"19\d{2}[a-zA-Z]{3}"
+                r"|20\d{2}[a-zA-Z]{3}"), '%Y%b', 'monthly'),
+]
+
+# time steps of the rasters and of the rows of IWFM precipitation files
+timeStepNames = ('daily', 'monthly')
+
+# dates already parsed from each file name
+parsedFileDates = {}
+
 def ParseDateFromFileName(inFileName):
     ''' parse dates of various types from a file name 
     Parameters
@@ -321,45 +1636,66 @@ def ParseDateFromFileName(inFileName):
     -------
     datetime.datetime
         datetime object
+
+    Raises
+    ------
+    ValueError
+        if the file name does not contain a date in any of the formats
     '''
-    # regex expression for YYYYMM
-    expr1 = re.compile(r"19\d{2}0?[1-9](?!\d+)"
-                       r"|19\d{2}1?[0-2](?!\d+)"
-                       r"|20\d{2}0?[1-9](?!\d+)"
-                       r"|20\d{2}1[0-2](?!\d+)")
-    
-    match1 = re.search(expr1, inFileName)
-    
-    # regex expression for YYYY_MM
-    expr2 = re.compile(r"19\d{2}_0?[1-9](?!\d+)"
-                       r"|19\d{2}_1[0-2](?!\d+)"
-                       r"|20\d{2}_0?[1-9](?!\d+)"
-                       r"|20\d{2}_1[0-2](?!\d+)")
-    
-    match2 = re.search(expr2, inFileName)
-    
-    
-    # regex expression for YYYYmon
-    expr3 = re.compile(r"19\d{2}[a-zA-Z]{3}"
-                       r"|20\d{2}[a-zA-Z]{3}")
-    
-    match3 = re.search(expr3, inFileName)
-    
-    if match1:
-        dateString = match1.group()
-        fileDate = datetime.datetime.strptime(dateString, '%Y%m')
-        
-    elif match2:
-        dateString = match2.group()
-        fileDate = datetime.datetime.strptime(dateString, '%Y_%m')
-        
-    elif match3:
-        dateString = match3.group()
-        fileDate = datetime.datetime.strptime(dateString, '%Y%b')
-        
+    if inFileName in parsedFileDates:
+        return parsedFileDates[inFileName]
+
+    for expr, fmt, timeStep in fileDateExpressions:
+        match = re.search(expr, inFileName)
+        if match:
+            fileDate = datetime.datetime.strptime(match.group(), fmt)
+            break
+    else:
+        raise ValueError("{0} does not contain a date as YYYYMMDD, YYYYMM, YYYY_MM or YYYYmon".format(inFileName))
+
+    parsedFileDates[inFileName] = fileDate
+
     return fileDate
-        
-def FormatIWFMDate(fileDate, fmt='%m/%d/%Y_24:00'):
+
+def ParseDatesFromFileNames(inFileNames, errors='raise', returnTimeSteps=False):
+    ''' parses the dates of many file names at once with the patterns used by
+        ParseDateFromFileName and returns them as a pd.Series of datetime64.
+        file names without a date raise a ValueError, or are NaT if errors is
+        'coerce'. if returnTimeSteps is True, a pd.Series of the time step of
+        each file name, 'daily' or 'monthly', is also returned '''
+    fileNames = pd.Series(list(inFileNames), dtype=object).astype(str)
+    fileDates = pd.Series(pd.NaT, index=fileNames.index, dtype='datetime64[ns]')
+    fileTimeSteps = pd.Series(None, index=fileNames.index, dtype=object)
+
+    for expr, fmt, timeStep in fileDateExpressions:
+        unmatched = fileDates.isna()
+        if not unmatched.any():
+            break
+        dateStrings = fileNames[unmatched].str.extract("({0})".format(expr.pattern), expand=False).dropna()
+        if len(dateStrings) > 0:
+            fileDates[dateStrings.index] = pd.to_datetime(dateStrings, format=fmt, errors='coerce')
+            fileTimeSteps[dateStrings.index] = timeStep
+
+    if errors == 'raise' and fileDates.isna().any():
+        missing = fileNames[fileDates.isna()].tolist()
+        raise ValueError("{0} file name(s) do not contain a date as YYYYMMDD, YYYYMM, YYYY_MM or YYYYmon: {1}".format(len(missing), missing[:10]))
+
+    if returnTimeSteps:
+        fileTimeSteps[fileDates.isna()] = None
+        return fileDates, fileTimeSteps
+
+    return fileDates
+
+def FormatIWFMDates(dates, timeSteps):
+    ''' formats a pd.Series of dates as IWFM time stamps. dates with a 'monthly'
+        time step are stamped with the last day of their month and 'daily'
+        dates with their own day '''
+    dates = pd.Series(dates)
+    periodEnds = dates.where(pd.Series(timeSteps, index=dates.index) == 'daily', dates + pd.offsets.MonthEnd(0))
+
+    return periodEnds.dt.strftime('%m/%d/%Y_24:00')
+
+def FormatIWFMDate(fileDate, fmt='%m/%d/%Y_24:00', timeStep='monthly'):
     ''' formats a datetime object to a end of month string
     
     Parameters
@@ -369,12 +1705,19 @@ def FormatIWFMDate(fileDate, fmt='%m/%d/%Y_24:00'):
     
     fmt : str
         python datetime format
+
+    timeStep : str
+        'monthly' to format the last day of the month of fileDate or
+        'daily' to format fileDate itself
     
     Returns
     -------
     str
         string formatted date following the format given by fmt    
     '''
+    if timeStep == 'daily':
+        return datetime.datetime.strftime(fileDate, fmt)
+
     modelDate = datetime.datetime.strftime(LastDayOfMonth(fileDate), fmt)
 
     return modelDate
@@ -390,27 +1733,2005 @@ def OrderFilesByDate(features):
     Returns
     -------
     pd.DataFrame
-        pandas DataFrame object containing filenames, dates, and formatted text dates
+        pandas DataFrame object containing filenames, dates, formatted text
+        dates and the time step of each file, 'daily' or 'monthly'
     '''
-    df = pd.DataFrame(data=features, columns=['FileNames'])
-    df['Date'] = df.apply(lambda row: ParseDateFromFileName(row['FileNames']), axis=1)
-    df.sort_values(by='Date', inplace=True)
-    df['TextDate'] = df.apply(lambda row: LastDayOfMonth(row['Date']).strftime('%m/%d/%Y_24:00'), axis=1)
+    df = pd.DataFrame(data=list(features), columns=['FileNames'])
+    fileDates, fileTimeSteps = ParseDatesFromFileNames(df['FileNames'], returnTimeSteps=True)
+    df['Date'] = fileDates.values
+    df['TimeStep'] = fileTimeSteps.values
+    df.sort_values(by='Date', inplace=True, kind='stable')
+    df['TextDate'] = FormatIWFMDates(df['Date'], df['TimeStep']).values
     
     return df
 
+def ReadRasterCatalog(catalogFile):
+    ''' reads the directory entries of a raster catalog, or an empty catalog if
+        the file does not exist or was written by another version '''
+    if os.path.exists(catalogFile):
+        with open(catalogFile, 'r') as f:
+            catalog = json.load(f)
+        if catalog.get('version') == 2:
+            return catalog['directories']
+
+    return {}
+
+def WriteRasterCatalog(directories, catalogFile):
+    ''' writes the directory entries of a raster catalog. the file is replaced
+        in one step so an interrupted write does not corrupt the catalog '''
+    tempFile = '{0}.{1}.tmp'.format(catalogFile, os.getpid())
+    with open(tempFile, 'w') as f:
+        json.dump({'version': 2, 'directories': directories}, f, indent=1)
+    os.replace(tempFile, catalogFile)
+
+def ScanCatalogDirectory(dirPath, directories):
+    ''' updates the catalog entry of a directory and returns it
+
+    Directories whose modification time is unchanged since the last scan are
+    not listed again, since adding, removing or renaming a file changes it.
+    Rasters already in the catalog with the same size and modification time
+    keep their entry, so only new or changed rasters are read.
+    '''
+    dirModifiedTime = os.stat(dirPath).st_mtime
+    entry = directories.get(dirPath)
+    if entry is not None and entry['mtime'] == dirModifiedTime:
+        return entry
+
+    oldRasters = {raster['path']: raster for raster in entry['rasters']} if entry is not None else {}
+    subdirs = []
+    rasters = []
+    newRasters = []
+    for dirEntry in sorted(os.scandir(dirPath), key=lambda dirEntry: dirEntry.name):
+        if dirEntry.is_dir():
+            subdirs.append(dirEntry.path)
+        elif dirEntry.name.lower().endswith('.bil'):
+            fileStat = dirEntry.stat()
+            raster = oldRasters.get(dirEntry.path)
+            if raster is None or raster['size'] != fileStat.st_size or raster['mtime'] != fileStat.st_mtime:
+                raster = {'path': dirEntry.path, 'size': fileStat.st_size, 'mtime': fileStat.st_mtime,
+                          'date': None, 'timeStep': None, 'cellSize': None, 'numRows': None, 'numCols': None}
+                if IsNativeRaster(dirEntry.path):
+                    header = ReadBilHeader(dirEntry.path)
+                    raster.update(cellSize=header.cellSizeX, numRows=header.numRows, numCols=header.numCols)
+                newRasters.append(raster)
+            rasters.append(raster)
+
+    # dates of the new rasters are parsed together. rasters without a date are
+    # kept in the catalog so they are not parsed again
+    newDates, newTimeSteps = ParseDatesFromFileNames([os.path.basename(raster['path']) for raster in newRasters],
+                                                     errors='coerce', returnTimeSteps=True)
+    for raster, newDate, newTimeStep in zip(newRasters, newDates, newTimeSteps):
+        raster['date'] = None if pd.isna(newDate) else newDate.strftime('%Y-%m-%d')
+        raster['timeStep'] = newTimeStep
+
+    entry = {'mtime': dirModifiedTime, 'subdirs': subdirs, 'rasters': rasters}
+    directories[dirPath] = entry
+
+    return entry
+
+def ScanRasterCatalog(inWorkspace, catalogFile=None):
+    ''' returns the BIL rasters of a folder and its subfolders, as OrderFilesByDate
+        does, from a JSON catalog in which only new or modified folders and rasters
+        are read again. a catalog that cannot be written is only reported '''
+    inWorkspace = os.path.abspath(inWorkspace)
+    directories = ReadRasterCatalog(catalogFile) if catalogFile is not None else {}
+    oldContents = json.dumps({dirPath: [entry['subdirs'], entry['rasters']] for dirPath, entry in directories.items()}, sort_keys=True)
+
+    rootEntry = ScanCatalogDirectory(inWorkspace, directories)
+    rasters = list(rootEntry['rasters'])
+    for subdir in rootEntry['subdirs']:
+        rasters.extend(ScanCatalogDirectory(subdir, directories)['rasters'])
+
+    # only rewrite the catalog when the rasters or folders changed. writing the
+    # catalog changes the modification time of its own folder, which would
+    # otherwise make every scan rewrite it
+    newContents = json.dumps({dirPath: [entry['subdirs'], entry['rasters']] for dirPath, entry in directories.items()}, sort_keys=True)
+    if catalogFile is not None and newContents != oldContents:
+        try:
+            WriteRasterCatalog(directories, catalogFile)
+        except OSError as writeError:
+            print("The raster catalog could not be written to {0}: {1}".format(catalogFile, writeError))
+
+    missing = [raster['path'] for raster in rasters if raster['date'] is None]
+    if len(missing) > 0:
+        raise ValueError("{0} file name(s) do not contain a date as YYYYMMDD, YYYYMM, YYYY_MM or YYYYmon: {1}".format(len(missing), missing[:10]))
+    df = pd.DataFrame({'FileNames': [raster['path'] for raster in rasters],
+                       'Date': pd.to_datetime([raster['date'] for raster in rasters], format='%Y-%m-%d'),
+                       'TimeStep': [raster['timeStep'] for raster in rasters],
+                       'CellSize': [raster['cellSize'] for raster in rasters],
+                       'NumRows': [raster['numRows'] for raster in rasters],
+                       'NumCols': [raster['numCols'] for raster in rasters],
+                       'Size': [raster['size'] for raster in rasters],
+                       'ModifiedTime': [raster['mtime'] for raster in rasters]})
+    df.sort_values(by=['Date', 'FileNames'], inplace=True, kind='stable')
+    df['TextDate'] = FormatIWFMDates(df['Date'], df['TimeStep']).values
+    df.reset_index(drop=True, inplace=True)
+
+    return df[['FileNames', 'Date', 'TimeStep', 'TextDate', 'CellSize', 'NumRows', 'NumCols', 'Size', 'ModifiedTime']]
+
 def AreaWeightValuesFromFeatureClass(inFeature, inValueUnits, outValueUnits, inIDField, inValueField="grid_code", inAreaField="SHAPE@AREA"):
     ''' performs area weighting on value field and groups to a unique Identifier '''
-    arr = arcpy.da.FeatureClassToNumPyArray(inFeature, [inIDField, inValueField, inAreaField])
-    df = pd.DataFrame(arr)
+    if UseArcpy():
+        arr = arcpy.da.FeatureClassToNumPyArray(inFeature, [inIDField, inValueField, inAreaField])
+        df = pd.DataFrame(arr)
+    else:
+        # the area of each polygon is the sum of the signed areas of its rings,
+        # which subtracts the holes
+        featureIDs, polygons = GetPolygonsFromFeatureClass(inFeature, inIDField)
+        df = pd.DataFrame({inIDField: featureIDs,
+                           inValueField: ReadFeatureClassField(inFeature, inValueField),
+                           inAreaField: [abs(sum([RingArea(ring) for ring in rings])) for rings in polygons]})
     df2 = df.join(df.groupby(inIDField)[inAreaField].sum(), on=inIDField, rsuffix="_total")
-    df2["WeightedGridCode"] = df2[inAreaField]/df2["SHAPE@AREA_total"]*df2[inValueField]*LengthUnitConversionFactor(inValueUnits, outValueUnits)
+    df2["WeightedGridCode"] = df2[inAreaField]/df2[inAreaField + "_total"]*df2[inValueField]*LengthUnitConversionFactor(inValueUnits, outValueUnits)
     df3 = df2.groupby(inIDField)["WeightedGridCode"].sum()
     weightedValues = df3.tolist()
 
     return weightedValues
 
-def PrecipHeader():
+def ReadDbfField(inDbfFile, inFieldName):
+    ''' reads the values of one field (case insensitive) of a dBASE table in record
+        order, as integers, floats or strings '''
+    with open(inDbfFile, 'rb') as f:
+        tableHeader = f.read(32)
+        numRecords = int.from_bytes(tableHeader[4:8], 'little')
+        headerLength = int.from_bytes(tableHeader[8:10], 'little')
+        recordLength = int.from_bytes(tableHeader[10:12], 'little')
+        fieldDescriptors = f.read(headerLength - 32)
+
+        # field values start after the one byte deletion flag of each record
+        fieldOffset = 1
+        fieldType = None
+        for i in range(0, len(fieldDescriptors) - 31, 32):
+            descriptor = fieldDescriptors[i:i+32]
+            if descriptor[0] == 0x0D:
+                break
+            fieldName = descriptor[:11].split(b'\x00')[0].decode('ascii', 'replace')
+            fieldLength = descriptor[16]
+            if fieldName.upper() == inFieldName.upper():
+                fieldType = chr(descriptor[11])
+                fieldDecimals = descriptor[17]
+                break
+            fieldOffset += fieldLength
+
+        if fieldType is None:
+            raise ValueError("field {0} was not found in {1}".format(inFieldName, inDbfFile))
+
+        f.seek(headerLength)
+        records = np.frombuffer(f.read(numRecords*recordLength), dtype=np.uint8)
+
+    records = records[:numRecords*recordLength].reshape(numRecords, recordLength)
+    rawValues = records[:, fieldOffset:fieldOffset + fieldLength].copy().view('S{0}'.format(fieldLength)).ravel()
+    textValues = np.char.strip(np.char.decode(rawValues, 'latin-1'))
+
+    if fieldType in ('N', 'F'):
+        if fieldType == 'N' and fieldDecimals == 0:
+            return textValues.astype(np.int64)
+        return textValues.astype(np.float64)
+
+    return textValues
+
+def ReadShapefilePolygons(inShapefile, inIDField):
+    ''' returns the identifiers, or None if inIDField is None, and the rings of each
+        polygon of a shapefile as (n, 2) arrays of x, y coordinates '''
+    featureIDs = ReadDbfField(os.path.splitext(inShapefile)[0] + '.dbf', inIDField) if inIDField is not None else None
+
+    polygons = []
+    with open(inShapefile, 'rb') as f:
+        fileHeader = f.read(100)
+        fileLength = int.from_bytes(fileHeader[24:28], 'big')*2
+        shapeType = int.from_bytes(fileHeader[32:36], 'little')
+        if shapeType not in (5, 15, 25):
+            raise ValueError("{0} is not a polygon shapefile".format(inShapefile))
+
+        position = 100
+        while position < fileLength:
+            recordHeader = f.read(8)
+            contentLength = int.from_bytes(recordHeader[4:8], 'big')*2
+            content = f.read(contentLength)
+            position += 8 + contentLength
+
+            rings = []
+            if int.from_bytes(content[0:4], 'little') != 0:
+                numParts, numPoints = np.frombuffer(content, dtype='<i4', count=2, offset=36)
+                partStarts = np.frombuffer(content, dtype='<i4', count=numParts, offset=44)
+                points = np.frombuffer(content, dtype='<f8', count=2*numPoints, offset=44 + 4*numParts).reshape(-1, 2)
+                partEnds = np.append(partStarts[1:], numPoints)
+                rings = [points[start:end] for start, end in zip(partStarts, partEnds)]
+
+            polygons.append(rings)
+
+    return featureIDs, polygons
+
+def WritePolygonShapefile(outShapefile, featureIDs, polygons, inIDField):
+    ''' writes polygons given as lists of (n, 2) rings, clockwise for exterior rings,
+        and their integer identifiers to a shapefile and returns its path '''
+    basePath = os.path.splitext(outShapefile)[0]
+    polygons = [[np.asarray(ring, dtype='<f8').reshape(-1, 2) for ring in rings] for rings in polygons]
+
+    records = []
+    for recordNumber, rings in enumerate(polygons, start=1):
+        if len(rings) == 0:
+            content = np.array([0], dtype='<i4').tobytes()
+        else:
+            points = np.concatenate(rings)
+            partStarts = np.cumsum([0] + [len(ring) for ring in rings[:-1]])
+            content = np.array([5], dtype='<i4').tobytes() + \
+                      np.array([points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()], dtype='<f8').tobytes() + \
+                      np.array([len(rings), len(points)], dtype='<i4').tobytes() + \
+                      np.asarray(partStarts, dtype='<i4').tobytes() + points.tobytes()
+        records.append(np.array([recordNumber, len(content)//2], dtype='>i4').tobytes() + content)
+
+    allPoints = [ring for rings in polygons for ring in rings]
+    if len(allPoints) > 0:
+        allPoints = np.concatenate(allPoints)
+        boundingBox = [allPoints[:, 0].min(), allPoints[:, 1].min(), allPoints[:, 0].max(), allPoints[:, 1].max()]
+    else:
+        boundingBox = [0.0, 0.0, 0.0, 0.0]
+
+    def FileHeader(fileLength):
+        return np.array([9994, 0, 0, 0, 0, 0, fileLength//2], dtype='>i4').tobytes() + \
+               np.array([1000, 5], dtype='<i4').tobytes() + \
+               np.array(boundingBox + [0.0, 0.0, 0.0, 0.0], dtype='<f8').tobytes()
+
+    shpLength = 100 + sum([len(record) for record in records])
+    with open(basePath + '.shp', 'wb') as f:
+        f.write(FileHeader(shpLength))
+        f.write(b''.join(records))
+
+    # the index holds the offset and length of each record in 16 bit words
+    recordLengths = np.array([len(record) for record in records], dtype=np.int64)
+    recordOffsets = 100 + np.cumsum(recordLengths) - recordLengths
+    with open(basePath + '.shx', 'wb') as f:
+        f.write(FileHeader(100 + 8*len(records)))
+        f.write(np.column_stack([recordOffsets//2, (recordLengths - 8)//2]).astype('>i4').tobytes())
+
+    # dBASE table with the numeric identifier field
+    fieldLength = 10
+    textIDs = np.array(['{0:>{1}d}'.format(int(featureID), fieldLength) for featureID in featureIDs], dtype='S{0}'.format(fieldLength))
+    fieldName = inIDField.encode('ascii')[:10].ljust(11, b'\x00')
+    today = datetime.date.today()
+    with open(basePath + '.dbf', 'wb') as f:
+        f.write(bytes([3, today.year - 1900, today.month, today.day]) +
+                np.array([len(textIDs)], dtype='<i4').tobytes() +
+                np.array([32 + 32 + 1, 1 + fieldLength], dtype='<i2').tobytes() + bytes(20))
+        f.write(fieldName + b'N' + bytes(4) + bytes([fieldLength, 0]) + bytes(14))
+        f.write(b'\x0d')
+        recordBytes = np.empty((len(textIDs), 1 + fieldLength), dtype=np.uint8)
+        recordBytes[:, 0] = ord(' ')
+        recordBytes[:, 1:] = textIDs.view(np.uint8).reshape(len(textIDs), fieldLength)
+        f.write(recordBytes.tobytes())
+        f.write(b'\x1a')
+
+    return outShapefile
+
+def GetPolygonsFromFeatureClass(inFeature, inIDField):
+    ''' returns the identifiers and the rings of each polygon in a feature class.
+        shapefiles are read directly and others with arcpy, or pyogrio with the native backend '''
+    if os.path.splitext(inFeature)[1].lower() == '.shp':
+        return ReadShapefilePolygons(inFeature, inIDField)
+
+    if not UseArcpy():
+        return ReadPolygonsWithPyogrio(inFeature, inIDField)
+
+    featureIDs = []
+    polygons = []
+    with arcpy.da.SearchCursor(inFeature, [inIDField, 'SHAPE@']) as cursor:
+        for featureID, shape in cursor:
+            rings = []
+            if shape is not None:
+                for part in shape:
+                    # interior rings are separated from the exterior ring by None
+                    ring = []
+                    for point in part:
+                        if point is None:
+                            if len(ring) > 0:
+                                rings.append(np.array(ring))
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    if len(ring) > 0:
+                        rings.append(np.array(ring))
+            featureIDs.append(featureID)
+            polygons.append(rings)
+
+    return np.array(featureIDs), polygons
+
+def SplitFeaturePath(inFeature):
+    ''' splits the path of a feature class into the path of its dataset and the
+        layer name, which is None for shapefiles and other single layer files '''
+    workspace, layerName = os.path.split(inFeature)
+    if workspace.rstrip('\\/').lower().endswith('.gdb'):
+        return workspace, layerName
+
+    return inFeature, None
+
+def ReadPolygonsWithPyogrio(inFeature, inIDField):
+    ''' reads the identifier and the rings of each polygon in a feature class
+        with pyogrio, e.g. from a file geodatabase without arcpy '''
+    if pyogrio is None:
+        raise ValueError("pyogrio and shapely are required to read {0} with the native backend".format(inFeature))
+
+    datasetPath, layerName = SplitFeaturePath(inFeature)
+    meta, fids, geometries, fieldData = pyogrio.raw.read(datasetPath, layer=layerName, columns=[inIDField])
+
+    polygons = []
+    for geometry in shapely.from_wkb(geometries):
+        rings = []
+        if geometry is not None and not geometry.is_empty:
+            parts = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+            for part in parts:
+                rings.append(np.asarray(part.exterior.coords)[:, :2])
+                rings.extend([np.asarray(interior.coords)[:, :2] for interior in part.interiors])
+        polygons.append(rings)
+
+    return np.asarray(fieldData[0]), polygons
+
+def ReadFeatureClassField(inFeature, inFieldName):
+    ''' returns the values of one field of a feature class in feature order '''
+    if os.path.splitext(inFeature)[1].lower() == '.shp':
+        return ReadDbfField(os.path.splitext(inFeature)[0] + '.dbf', inFieldName)
+
+    if UseArcpy():
+        return arcpy.da.FeatureClassToNumPyArray(inFeature, [inFieldName])[inFieldName]
+
+    if pyogrio is None:
+        raise ValueError("pyogrio is required to read {0} with the native backend".format(inFeature))
+
+    datasetPath, layerName = SplitFeaturePath(inFeature)
+    return np.asarray(pyogrio.raw.read(datasetPath, layer=layerName, columns=[inFieldName], read_geometry=False)[3][0])
+
+def GetFeatureCount(inFeature):
+    ''' returns the number of features in a feature class '''
+    if UseArcpy():
+        return int(arcpy.GetCount_management(inFeature)[0])
+
+    if os.path.splitext(inFeature)[1].lower() == '.shp':
+        with open(os.path.splitext(inFeature)[0] + '.dbf', 'rb') as f:
+            return int.from_bytes(f.read(8)[4:8], 'little')
+
+    if pyogrio is None:
+        raise ValueError("pyogrio is required to read {0} with the native backend".format(inFeature))
+
+    datasetPath, layerName = SplitFeaturePath(inFeature)
+    return int(pyogrio.read_info(datasetPath, layer=layerName)['features'])
+
+def GetFeatureExtent(inFeature):
+    ''' returns the (xMin, yMin, xMax, yMax) extent of a feature class '''
+    if UseArcpy():
+        extent = arcpy.Describe(inFeature).extent
+        return extent.XMin, extent.YMin, extent.XMax, extent.YMax
+
+    # the bounding box of a shapefile is in its file header, but some writers leave it empty
+    if os.path.splitext(inFeature)[1].lower() == '.shp':
+        with open(inFeature, 'rb') as f:
+            xMin, yMin, xMax, yMax = np.frombuffer(f.read(100), dtype='<f8', count=4, offset=36)
+        if xMax > xMin and yMax > yMin:
+            return xMin, yMin, xMax, yMax
+
+        points = np.concatenate([ring for rings in ReadShapefilePolygons(inFeature, None)[1] for ring in rings])
+        return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+    if pyogrio is None:
+        raise ValueError("pyogrio is required to read {0} with the native backend".format(inFeature))
+
+    datasetPath, layerName = SplitFeaturePath(inFeature)
+    bounds = pyogrio.read_bounds(datasetPath, layer=layerName)[1]
+    return bounds[0].min(), bounds[1].min(), bounds[2].max(), bounds[3].max()
+
+def SplitRing(ring, axis, value):
+    ''' splits a ring along a vertical (axis=0) or horizontal (axis=1) line
+        and returns the parts of the ring below and above the line '''
+    lowerRing = []
+    upperRing = []
+    previousPoint = ring[-1]
+    previousValue = previousPoint[axis]
+    for point in ring:
+        pointValue = point[axis]
+        if (previousValue < value) != (pointValue < value) and pointValue != previousValue:
+            t = (value - previousValue)/(pointValue - previousValue)
+            crossing = (previousPoint[0] + t*(point[0] - previousPoint[0]),
+                        previousPoint[1] + t*(point[1] - previousPoint[1]))
+            lowerRing.append(crossing)
+            upperRing.append(crossing)
+        if pointValue <= value:
+            lowerRing.append(point)
+        if pointValue >= value:
+            upperRing.append(point)
+        previousPoint = point
+        previousValue = pointValue
+
+    return lowerRing, upperRing
+
+def RingArea(ring):
+    ''' signed area of a ring using the shoelace formula '''
+    area = 0.0
+    x0, y0 = ring[-1]
+    for x1, y1 in ring:
+        area += x0*y1 - x1*y0
+        x0, y0 = x1, y1
+
+    return area/2.0
+
+def CalculatePixelOverlapAreas(rings, gridHeader):
+    ''' returns the flat indices (row*numCols + col) of the pixels a polygon overlaps
+        and the exact area of the polygon within each of them '''
+    xMin, yMax = gridHeader.xMin, gridHeader.yMax
+    cellSizeX, cellSizeY = gridHeader.cellSizeX, gridHeader.cellSizeY
+    numRows, numCols = gridHeader.numRows, gridHeader.numCols
+
+    pixelAreas = {}
+    totalArea = 0.0
+    for ring in rings:
+        ring = [tuple(point) for point in np.asarray(ring, dtype=np.float64).tolist()]
+        if len(ring) < 3:
+            continue
+        totalArea += RingArea(ring)
+
+        # discard any part of the ring outside of the raster extent
+        ring = SplitRing(ring, 0, xMin)[1]
+        ring = SplitRing(ring, 0, gridHeader.xMax)[0] if len(ring) > 2 else ring
+        ring = SplitRing(ring, 1, gridHeader.yMin)[1] if len(ring) > 2 else ring
+        ring = SplitRing(ring, 1, yMax)[0] if len(ring) > 2 else ring
+        if len(ring) < 3:
+            continue
+
+        xValues = [point[0] for point in ring]
+        firstCol = min(max(int((min(xValues) - xMin)//cellSizeX), 0), numCols - 1)
+        lastCol = min(max(int((max(xValues) - xMin)//cellSizeX), 0), numCols - 1)
+
+        # cut the ring into columns and then each column into cells. areas are
+        # signed so interior rings subtract from the exterior ring
+        remainingRing = ring
+        for col in range(firstCol, lastCol + 1):
+            if col < lastCol:
+                columnRing, remainingRing = SplitRing(remainingRing, 0, xMin + (col + 1)*cellSizeX)
+            else:
+                columnRing = remainingRing
+            if len(columnRing) < 3:
+                continue
+
+            yValues = [point[1] for point in columnRing]
+            firstRow = min(max(int((yMax - max(yValues))//cellSizeY), 0), numRows - 1)
+            lastRow = min(max(int((yMax - min(yValues))//cellSizeY), 0), numRows - 1)
+
+            remainingColumn = columnRing
+            for row in range(firstRow, lastRow + 1):
+                if row < lastRow:
+                    remainingColumn, cellRing = SplitRing(remainingColumn, 1, yMax - (row + 1)*cellSizeY)
+                else:
+                    cellRing = remainingColumn
+                if len(cellRing) < 3:
+                    continue
+                pixelIndex = row*numCols + col
+                pixelAreas[pixelIndex] = pixelAreas.get(pixelIndex, 0.0) + RingArea(cellRing)
+
+    # rings may be ordered clockwise (shapefiles, arcpy) or counter-clockwise
+    orientation = -1.0 if totalArea < 0 else 1.0
+    pixelIndices = np.fromiter(pixelAreas.keys(), dtype=np.int64, count=len(pixelAreas))
+    overlapAreas = np.fromiter(pixelAreas.values(), dtype=np.float64, count=len(pixelAreas))*orientation
+
+    keep = overlapAreas > 0
+    return pixelIndices[keep], overlapAreas[keep]
+
+AreaWeights = namedtuple('AreaWeights', ['ids', 'matrix', 'pixels', 'grid', 'window'])
+
+def GetGridDefinition(gridHeader):
+    ''' returns the values defining the location and size of the pixels of a raster '''
+    return (gridHeader.numRows, gridHeader.numCols, gridHeader.xMin, gridHeader.yMax,
+            gridHeader.cellSizeX, gridHeader.cellSizeY)
+
+def CalculateOverlapAreasOfPolygons(rowIndices, polygons, gridHeader):
+    ''' returns the row index, flat pixel index and overlap area of every pixel
+        overlapping each polygon, with the row index of each polygon given '''
+    rowList = []
+    pixelList = []
+    areaList = []
+    for rowIndex, rings in zip(rowIndices, polygons):
+        pixelIndices, overlapAreas = CalculatePixelOverlapAreas(rings, gridHeader)
+        rowList.append(np.full(len(pixelIndices), rowIndex, dtype=np.int64))
+        pixelList.append(pixelIndices)
+        areaList.append(overlapAreas)
+
+    rows = np.concatenate(rowList) if rowList else np.zeros(0, dtype=np.int64)
+    pixelIndices = np.concatenate(pixelList) if pixelList else np.zeros(0, dtype=np.int64)
+    overlapAreas = np.concatenate(areaList) if areaList else np.zeros(0, dtype=np.float64)
+
+    return rows, pixelIndices, overlapAreas
+
+def CalculateOverlapAreasOfPolygonsMulti(inputList):
+    ''' returns the row index, flat pixel index and overlap area of every pixel
+        overlapping each polygon of one tile '''
+    # unpack list of input variables
+    rowIndices, polygons, gridHeader = inputList
+
+    return CalculateOverlapAreasOfPolygons(rowIndices, polygons, gridHeader)
+
+def SplitPolygonsIntoTiles(polygons, numTiles):
+    ''' groups polygons into about numTiles spatial tiles of about equal numbers
+        of polygons and returns the indices of the polygons in each tile
+
+    Polygons are assigned to a tile by the center of their bounding box and
+    are never split, so a polygon straddling the edge of two tiles is
+    calculated whole in one of them. Tiles are columns split by the x of the
+    centers and then rows split by the y within each column.
+    '''
+    centers = np.zeros((len(polygons), 2), dtype=np.float64)
+    for i, rings in enumerate(polygons):
+        if len(rings) > 0:
+            points = np.concatenate([np.asarray(ring, dtype=np.float64).reshape(-1, 2) for ring in rings])
+            centers[i] = (points.min(axis=0) + points.max(axis=0))/2.0
+
+    numColumns = max(int(np.ceil(np.sqrt(numTiles))), 1)
+    numRows = max(int(np.ceil(numTiles/float(numColumns))), 1)
+
+    tiles = []
+    for column in np.array_split(np.argsort(centers[:, 0], kind='stable'), numColumns):
+        for tile in np.array_split(column[np.argsort(centers[column, 1], kind='stable')], numRows):
+            if len(tile) > 0:
+                tiles.append(np.sort(tile))
+
+    return tiles
+
+def CalculateAreaWeightMatrix(inFeature, inIDField, gridHeader, features=None, numTiles=1, numWorkers=None):
+    ''' calculates the AreaWeights of the pixels of a raster grid for each polygon of
+        a feature class, combining polygons sharing an identifier. with numTiles,
+        the overlaps are calculated in spatial tiles in parallel '''
+    if features is None:
+        features = GetPolygonsFromFeatureClass(inFeature, inIDField)
+    featureIDs, polygons = features
+
+    # rows are ordered by identifier to match the groupby in AreaWeightValuesFromFeatureClass
+    uniqueIDs, rowIndices = np.unique(featureIDs, return_inverse=True)
+
+    if numTiles is None or numTiles <= 1 or len(polygons) < 2:
+        rows, pixelIndices, overlapAreas = CalculateOverlapAreasOfPolygons(rowIndices, polygons, gridHeader)
+    else:
+        # polygons sharing an identifier may fall in different tiles. their
+        # overlap areas are summed into one row when the matrix is built
+        tiles = SplitPolygonsIntoTiles(polygons, numTiles)
+        tileResults = MultiProcess(CalculateOverlapAreasOfPolygonsMulti,
+                                   [(rowIndices[tile], [polygons[i] for i in tile], gridHeader) for tile in tiles],
+                                   numWorkers, chunksize=1)
+        rows = np.concatenate([tileRows for tileRows, tilePixels, tileAreas in tileResults])
+        pixelIndices = np.concatenate([tilePixels for tileRows, tilePixels, tileAreas in tileResults])
+        overlapAreas = np.concatenate([tileAreas for tileRows, tilePixels, tileAreas in tileResults])
+
+    # only the window of rows and columns covering the polygons is read from each
+    # raster, so pixels are numbered within the window
+    window = GetPixelWindowFromIndices(pixelIndices, gridHeader.numCols)
+    pixelIndices = (pixelIndices // gridHeader.numCols - window[0])*(window[3] - window[2]) + \
+                   (pixelIndices % gridHeader.numCols - window[2])
+
+    # columns only include pixels that overlap at least one polygon
+    pixels, columns = np.unique(pixelIndices, return_inverse=True)
+    matrix = sparse.csr_matrix((overlapAreas, (rows, columns)), shape=(len(uniqueIDs), len(pixels)))
+    matrix.sum_duplicates()
+
+    # normalize each row by the area of the polygon within the raster extent
+    rowAreas = np.asarray(matrix.sum(axis=1)).ravel()
+    if np.any(rowAreas <= 0):
+        missingIDs = uniqueIDs[rowAreas <= 0]
+        raise ValueError("{0} polygon(s) do not overlap the raster grid: {1}".format(len(missingIDs), missingIDs[:10].tolist()))
+    matrix.data /= np.repeat(rowAreas, np.diff(matrix.indptr))
+
+    return AreaWeights(uniqueIDs, matrix, pixels, GetGridDefinition(gridHeader), window)
+
+def HashAreaWeightInputs(featureIDs, polygons, inIDField, gridHeader):
+    ''' returns hashes of the polygons and identifiers of a feature class and of the
+        grid definition and spatial reference, which name cached area weights '''
+    gridHash = hashlib.sha1()
+    gridHash.update(repr(GetGridDefinition(gridHeader)).encode('utf-8'))
+    gridHash.update((gridHeader.spatialReference or '').encode('utf-8'))
+
+    return HashPolygons(featureIDs, polygons, inIDField), gridHash.hexdigest()
+
+def HashPolygons(featureIDs, polygons, inIDField):
+    ''' returns a hexadecimal hash of the identifiers and geometry of polygons
+        read with GetPolygonsFromFeatureClass and the name of their identifier field '''
+    aoiHash = hashlib.sha1()
+    aoiHash.update(inIDField.encode('utf-8'))
+    aoiHash.update(np.asarray(featureIDs).astype(str).tobytes())
+    for rings in polygons:
+        aoiHash.update(len(rings).to_bytes(4, 'little'))
+        for ring in rings:
+            aoiHash.update(np.ascontiguousarray(ring, dtype=np.float64).tobytes())
+
+    return aoiHash.hexdigest()
+
+def SaveAreaWeights(weights, outFile):
+    ''' saves area weights to a .npz file. the file is written to a temporary
+        name first so an interrupted run never leaves a partial file '''
+    tempFile = '{0}.{1}.tmp.npz'.format(outFile, os.getpid())
+    np.savez(tempFile,
+             ids=weights.ids,
+             data=weights.matrix.data,
+             indices=weights.matrix.indices,
+             indptr=weights.matrix.indptr,
+             shape=np.array(weights.matrix.shape),
+             pixels=weights.pixels,
+             grid=np.array(weights.grid, dtype=np.float64),
+             window=np.array(weights.window))
+    os.replace(tempFile, outFile)
+
+    return outFile
+
+def LoadAreaWeights(inFile):
+    ''' loads area weights saved with SaveAreaWeights '''
+    with np.load(inFile, allow_pickle=False) as weightsFile:
+        matrix = sparse.csr_matrix((weightsFile['data'], weightsFile['indices'], weightsFile['indptr']),
+                                   shape=tuple(weightsFile['shape']))
+        grid = weightsFile['grid'].tolist()
+        grid = (int(grid[0]), int(grid[1])) + tuple(grid[2:])
+
+        window = tuple(int(i) for i in weightsFile['window'])
+
+        return AreaWeights(weightsFile['ids'], matrix, weightsFile['pixels'], grid, window)
+
+def GetAreaWeightMatrix(inFeature, inIDField, gridHeader, cacheDir=None, numTiles=1):
+    ''' returns the area weights for a feature class and raster grid, reusing the
+        weights cached in cacheDir for the same polygons and grid if given '''
+    features = GetPolygonsFromFeatureClass(inFeature, inIDField)
+    if cacheDir is None:
+        return CalculateAreaWeightMatrix(inFeature, inIDField, gridHeader, features, numTiles)
+
+    aoiHash, gridHash = HashAreaWeightInputs(features[0], features[1], inIDField, gridHeader)
+    cacheFile = os.path.join(cacheDir, "weights_{0}_{1}.npz".format(aoiHash[:16], gridHash[:16]))
+
+    if os.path.exists(cacheFile):
+        return LoadAreaWeights(cacheFile)
+
+    weights = CalculateAreaWeightMatrix(inFeature, inIDField, gridHeader, features, numTiles)
+    SaveAreaWeights(weights, cacheFile)
+
+    return weights
+
+def WeightPixelValues(weights, pixelValues, noData=None):
+    ''' area weights the values of weights.pixels, one value or one column per raster,
+        excluding noData pixels and rescaling the weights of the other pixels '''
+    pixelValues = np.asarray(pixelValues, dtype=np.float64)
+
+    if noData is None:
+        return weights.matrix @ pixelValues
+
+    validPixels = pixelValues != noData
+    if np.all(validPixels):
+        return weights.matrix @ pixelValues
+
+    pixelValues = np.where(validPixels, pixelValues, 0.0)
+    validWeights = weights.matrix @ validPixels.astype(np.float64)
+    weightedValues = weights.matrix @ pixelValues
+    return np.divide(weightedValues, validWeights, out=np.zeros_like(weightedValues), where=validWeights > 0)
+
+def ApplyAreaWeights(weights, inValues, noData=None):
+    ''' area weights the (numRows, numCols) values of a raster to each polygon in the
+        order of weights.ids, excluding noData pixels '''
+    rowStart, rowEnd, colStart, colEnd = weights.window
+    windowValues = np.asarray(inValues)[rowStart:rowEnd, colStart:colEnd]
+
+    return WeightPixelValues(weights, windowValues.reshape(-1)[weights.pixels], noData)
+
+def ReadWeightedPixels(inRaster, weights):
+    ''' reads the values of the pixels used by the area weights from a BIL raster
+        and returns them with the nodata value of the raster '''
+    header = ReadBilHeader(inRaster)
+    if GetGridDefinition(header) != weights.grid:
+        raise ValueError("{0} is not on the grid used to calculate the area weights".format(inRaster))
+
+    return ReadBilWindow(inRaster, weights.window, header=header).reshape(-1)[weights.pixels], header.noData
+
+def AreaWeightValuesFromRaster(inRaster, weights, inValueUnits, outValueUnits):
+    ''' performs area weighting of a raster using precalculated weights '''
+    pixelValues, noData = ReadWeightedPixels(inRaster, weights)
+
+    # weights sum to 1, so converting the weighted value also converts temperatures
+    scale, offset = UnitConversion(inValueUnits, outValueUnits)
+    weightedValues = WeightPixelValues(weights, pixelValues, noData)*scale + offset
+
+    return weightedValues.tolist()
+
+def AreaWeightValuesFromRasters(inRastersList, weights, inValueUnits, outValueUnits, blockSize=120, numReaders=4, stage=None, budget=None):
+    ''' yields (rasters x identifiers) area weighted values for blocks of blockSize
+        rasters read ahead by numReaders threads. the blocks fit in budget besides
+        the memory in use and are halved, as recorded in stage, when it is exceeded '''
+    scale, offset = UnitConversion(inValueUnits, outValueUnits)
+    numPixels = len(weights.pixels)
+    if budget is not None:
+        blockSize = budget.GetBlockSize(16*numPixels, blockSize, CurrentMemory() or 0)
+    if stage is not None:
+        stage.BlockSize(blockSize)
+    pixelReads = PipelineMap(None, inRastersList, partial(ReadWeightedPixels, weights=weights),
+                             numReaders=numReaders, maxPending=blockSize + numReaders, stage=stage)
+
+    blockStart = 0
+    while blockStart < len(inRastersList):
+        blockRasters = inRastersList[blockStart:blockStart + blockSize]
+        blockStart += len(blockRasters)
+        pixelBlock = np.empty((numPixels, len(blockRasters)), dtype=np.float64)
+
+        # rasters in a block normally share a nodata value, otherwise mask each column
+        blockNoData = None
+        for i in range(len(blockRasters)):
+            pixelValues, noData = next(pixelReads)
+            pixelBlock[:, i] = pixelValues
+            if noData is not None:
+                if blockNoData is None:
+                    blockNoData = noData
+                elif noData != blockNoData:
+                    pixelBlock[pixelValues == noData, i] = blockNoData
+
+        weightedValues = WeightPixelValues(weights, pixelBlock, blockNoData)
+        weightedValues *= scale
+        weightedValues += offset
+        del pixelBlock
+
+        if budget is not None and blockSize > 1 and budget.IsExceeded():
+            blockSize = max(blockSize // 2, 1)
+            if stage is not None:
+                stage.BlockSize(blockSize, reduced=True)
+
+        yield weightedValues.T
+
+    pixelReads.close()
+
+def FormatPrecipValues(values):
+    ''' formats rainfall rates to 10 byte strings identical to '{:>10.3}'.format,
+        rounding with numpy and formatting each distinct rounded value once '''
+    values = np.asarray(values, dtype=np.float64)
+    flatValues = values.reshape(-1)
+
+    # split each value into a 3 digit mantissa and a decimal exponent. the rare
+    # values whose exponent is off by one from log10 are corrected afterwards
+    with np.errstate(all='ignore'):
+        absValues = np.abs(flatValues)
+        rounded = np.isfinite(absValues) & (absValues > 0)
+        exponents = np.floor(np.log10(np.where(rounded, absValues, 1.0))).astype(np.int64)
+        powersOfTen = np.array([float('1e{0}'.format(i)) for i in range(-330, 311)])
+        mantissas = absValues / powersOfTen[exponents + 328]
+        for i in np.flatnonzero(rounded & ((mantissas >= 1000.0) | (mantissas < 100.0))).tolist():
+            exponents[i] += 1 if mantissas[i] >= 1000.0 else -1
+            mantissas[i] = absValues[i] / powersOfTen[exponents[i] + 328]
+
+        # values within floating point error of a rounding tie are left to python,
+        # as are values so large or small that the powers of ten lose precision
+        # or the rounded value overflows
+        digits = np.rint(mantissas)
+        rounded &= np.abs(np.abs(mantissas - digits) - 0.5) > 1e-6
+        rounded &= (exponents > -300) & (exponents < 300)
+        digits = np.where(rounded, digits, 100.0).astype(np.int64)
+        for i in np.flatnonzero(digits >= 1000).tolist():
+            digits[i] = 100
+            exponents[i] += 1
+
+    exponents[~rounded] = 0
+    exponentMin = int(exponents.min()) if len(exponents) > 0 else 0
+    exponentSpan = int(exponents.max()) - exponentMin + 1 if len(exponents) > 0 else 1
+
+    # each distinct sign, exponent and mantissa is a key into a table of strings
+    # formatted by python. the last two keys are for positive and negative zero
+    keys = (exponents - exponentMin)*1000 + digits
+    keys += np.signbit(flatValues)*(exponentSpan*1000)
+    zeroKey = 2*exponentSpan*1000
+    keys[flatValues == 0] = zeroKey
+    keys[(flatValues == 0) & np.signbit(flatValues)] = zeroKey + 1
+    keys[~(rounded | (flatValues == 0))] = zeroKey
+
+    keyPresent = np.zeros(zeroKey + 2, dtype=bool)
+    keyPresent[keys] = True
+    keyStrings = np.empty(zeroKey + 2, dtype='S10')
+    for key in np.flatnonzero(keyPresent[:zeroKey]).tolist():
+        sign, key = divmod(key, exponentSpan*1000)
+        exponent, digit = divmod(key, 1000)
+        keyValue = float("{0}{1}e{2}".format('-' if sign else '', digit, exponent + exponentMin - 2))
+        keyStrings[sign*exponentSpan*1000 + exponent*1000 + digit] = '{:>10.3}'.format(keyValue)
+    keyStrings[zeroKey] = '{:>10.3}'.format(0.0)
+    keyStrings[zeroKey + 1] = '{:>10.3}'.format(-0.0)
+    formatted = keyStrings[keys]
+
+    for i in np.flatnonzero(~(rounded | (flatValues == 0))).tolist():
+        formatted[i] = '{:>10.3}'.format(float(flatValues[i]))
+
+    return formatted.reshape(values.shape)
+
+def FormatPrecipRows(textDates, values):
+    ''' formats rows of dates and (rows x stations) rainfall rates identically to
+        writing each value with '{:>10.3}' '''
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values.reshape(1, -1)
+    numRows, numCols = values.shape
+    textDates = [str(dt) for dt in textDates]
+
+    # every row is assembled as one block of bytes when the dates have the same length
+    dateLength = len(textDates[0]) if numRows > 0 else 0
+    if numRows == 0 or any([len(dt) != dateLength for dt in textDates]):
+        rowFormat = '{}' + '{:>10.3}'*numCols + '\n'
+        return ''.join([rowFormat.format(dt, *rowValues) for dt, rowValues in zip(textDates, values.tolist())])
+
+    rowBytes = np.empty((numRows, dateLength + 10*numCols + 1), dtype=np.uint8)
+    rowBytes[:, :dateLength] = np.frombuffer(''.join(textDates).encode('ascii'), dtype=np.uint8).reshape(numRows, dateLength)
+    rowBytes[:, dateLength:-1] = FormatPrecipValues(values).view(np.uint8).reshape(numRows, 10*numCols)
+    rowBytes[:, -1] = ord('\n')
+
+    return rowBytes.tobytes().decode('ascii')
+
+def WritePrecipRows(f, textDates, values, chunkSize=256):
+    ''' writes (rows x stations) rainfall rates to an open file in chunks of rows
+        and returns the number of characters written '''
+    textDates = [dt if isinstance(dt, str) else FormatIWFMDate(dt) for dt in textDates]
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values.reshape(1, -1)
+
+    if len(textDates) != values.shape[0]:
+        raise ValueError("{0} dates were provided for {1} rows of values".format(len(textDates), values.shape[0]))
+
+    charactersWritten = 0
+    for chunkStart in range(0, len(textDates), chunkSize):
+        chunkEnd = chunkStart + chunkSize
+        charactersWritten += f.write(FormatPrecipRows(textDates[chunkStart:chunkEnd], values[chunkStart:chunkEnd]))
+
+    return charactersWritten
+
+def WritePrecipFile(outFile, textDates, values, outUnits, NSPRN=1, NFQRN=0, chunkSize=256, timeUnit='month', variable='ppt'):
+    ''' writes an IWFM precipitation file, or the data file of another variable of
+        iwfmVariables, from (rows x stations) values or an iterable of such blocks
+        in date order, and returns its path '''
+    if variable not in iwfmVariables:
+        raise ValueError("variable must be one of {0}, not {1}".format(sorted(iwfmVariables), variable))
+    template = iwfmVariables[variable]
+    conversionFactor = 1.0 if outUnits in temperatureUnits else FACTRN(outUnits)
+
+    if isinstance(values, np.ndarray):
+        valueBlocks = [values]
+    else:
+        valueBlocks = values
+
+    # use a large write buffer so the file is written in big sequential pieces
+    with open(outFile, 'w', buffering=2**22) as f:
+        rowStart = 0
+        for i, valuesBlock in enumerate(valueBlocks):
+            valuesBlock = np.asarray(valuesBlock, dtype=np.float64)
+            if valuesBlock.ndim == 1:
+                valuesBlock = valuesBlock.reshape(1, -1)
+            if i == 0:
+                f.write(template.header(os.path.basename(outFile)))
+                f.write(template.specs(valuesBlock.shape[1], conversionFactor, NSPRN, NFQRN, timeUnit))
+                f.write(template.data(valuesBlock.shape[1]))
+            rowEnd = rowStart + valuesBlock.shape[0]
+            WritePrecipRows(f, textDates[rowStart:rowEnd], valuesBlock, chunkSize)
+            rowStart = rowEnd
+
+    if rowStart != len(textDates):
+        raise ValueError("{0} dates were provided for {1} rows of values".format(len(textDates), rowStart))
+
+    return outFile
+
+def GetAreaWeightsForRasters(rasterFiles, aoiFeature, aoiIDField, cacheDir=None, numTiles=1):
+    ''' returns the area weights to use for each raster in a series
+
+    Weights are calculated once for each raster grid in the series, e.g. a
+    series mixing 4 km and 800 m PRISM rasters gets two sets of weights.
+    Rasters on the same grid share the same AreaWeights object. The weights
+    of large areas of interest can be calculated in numTiles spatial tiles
+    in parallel.
+    '''
+    weightsByGrid = {}
+    rasterWeights = []
+    for raster in rasterFiles:
+        header = ReadBilHeader(raster)
+        grid = GetGridDefinition(header)
+        if grid not in weightsByGrid:
+            print("Getting Area Weights for {0} on a {1} x {2} grid".format(aoiFeature, header.numRows, header.numCols))
+            weightsByGrid[grid] = GetAreaWeightMatrix(aoiFeature, aoiIDField, header, cacheDir, numTiles)
+        rasterWeights.append(weightsByGrid[grid])
+
+    allWeights = list(weightsByGrid.values())
+    if not all([np.array_equal(weights.ids, allWeights[0].ids) for weights in allWeights]):
+        raise ValueError("area weights for each raster grid must have the same identifiers")
+
+    return rasterWeights
+
+def AreaWeightValuesFromRasterSeries(rasterFiles, rasterWeights, inValueUnits, outValueUnits, blockSize=120, numReaders=4, stage=None,
+                                     budget=None):
+    ''' yields (rasters x identifiers) blocks of area weighted values for a series
+        of rasters using the weights returned by GetAreaWeightsForRasters '''
+    # split the rasters into runs of consecutive rasters sharing a grid
+    runStarts = [i for i in range(len(rasterFiles)) if i == 0 or rasterWeights[i] is not rasterWeights[i-1]]
+    runEnds = runStarts[1:] + [len(rasterFiles)]
+
+    for runStart, runEnd in zip(runStarts, runEnds):
+        for valuesBlock in AreaWeightValuesFromRasters(rasterFiles[runStart:runEnd], rasterWeights[runStart],
+                                                       inValueUnits, outValueUnits, blockSize, numReaders, stage, budget):
+            yield valuesBlock
+
+def GetOutputPeriods(outputRasters, outTimeStep=None, report=None, allowGaps=False):
+    ''' returns the rasters used, the row of each, the IWFM dates and the time step
+        of the rows of a file. summed months missing days at either end are left
+        out with a warning in report, and gaps are rejected unless allowGaps '''
+    if report is None:
+        report = RunReport()
+    inTimeSteps = outputRasters['TimeStep'].unique().tolist()
+    if len(inTimeSteps) > 1:
+        raise ValueError("the rasters mix {0} time steps".format(" and ".join(inTimeSteps)))
+    inTimeStep = inTimeSteps[0] if len(inTimeSteps) > 0 else 'monthly'
+    if outTimeStep is None:
+        outTimeStep = inTimeStep
+    if outTimeStep not in timeStepNames:
+        raise ValueError("time step must be one of {0}, not {1}".format(timeStepNames, outTimeStep))
+    if inTimeStep == 'monthly' and outTimeStep == 'daily':
+        raise ValueError("monthly rasters cannot be written to a daily time series")
+
+    duplicated = outputRasters['Date'].duplicated(keep=False)
+    if duplicated.any():
+        raise ValueError("{0} rasters share a date: {1}".format(duplicated.sum(), outputRasters['FileNames'][duplicated].tolist()[:10]))
+
+    if inTimeStep == outTimeStep:
+        gaps = FindDateGaps(outputRasters['Date'], outTimeStep)[1]
+        if len(gaps) > 0:
+            gaps = ["{0} to {1}".format(start, end) if start != end else start for start, end in gaps]
+            message = "{0} gap(s) of {1} rows without rasters: {2}".format(len(gaps), outTimeStep, gaps[:10])
+            if not allowGaps:
+                raise ValueError(message)
+            report.Warn(message)
+        return outputRasters, np.arange(len(outputRasters)), outputRasters['TextDate'].tolist(), outTimeStep
+
+    # daily rasters are summed by month. rasters are in date order, so the rows
+    # of the months are in the order they first appear
+    months = outputRasters['Date'].dt.to_period('M')
+    rowIndices, uniqueMonths = pd.factorize(months)
+    numDays = np.bincount(rowIndices, minlength=len(uniqueMonths))
+    incomplete = numDays != uniqueMonths.days_in_month
+    if incomplete[1:-1].any():
+        raise ValueError("{0} month(s) are missing daily rasters: {1}".format(incomplete[1:-1].sum(),
+                                                                             [str(month) for month in uniqueMonths[1:-1][incomplete[1:-1]]][:10]))
+
+    # partial months at either end of the series are left out
+    keepMonths = ~incomplete
+    for i in sorted(set([0, len(uniqueMonths) - 1])):
+        if len(uniqueMonths) > 0 and incomplete[i]:
+            report.Warn("Leaving out {0}, which only has {1} of {2} daily rasters".format(uniqueMonths[i], numDays[i], uniqueMonths[i].days_in_month))
+    keep = keepMonths[rowIndices]
+    outputRasters = outputRasters[keep]
+    rowIndices = np.cumsum(keepMonths)[rowIndices[keep]] - 1
+    uniqueMonths = uniqueMonths[keepMonths]
+
+    # a month with no daily rasters at all does not show up as incomplete
+    monthSteps = np.diff(uniqueMonths.asi8)
+    if np.any(monthSteps != 1):
+        gaps = ["{0} to {1}".format(start + 1, end - 1) for start, end in zip(uniqueMonths[:-1][monthSteps != 1], uniqueMonths[1:][monthSteps != 1])]
+        message = "{0} gap(s) of months without daily rasters: {1}".format(len(gaps), gaps[:10])
+        if not allowGaps:
+            raise ValueError(message)
+        report.Warn(message)
+
+    textDates = uniqueMonths.to_timestamp(how='end').strftime('%m/%d/%Y_24:00').tolist()
+
+    return outputRasters, rowIndices, textDates, outTimeStep
+
+def SumValuesByRow(valueBlocks, rowIndices, mean=False):
+    ''' sums, or averages if mean, (rasters x identifiers) blocks of values into the
+        rows of rowIndices, yielding each row once its last raster is added '''
+    rowIndices = np.asarray(rowIndices)
+    rowDivisors = np.bincount(rowIndices).astype(np.float64) if mean and len(rowIndices) > 0 else None
+    partialRow = None
+    rasterStart = 0
+    for valuesBlock in valueBlocks:
+        valuesBlock = np.asarray(valuesBlock, dtype=np.float64)
+        blockRows = rowIndices[rasterStart:rasterStart + len(valuesBlock)]
+        rasterStart += len(valuesBlock)
+        if len(blockRows) == 0:
+            continue
+
+        rowStarts = np.flatnonzero(np.r_[True, blockRows[1:] != blockRows[:-1]])
+        rowSums = np.add.reduceat(valuesBlock, rowStarts, axis=0)
+        if rowDivisors is not None:
+            rowSums /= rowDivisors[blockRows[rowStarts], np.newaxis]
+        if partialRow is not None:
+            if blockRows[0] == partialRow[0]:
+                rowSums[0] += partialRow[1]
+            else:
+                yield partialRow[1].reshape(1, -1)
+
+        # the last row of the block may continue in the next block
+        partialRow = (blockRows[-1], rowSums[-1])
+        if len(rowSums) > 1:
+            yield rowSums[:-1]
+
+    if partialRow is not None:
+        yield partialRow[1].reshape(1, -1)
+
+def WritePrecipFileFromRasters(inRastersList, aoiFeature, aoiIDField, inUnits, outUnits, outFile, blockSize=120, cacheDir=None, report=None,
+                               numTiles=1, outTimeStep=None, storeDir=None, memoryBudget=None, allowGaps=False):
+    ''' writes an IWFM precipitation file by area weighting BIL rasters
+        to the polygons of the area of interest feature class. the weights
+        of large areas of interest can be calculated in numTiles spatial
+        tiles in parallel. daily rasters are written as a daily time series,
+        or summed into monthly totals as they are read if outTimeStep is
+        'monthly'. the values are also saved in inUnits to a ResultStoreWriter
+        store in storeDir if given, to export other files from later. the
+        rasters weighted at once are limited to fit in memoryBudget bytes,
+        by default most of the memory available. dates without rasters are
+        rejected unless allowGaps is True. the ordering, weights, weighting
+        and writing stages are timed in report if given '''
+    if report is None:
+        report = RunReport()
+
+    with report.Stage('ordering'):
+        outputRasters, rowIndices, textDates, rowTimeStep = GetOutputPeriods(OrderFilesByDate(inRastersList), outTimeStep, report, allowGaps)
+        rasterFiles = outputRasters['FileNames'].tolist()
+
+    with report.Stage('weights'):
+        rasterWeights = GetAreaWeightsForRasters(rasterFiles, aoiFeature, aoiIDField, cacheDir, numTiles)
+
+    # stored values are kept in the raster units and converted as they are written
+    valueUnits = outUnits if storeDir is None else inUnits
+    weightingStage = report.GetStage('weighting', len(rasterFiles))
+    valueBlocks = AreaWeightValuesFromRasterSeries(rasterFiles, rasterWeights, inUnits, valueUnits, blockSize, stage=weightingStage,
+                                                   budget=MemoryBudget(memoryBudget))
+    valueBlocks = report.TimeIterator('weighting', valueBlocks, countFunc=len)
+    if len(textDates) < len(rasterFiles):
+        valueBlocks = SumValuesByRow(valueBlocks, rowIndices)
+    if storeDir is not None:
+        storeWriter = ResultStoreWriter(storeDir, rasterWeights[0].ids, textDates, inUnits, 'ppt', rowTimeStep)
+        scale, offset = UnitConversion(inUnits, outUnits)
+        valueBlocks = (valuesBlock*scale + offset for valuesBlock in storeWriter.StoreBlocks(valueBlocks))
+
+    with report.Stage('writing'):
+        return WritePrecipFile(outFile, textDates, valueBlocks, outUnits, timeUnit='day' if rowTimeStep == 'daily' else 'month')
+
+def WriteIWFMFilesFromRasters(variableRasters, aoiFeature, aoiIDField, variableUnits, outFiles, blockSize=120, cacheDir=None,
+                              report=None, numTiles=1, outTimeStep=None, storeDirs=None, memoryBudget=None):
+    ''' writes one IWFM data file per variable of iwfmVariables by area weighting
+        the rasters of each variable with one shared set of area weights, and
+        returns the file of each variable '''
+    if report is None:
+        report = RunReport()
+
+    variables = list(variableRasters)
+    for variable in variables:
+        if variable not in iwfmVariables:
+            raise ValueError("variable must be one of {0}, not {1}".format(sorted(iwfmVariables), variable))
+
+    with report.Stage('ordering'):
+        periods = {variable: GetOutputPeriods(OrderFilesByDate(variableRasters[variable]), outTimeStep, report) for variable in variables}
+
+        # every variable must have a row for the same dates
+        textDates = periods[variables[0]][2]
+        for variable in variables[1:]:
+            variableDates = periods[variable][2]
+            if variableDates != textDates:
+                missing = sorted(set(textDates) - set(variableDates))
+                extra = sorted(set(variableDates) - set(textDates))
+                raise ValueError("{0} rasters are missing {1} date(s) of the {2} rasters {3} and have {4} other date(s) {5}".format(
+                    variable, len(missing), variables[0], missing[:10], len(extra), extra[:10]))
+
+    with report.Stage('weights'):
+        allRasters = [raster for variable in variables for raster in periods[variable][0]['FileNames']]
+        allWeights = GetAreaWeightsForRasters(allRasters, aoiFeature, aoiIDField, cacheDir, numTiles)
+
+    budget = MemoryBudget(memoryBudget)
+    weightsStart = 0
+    for variable in variables:
+        outputRasters, rowIndices, textDates, rowTimeStep = periods[variable]
+        rasterFiles = outputRasters['FileNames'].tolist()
+        rasterWeights = allWeights[weightsStart:weightsStart + len(rasterFiles)]
+        weightsStart += len(rasterFiles)
+        inUnits, outUnits = variableUnits[variable]
+        storeDir = storeDirs.get(variable) if storeDirs is not None else None
+        valueUnits = outUnits if storeDir is None else inUnits
+
+        print("Area Weighting {0} {1} rasters".format(len(rasterFiles), variable))
+        weightingStage = report.GetStage('weighting {0}'.format(variable), len(rasterFiles))
+        valueBlocks = AreaWeightValuesFromRasterSeries(rasterFiles, rasterWeights, inUnits, valueUnits, blockSize, stage=weightingStage,
+                                                       budget=budget)
+        valueBlocks = report.TimeIterator('weighting {0}'.format(variable), valueBlocks, countFunc=len)
+        if len(textDates) < len(rasterFiles):
+            valueBlocks = SumValuesByRow(valueBlocks, rowIndices, iwfmVariables[variable].aggregation == 'mean')
+        if storeDir is not None:
+            storeWriter = ResultStoreWriter(storeDir, rasterWeights[0].ids, textDates, inUnits, variable, rowTimeStep)
+            scale, offset = UnitConversion(inUnits, outUnits)
+            valueBlocks = (valuesBlock*scale + offset for valuesBlock in storeWriter.StoreBlocks(valueBlocks))
+
+        with report.Stage('writing {0}'.format(variable)):
+            WritePrecipFile(outFiles[variable], textDates, valueBlocks, outUnits,
+                            timeUnit='day' if rowTimeStep == 'daily' else 'month', variable=variable)
+
+    return {variable: outFiles[variable] for variable in variables}
+
+def WritePrecipFileFromIntersect(inRastersList, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, outFile, numWorkers=None, report=None,
+                                 scratchWorkspace=None, keepIntermediates=False, diskBudget=None, memoryBudget=None):
+    ''' writes an IWFM precipitation file by intersecting vectorized rasters
+        with the polygons of the area of interest feature class
+
+    Each raster goes through all of the geoprocessing steps in one task, and
+    rows are written in date order as the tasks finish instead of after every
+    raster has finished every step. Intermediate files are written to the
+    Clipped, Points, Fishnet, Polygon and Intersect directories of
+    scratchWorkspace, e.g. a local disk, or of outWorkspace if it is None,
+    and each one is deleted once the steps using it have finished unless
+    keepIntermediates is True. The steps completed for each raster are
+    recorded in the Manifest directory of outWorkspace, so a run that was
+    interrupted or whose rasters changed only redoes the steps that are
+    missing or out of date. The values of each raster are kept with its
+    manifest, so rasters whose values are still valid are skipped whether
+    or not their intermediates were kept. The stages are timed in report if given.
+
+    If diskBudget is given, the first raster is processed on its own to
+    measure the peak bytes of intermediate files of a raster, and the number
+    of rasters in the pipeline at once is limited so that their
+    intermediates fit in diskBudget bytes.
+
+    The number of workers is chosen so that the memory of the rasters
+    processed at once, estimated from the raster window and feature count
+    with EstimateIntersectTaskBytes, fits in memoryBudget bytes, by default
+    most of the memory available. Once tasks finish, their measured peak
+    memory limits the rasters in the pipeline instead of the estimate.
+    '''
+    if report is None:
+        report = RunReport()
+
+    # values are grouped by identifier, so polygons sharing one are counted once
+    featureCount = len(np.unique(ReadFeatureClassField(aoiFeature, aoiIDField)))
+
+    if scratchWorkspace is None:
+        scratchWorkspace = outWorkspace
+    for dirName in ["Clipped", "Points", "Fishnet", "Polygon", "Intersect"]:
+        MakeDirectory(scratchWorkspace, dirName)
+    manifestDir = MakeDirectory(outWorkspace, "Manifest")
+
+    with report.Stage('ordering'):
+        outputRasters = OrderFilesByDate(inRastersList)
+        textDates = outputRasters['TextDate'].tolist()
+        taskData = [(raster, aoiFeature, aoiIDField, inUnits, outUnits, outWorkspace, manifestDir, scratchWorkspace, keepIntermediates)
+                    for raster in outputRasters['FileNames']]
+
+    geoprocessingStage = report.GetStage('geoprocessing', len(taskData))
+
+    budget = MemoryBudget(memoryBudget)
+    if len(taskData) > 0:
+        budget.EstimateTask(EstimateIntersectTaskBytes(taskData[0][0], aoiFeature))
+        numWorkers = budget.GetNumWorkers(numWorkers)
+        print("Geoprocessing is estimated to use {0:.0f} MB per raster. Using {1} workers.".format(budget.GetTaskBytes()/1e6, numWorkers))
+
+    def ValueRows():
+        maxPending = None
+        remainingTasks = taskData
+        if diskBudget is not None and len(taskData) > 0:
+            for values, rasterBytes in PipelineMap(IntersectRasterDiskUsageMulti, taskData[:1], numWorkers=numWorkers, stage=geoprocessingStage,
+                                                   budget=budget):
+                yield values
+            remainingTasks = taskData[1:]
+
+            # the budget bounds the rasters in flight. intermediates kept with
+            # keepIntermediates stay on disk after their raster and are not bounded
+            maxPending = max(int(diskBudget // rasterBytes), 1) if rasterBytes > 0 else None
+            if maxPending is not None:
+                print("Intermediate files use about {0:.1f} MB per raster. Processing up to {1} rasters at once.".format(rasterBytes/1e6, maxPending))
+
+        for values in PipelineMap(IntersectRasterMulti, remainingTasks, numWorkers=numWorkers, maxPending=maxPending, stage=geoprocessingStage,
+                                  budget=budget):
+            yield values
+
+    def CheckedValueRows():
+        for raster, values in zip(outputRasters['FileNames'], report.TimeIterator('geoprocessing', ValueRows())):
+            if len(values) != featureCount:
+                raise ValueError("{0} has values for {1} of {2} polygons in {3}".format(raster, len(values), featureCount, aoiFeature))
+            yield values
+
+    with report.Stage('writing'):
+        return WritePrecipFile(outFile, textDates, CheckedValueRows(), outUnits)
+
+def CalculatePixelCentersInPolygon(rings, gridHeader):
+    ''' returns the flat pixel indices (row*numCols + col) of the raster pixels
+        whose centers are inside a polygon, the rule used to rasterize zones
+
+    Each row of pixel centers is crossed with every edge of the rings and
+    the pixels between each pair of crossings are inside, so interior rings
+    are excluded without needing to know which rings are holes.
+    '''
+    rings = [np.asarray(ring, dtype=np.float64) for ring in rings if len(ring) > 2]
+    if len(rings) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    points = np.concatenate(rings)
+    rowStart, rowEnd, colStart, colEnd = GetPixelWindow(gridHeader, (points[:, 0].min(), points[:, 1].min(),
+                                                                     points[:, 0].max(), points[:, 1].max()))
+    if rowEnd <= rowStart or colEnd <= colStart:
+        return np.zeros(0, dtype=np.int64)
+
+    # edges from each point to the next, closing each ring
+    startPoints = points
+    endPoints = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    rows = np.arange(rowStart, rowEnd)
+    rowCenters = gridHeader.yMax - (rows + 0.5)*gridHeader.cellSizeY
+
+    # an edge crosses a row when exactly one of its ends is below the row center
+    crosses = (startPoints[:, 1:2] <= rowCenters) != (endPoints[:, 1:2] <= rowCenters)
+    edgeIndices, rowIndices = np.nonzero(crosses)
+    x0, y0 = startPoints[edgeIndices, 0], startPoints[edgeIndices, 1]
+    x1, y1 = endPoints[edgeIndices, 0], endPoints[edgeIndices, 1]
+    crossings = x0 + (rowCenters[rowIndices] - y0)*(x1 - x0)/(y1 - y0)
+
+    # every row is crossed an even number of times. pixels with centers
+    # from each odd crossing up to the next crossing are inside
+    order = np.lexsort((crossings, rowIndices))
+    crossings = crossings[order]
+    rowIndices = rowIndices[order]
+    firstCols = np.ceil((crossings[0::2] - gridHeader.xMin)/gridHeader.cellSizeX - 0.5).astype(np.int64)
+    lastCols = np.ceil((crossings[1::2] - gridHeader.xMin)/gridHeader.cellSizeX - 0.5).astype(np.int64)
+    firstCols = np.clip(firstCols, 0, gridHeader.numCols)
+    runLengths = np.clip(lastCols, 0, gridHeader.numCols) - firstCols
+    runLengths[runLengths < 0] = 0
+
+    runStarts = rows[rowIndices[0::2]]*gridHeader.numCols + firstCols
+    runOffsets = np.cumsum(runLengths) - runLengths
+    pixelIndices = np.repeat(runStarts - runOffsets, runLengths) + np.arange(runLengths.sum())
+
+    return np.unique(pixelIndices)
+
+ZoneLabels = namedtuple('ZoneLabels', ['ids', 'labels', 'grid', 'window', 'extraZones', 'extraPixels'])
+
+def RasterizeZones(inFeature, inZoneField, gridHeader, features=None):
+    ''' rasterizes zone polygons to ZoneLabels by pixel center, as zonal statistics
+        in arcpy do. zones too small to hold a pixel center get the pixel they
+        overlap most, kept in extraZones and extraPixels '''
+    if features is None:
+        features = GetPolygonsFromFeatureClass(inFeature, inZoneField)
+    featureIDs, polygons = features
+
+    uniqueIDs, zoneIndices = np.unique(featureIDs, return_inverse=True)
+
+    pointList = [np.asarray(ring, dtype=np.float64) for rings in polygons for ring in rings if len(ring) > 0]
+    if len(pointList) == 0:
+        raise ValueError("{0} has no polygons".format(inFeature))
+    points = np.concatenate(pointList)
+    window = GetPixelWindow(gridHeader, (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()))
+    windowRows, windowCols = window[1] - window[0], window[3] - window[2]
+
+    def ToWindowIndices(pixelIndices):
+        return (pixelIndices // gridHeader.numCols - window[0])*windowCols + (pixelIndices % gridHeader.numCols - window[2])
+
+    labels = np.full(windowRows*windowCols, -1, dtype=np.int32)
+    for zoneIndex, rings in zip(zoneIndices, polygons):
+        labels[ToWindowIndices(CalculatePixelCentersInPolygon(rings, gridHeader))] = zoneIndex
+
+    # small zones use the pixel they overlap the most
+    extraZones = []
+    extraPixels = []
+    zoneCounts = np.bincount(labels[labels >= 0], minlength=len(uniqueIDs))
+    for zoneIndex in np.flatnonzero(zoneCounts == 0).tolist():
+        pixelIndices = []
+        overlapAreas = []
+        for rings in [rings for i, rings in zip(zoneIndices, polygons) if i == zoneIndex]:
+            polygonPixels, polygonAreas = CalculatePixelOverlapAreas(rings, gridHeader)
+            pixelIndices.append(polygonPixels)
+            overlapAreas.append(polygonAreas)
+        pixelIndices = np.concatenate(pixelIndices)
+        overlapAreas = np.concatenate(overlapAreas)
+        if len(pixelIndices) == 0 or overlapAreas.max() <= 0:
+            raise ValueError("zone {0} does not overlap the raster grid".format(uniqueIDs[zoneIndex]))
+        extraZones.append(zoneIndex)
+        extraPixels.append(ToWindowIndices(pixelIndices[np.argmax(overlapAreas)]))
+
+    return ZoneLabels(uniqueIDs, labels.reshape(windowRows, windowCols), GetGridDefinition(gridHeader), window,
+                      np.array(extraZones, dtype=np.int64), np.array(extraPixels, dtype=np.int64))
+
+def ZonalStatisticsFromLabels(zones, pixelValues, noData=None, statistics=('MEAN',)):
+    ''' returns the MEAN, MIN, MAX, STD (population), SUM or COUNT of the pixel values
+        of each zone, ignoring noData. zones without data are NaN, or 0 for COUNT '''
+    labels = zones.labels.reshape(-1)
+    pixelValues = np.asarray(pixelValues).reshape(-1)
+
+    zoneIndices = np.concatenate([labels[labels >= 0], zones.extraZones])
+    values = np.concatenate([pixelValues[labels >= 0], pixelValues[zones.extraPixels]]).astype(np.float64)
+    if noData is not None:
+        hasData = values != noData
+        zoneIndices = zoneIndices[hasData]
+        values = values[hasData]
+
+    numZones = len(zones.ids)
+    counts = np.bincount(zoneIndices, minlength=numZones)
+    sums = np.bincount(zoneIndices, weights=values, minlength=numZones)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums/counts
+
+    results = {}
+    for statistic in statistics:
+        statistic = statistic.upper()
+        if statistic == 'MEAN':
+            results[statistic] = means
+        elif statistic == 'SUM':
+            results[statistic] = np.where(counts > 0, sums, np.nan)
+        elif statistic == 'COUNT':
+            results[statistic] = counts
+        elif statistic == 'STD':
+            deviations = values - means[zoneIndices]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results[statistic] = np.sqrt(np.bincount(zoneIndices, weights=deviations*deviations, minlength=numZones)/counts)
+        elif statistic in ('MIN', 'MAX'):
+            extremes = np.full(numZones, np.inf if statistic == 'MIN' else -np.inf)
+            (np.minimum if statistic == 'MIN' else np.maximum).at(extremes, zoneIndices, values)
+            extremes[counts == 0] = np.nan
+            results[statistic] = extremes
+        else:
+            raise ValueError("{0} is not a supported statistic".format(statistic))
+
+    return results
+
+def ZonalValuesFromRaster(inRaster, zones, inValueUnits, outValueUnits, statistic='MEAN'):
+    ''' calculates a zonal statistic of a BIL raster for each zone and converts it to outValueUnits '''
+    header = ReadBilHeader(inRaster)
+    if GetGridDefinition(header) != zones.grid:
+        raise ValueError("{0} is not on the grid used to rasterize the zones".format(inRaster))
+
+    pixelValues = ReadBilWindow(inRaster, zones.window, header=header)
+    values = ZonalStatisticsFromLabels(zones, pixelValues, header.noData, [statistic])[statistic.upper()]
+    if statistic.upper() != 'COUNT':
+        values = values*LengthUnitConversionFactor(inValueUnits, outValueUnits)
+
+    return values
+
+def WritePrecipFileFromZonalStatistics(inRastersList, zoneFeature, zoneField, inUnits, outUnits, outFile, statistic='MEAN', numReaders=4, report=None):
+    ''' writes an IWFM precipitation file from the zonal statistic of each BIL raster
+        for the zones of the zone feature class
+
+    The zones are rasterized once for each raster grid in the series, and
+    each raster is only read and summarized by zone, without tables. The
+    stages are timed in report if given.
+
+    IWFM cannot read missing values, so a zone whose pixels are all nodata
+    in a raster raises a ValueError naming the zones and the partly written
+    file is removed. RasterizeZones already gives every zone at least one pixel.
+    '''
+    if report is None:
+        report = RunReport()
+
+    with report.Stage('ordering'):
+        outputRasters = OrderFilesByDate(inRastersList)
+        rasterFiles = outputRasters['FileNames'].tolist()
+        textDates = outputRasters['TextDate'].tolist()
+
+    with report.Stage('zones'):
+        features = GetPolygonsFromFeatureClass(zoneFeature, zoneField)
+        zonesByGrid = {}
+        rasterZones = []
+        for raster in rasterFiles:
+            header = ReadBilHeader(raster)
+            grid = GetGridDefinition(header)
+            if grid not in zonesByGrid:
+                print("Rasterizing Zones of {0} on a {1} x {2} grid".format(zoneFeature, header.numRows, header.numCols))
+                zonesByGrid[grid] = RasterizeZones(zoneFeature, zoneField, header, features)
+            rasterZones.append(zonesByGrid[grid])
+
+    def ReadZonalValues(rasterIndex):
+        return ZonalValuesFromRaster(rasterFiles[rasterIndex], rasterZones[rasterIndex], inUnits, outUnits, statistic)
+
+    def CheckedValueRows(valueRows):
+        for rasterIndex, values in enumerate(valueRows):
+            missing = np.isnan(values)
+            if np.any(missing):
+                raise ValueError("{0} zone(s) only have nodata pixels in {1}: {2}".format(
+                    np.sum(missing), rasterFiles[rasterIndex], rasterZones[rasterIndex].ids[missing].tolist()[:10]))
+            yield values
+
+    zonalStage = report.GetStage('zonalStatistics', len(rasterFiles))
+    valueRows = PipelineMap(None, range(len(rasterFiles)), ReadZonalValues, numReaders=numReaders, stage=zonalStage)
+
+    with report.Stage('writing'):
+        try:
+            return WritePrecipFile(outFile, textDates, CheckedValueRows(report.TimeIterator('zonalStatistics', valueRows)), outUnits)
+        except ValueError:
+            if os.path.exists(outFile):
+                os.remove(outFile)
+            raise
+
+PrecipFileSpecs = namedtuple('PrecipFileSpecs', ['NRAIN', 'FACTRN', 'NSPRN', 'NFQRN', 'DSSFL', 'dataOffset'])
+
+def ReadPrecipSpecs(inFile):
+    ''' reads the rainfall data specifications of an IWFM precipitation file and the
+        byte offset of the first line after them '''
+    specValues = []
+    with open(inFile, 'rb') as f:
+        while len(specValues) < 5:
+            line = f.readline()
+            if not line:
+                raise ValueError("{0} does not contain rainfall data specifications".format(inFile))
+            text = line.decode('ascii', 'replace')
+            # comment lines begin with C, c or *
+            if text[:1] in ('C', 'c', '*') or not text.strip():
+                continue
+            specValues.append(text.split('/')[0].strip())
+        dataOffset = f.tell()
+
+    return PrecipFileSpecs(int(specValues[0]), float(specValues[1]), int(specValues[2]),
+                           int(specValues[3]), specValues[4], dataOffset)
+
+def ParseIWFMDate(textDate):
+    ''' converts an IWFM time stamp e.g. 09/30/2015_24:00 to the datetime of that day '''
+    return datetime.datetime.strptime(textDate.strip()[:10], '%m/%d/%Y')
+
+def ReadLastPrecipDates(inFile, numDates=2, blockSize=2**16):
+    ''' returns the dates of the last numDates rows of an IWFM precipitation file
+        in file order by reading backwards from the end of the file. fewer dates
+        are returned if the file has fewer rows of data '''
+    dates = []
+    with open(inFile, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+
+        # read blocks from the end until the lines of the dates are complete
+        while position > 0:
+            readSize = min(blockSize, position)
+            position -= readSize
+            f.seek(position)
+            tail = f.read(readSize) + tail
+            lines = tail.split(b'\n')
+            # the first line may be cut off until the start of the file is read
+            if position > 0:
+                lines = lines[1:]
+
+            dates = []
+            foundAll = False
+            for line in reversed(lines):
+                # the date is at the start of the line so only decode its head
+                lineHead = line[:64].decode('ascii', 'replace')
+                if not line.strip():
+                    continue
+                if lineHead[:1] in ('C', 'c', '*') or not re.match(r"\s*\d{2}/\d{2}/\d{4}_", lineHead):
+                    foundAll = True
+                    break
+                dates.append(ParseIWFMDate(lineHead.split()[0]))
+                if len(dates) == numDates:
+                    foundAll = True
+                    break
+            if foundAll:
+                break
+
+    return dates[::-1]
+
+def ReadLastPrecipDate(inFile, blockSize=2**16):
+    ''' returns the date of the last row of an IWFM precipitation file by reading
+        backwards from the end of the file, or None if it has no rows of data '''
+    lastDates = ReadLastPrecipDates(inFile, 1, blockSize)
+    return lastDates[-1] if len(lastDates) > 0 else None
+
+def ReadPrecipTimeStep(inFile):
+    ''' returns the 'daily' or 'monthly' time step of the rows of an IWFM
+        precipitation file from its last two dates, or None if it cannot be
+        told, e.g. a file with one row at the end of a month '''
+    lastDates = ReadLastPrecipDates(inFile, 2)
+    if len(lastDates) == 2:
+        return 'daily' if (lastDates[1] - lastDates[0]).days == 1 else 'monthly'
+    if len(lastDates) == 1 and lastDates[0] != LastDayOfMonth(lastDates[0]):
+        return 'daily'
+
+    return None
+
+def AppendToPrecipFile(inFile, textDates, values, chunkSize=256):
+    ''' appends rows of (rows x stations) rainfall rates to an existing IWFM precipitation
+        file. if any block of values fails, the file is truncated back to its old length '''
+    specs = ReadPrecipSpecs(inFile)
+    valueBlocks = [values] if isinstance(values, np.ndarray) else values
+
+    # make sure new rows do not continue an unterminated last line
+    with open(inFile, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        needsNewLine = f.tell() > 0
+        if needsNewLine:
+            f.seek(-1, os.SEEK_END)
+            needsNewLine = f.read(1) != b'\n'
+
+    fileSize = os.path.getsize(inFile)
+    rowsAppended = 0
+    try:
+        with open(inFile, 'a', buffering=2**22) as f:
+            if needsNewLine:
+                f.write('\n')
+            for valuesBlock in valueBlocks:
+                valuesBlock = np.asarray(valuesBlock, dtype=np.float64)
+                if valuesBlock.ndim == 1:
+                    valuesBlock = valuesBlock.reshape(1, -1)
+                if valuesBlock.shape[1] != specs.NRAIN:
+                    raise ValueError("{0} has {1} stations but {2} values were provided".format(inFile, specs.NRAIN, valuesBlock.shape[1]))
+                WritePrecipRows(f, textDates[rowsAppended:rowsAppended + valuesBlock.shape[0]], valuesBlock, chunkSize)
+                rowsAppended += valuesBlock.shape[0]
+    except BaseException:
+        # the rows of the blocks written before the failure are removed again
+        with open(inFile, 'r+b') as f:
+            f.truncate(fileSize)
+        raise
+
+    return rowsAppended
+
+def UpdatePrecipFileFromRasters(inRastersList, aoiFeature, aoiIDField, inUnits, outUnits, inFile, blockSize=120, cacheDir=None, report=None,
+                                numTiles=1, outTimeStep=None, memoryBudget=None, allowGaps=False):
+    ''' appends rasters dated after the last row of an existing IWFM precipitation
+        file to that file and returns the number of rows appended
+
+    The number of stations in the file must equal the number of polygons in
+    the area of interest, FACTRN must match the output units and the rows
+    appended must have the daily or monthly time step of the file and follow
+    its last row without a gap, unless allowGaps is True. The file is left
+    unchanged if any raster fails. The weights can be calculated in numTiles spatial tiles in
+    parallel. Daily rasters are summed into monthly totals if outTimeStep is 'monthly', and
+    the rasters weighted at once fit in memoryBudget bytes, as in
+    WritePrecipFileFromRasters. The stages are timed in report if given.
+    '''
+    if report is None:
+        report = RunReport()
+
+    specs = ReadPrecipSpecs(inFile)
+    lastDate = ReadLastPrecipDate(inFile)
+
+    if abs(specs.FACTRN - FACTRN(outUnits)) > 1e-4*abs(FACTRN(outUnits)):
+        raise ValueError("FACTRN in {0} is {1}, which does not match {2}".format(inFile, specs.FACTRN, outUnits))
+
+    with report.Stage('ordering'):
+        outputRasters = OrderFilesByDate(inRastersList)
+        if lastDate is not None:
+            # a raster is appended if the row it is written to ends after the
+            # last row of the file
+            rowEndDates = outputRasters['Date'] + pd.offsets.MonthEnd(0)
+            if outTimeStep != 'monthly':
+                rowEndDates = rowEndDates.where(outputRasters['TimeStep'] != 'daily', outputRasters['Date'])
+            outputRasters = outputRasters[rowEndDates > lastDate]
+
+        outputRasters, rowIndices, textDates, rowTimeStep = GetOutputPeriods(outputRasters, outTimeStep, report, allowGaps)
+        rasterFiles = outputRasters['FileNames'].tolist()
+    if len(rasterFiles) == 0:
+        print("{0} is up to date through {1}".format(inFile, lastDate))
+        return 0
+
+    fileTimeStep = ReadPrecipTimeStep(inFile)
+    if fileTimeStep is not None and fileTimeStep != rowTimeStep:
+        raise ValueError("{0} has {1} rows, so {2} rows cannot be appended to it".format(inFile, fileTimeStep, rowTimeStep))
+
+    # the first new row must follow the last row of the file and the new rows
+    # must follow each other, or every later row of the series is shifted
+    rowDates = [ParseIWFMDate(textDate) for textDate in textDates]
+    if lastDate is not None:
+        rowDates.insert(0, lastDate)
+    periods = pd.DatetimeIndex(rowDates).to_period('D' if rowTimeStep == 'daily' else 'M')
+    periodSteps = np.diff(periods.asi8)
+    if np.any(periodSteps != 1):
+        gaps = ["{0} to {1}".format(start + 1, end - 1) for start, end in zip(periods[:-1][periodSteps != 1], periods[1:][periodSteps != 1])]
+        message = "{0} gap(s) in the rows appended to {1}, which ends {2}: {3}".format(len(gaps), inFile, lastDate, gaps[:10])
+        if not allowGaps or np.any(periodSteps < 1):
+            raise ValueError(message)
+        report.Warn(message)
+
+    # values are grouped by identifier, so polygons sharing one are counted once.
+    # checked before the weights, which can take a long time to calculate
+    numPolygons = len(np.unique(ReadFeatureClassField(aoiFeature, aoiIDField)))
+    if numPolygons != specs.NRAIN:
+        raise ValueError("{0} has {1} stations but {2} has {3} polygons".format(inFile, specs.NRAIN, aoiFeature, numPolygons))
+
+    with report.Stage('weights'):
+        rasterWeights = GetAreaWeightsForRasters(rasterFiles, aoiFeature, aoiIDField, cacheDir, numTiles)
+
+    print("Appending {0} rasters to {1}".format(len(rasterFiles), inFile))
+    weightingStage = report.GetStage('weighting', len(rasterFiles))
+    valueBlocks = AreaWeightValuesFromRasterSeries(rasterFiles, rasterWeights, inUnits, outUnits, blockSize, stage=weightingStage,
+                                                   budget=MemoryBudget(memoryBudget))
+    valueBlocks = report.TimeIterator('weighting', valueBlocks, countFunc=len)
+    if len(textDates) < len(rasterFiles):
+        valueBlocks = SumValuesByRow(valueBlocks, rowIndices)
+
+    with report.Stage('writing'):
+        return AppendToPrecipFile(inFile, textDates, valueBlocks)
+
+def GetRasterShard(inRastersList, shardIndex, numShards):
+    ''' returns the rasters of one of numShards runs of consecutive months of about
+        equal length, so every node given the same rasters gets the same shards '''
+    if not 0 <= shardIndex < numShards:
+        raise ValueError("shard index must be from 0 to {0}, not {1}".format(numShards - 1, shardIndex))
+
+    outputRasters = OrderFilesByDate(inRastersList).reset_index(drop=True)
+    shardBounds = np.linspace(0, len(outputRasters), numShards + 1).round().astype(int)
+
+    return outputRasters.iloc[shardBounds[shardIndex]:shardBounds[shardIndex + 1]]
+
+def SavePrecipShard(outFile, textDates, values, ids, outUnits, rasterFiles, shardIndex, numShards, aoiHash):
+    ''' saves the values of a shard to a .npz file with the index of the shard,
+        the number of shards and the HashPolygons hash of the area of interest.
+        the file is written to a temporary name first so an interrupted run
+        never leaves a partial file '''
+    tempFile = '{0}.{1}.tmp.npz'.format(outFile, os.getpid())
+    np.savez(tempFile,
+             dates=np.array(textDates, dtype=str),
+             values=np.asarray(values, dtype=np.float64),
+             ids=np.asarray(ids),
+             units=np.array(outUnits),
+             rasters=np.array(rasterFiles, dtype=str),
+             shardIndex=np.array(shardIndex),
+             numShards=np.array(numShards),
+             aoiHash=np.array(aoiHash))
+    os.replace(tempFile, outFile)
+
+    return outFile
+
+def ProcessPrecipShard(inRastersList, shardIndex, numShards, aoiFeature, aoiIDField, inUnits, outUnits, outFile,
+                       blockSize=120, cacheDir=None, report=None):
+    ''' area weights one shard of a raster series and saves its values to a .npz file
+        for MergePrecipShards. a shard already saved for the same inputs is skipped '''
+    if report is None:
+        report = RunReport()
+
+    with report.Stage('ordering'):
+        shardRasters = GetRasterShard(inRastersList, shardIndex, numShards)
+        rasterFiles = shardRasters['FileNames'].tolist()
+        textDates = shardRasters['TextDate'].tolist()
+        featureIDs, polygons = GetPolygonsFromFeatureClass(aoiFeature, aoiIDField)
+        aoiHash = HashPolygons(featureIDs, polygons, aoiIDField)
+
+    if os.path.exists(outFile):
+        with np.load(outFile, allow_pickle=False) as shardFile:
+            savedShard = (shardFile['rasters'].tolist(), str(shardFile['units']),
+                          int(shardFile['shardIndex']) if 'shardIndex' in shardFile.files else None,
+                          int(shardFile['numShards']) if 'numShards' in shardFile.files else None,
+                          str(shardFile['aoiHash']) if 'aoiHash' in shardFile.files else None)
+        if savedShard == (rasterFiles, outUnits, shardIndex, numShards, aoiHash):
+            print("Shard {0} of {1} is already saved in {2}".format(shardIndex + 1, numShards, outFile))
+            return outFile
+
+    if len(rasterFiles) == 0:
+        raise ValueError("shard {0} of {1} has no rasters".format(shardIndex + 1, numShards))
+
+    with report.Stage('weights'):
+        rasterWeights = GetAreaWeightsForRasters(rasterFiles, aoiFeature, aoiIDField, cacheDir)
+
+    weightingStage = report.GetStage('weighting', len(rasterFiles))
+    valueBlocks = AreaWeightValuesFromRasterSeries(rasterFiles, rasterWeights, inUnits, outUnits, blockSize, stage=weightingStage)
+    values = np.concatenate(list(report.TimeIterator('weighting', valueBlocks, countFunc=len)))
+
+    with report.Stage('writing'):
+        return SavePrecipShard(outFile, textDates, values, rasterWeights[0].ids, outUnits, rasterFiles, shardIndex, numShards, aoiHash)
+
+def MergePrecipShards(shardFiles, outFile, NSPRN=1, NFQRN=0):
+    ''' writes an IWFM precipitation file from every shard of one run, in date order.
+        missing, extra, stale, overlapping or gapped shards raise before writing '''
+    if len(shardFiles) == 0:
+        raise ValueError("no shard files to merge")
+
+    # only the dates, identifiers, units and shard numbers are read until the file is written
+    shards = []
+    shardNumbers = []
+    for shardFile in shardFiles:
+        with np.load(shardFile, allow_pickle=False) as shard:
+            if not set(['shardIndex', 'numShards', 'aoiHash']).issubset(shard.files):
+                raise ValueError("{0} does not record its shard number and area of interest. process it again".format(shardFile))
+            shards.append((shardFile, shard['dates'].tolist(), shard['ids'], str(shard['units'])))
+            shardNumbers.append((int(shard['shardIndex']), int(shard['numShards']), str(shard['aoiHash'])))
+
+    numShards = shardNumbers[0][1]
+    for (shardFile, shardDates, shardIDs, shardUnits), (shardIndex, shardCount, aoiHash) in zip(shards[1:], shardNumbers[1:]):
+        if shardCount != numShards:
+            raise ValueError("{0} is one of {1} shards, not {2} as {3}".format(shardFile, shardCount, numShards, shards[0][0]))
+        if aoiHash != shardNumbers[0][2]:
+            raise ValueError("{0} was processed for a different area of interest than {1}".format(shardFile, shards[0][0]))
+        if not np.array_equal(shardIDs, shards[0][2]):
+            raise ValueError("{0} has different polygons than {1}".format(shardFile, shards[0][0]))
+        if shardUnits != shards[0][3]:
+            raise ValueError("{0} is in {1}, not {2} as {3}".format(shardFile, shardUnits, shards[0][3], shards[0][0]))
+
+    shardIndices = sorted([shardIndex for shardIndex, shardCount, aoiHash in shardNumbers])
+    if shardIndices != list(range(numShards)):
+        missing = sorted(set(range(numShards)) - set(shardIndices))
+        duplicated = sorted(set([shardIndex for shardIndex in shardIndices if shardIndices.count(shardIndex) > 1]))
+        raise ValueError("shards {0} of {1} are missing and shards {2} are given more than once".format(missing, numShards, duplicated))
+
+    shards.sort(key=lambda shard: ParseIWFMDate(shard[1][0]))
+    textDates = [textDate for shard in shards for textDate in shard[1]]
+
+    # consecutive rows must be consecutive months, or days for a daily series
+    rowDates = pd.DatetimeIndex([ParseIWFMDate(textDate) for textDate in textDates])
+    daily = not rowDates.is_month_end.all()
+    periods = rowDates.to_period('D' if daily else 'M')
+    periodSteps = np.diff(periods.asi8)
+    if np.any(periodSteps < 1):
+        overlaps = [str(period) for period in periods[1:][periodSteps < 1]]
+        raise ValueError("{0} date(s) are in more than one shard: {1}".format(len(overlaps), overlaps[:10]))
+    if np.any(periodSteps > 1):
+        gaps = ["{0} to {1}".format(start + 1, end - 1) for start, end in zip(periods[:-1][periodSteps > 1], periods[1:][periodSteps > 1])]
+        raise ValueError("{0} gap(s) between shards: {1}".format(len(gaps), gaps[:10]))
+
+    def ShardValues():
+        for shardFile, shardDates, shardIDs, shardUnits in shards:
+            with np.load(shardFile, allow_pickle=False) as shard:
+                yield shard['values']
+
+    return WritePrecipFile(outFile, textDates, ShardValues(), shards[0][3], NSPRN, NFQRN, timeUnit='day' if daily else 'month')
+
+ResultStoreIndex = namedtuple('ResultStoreIndex', ['ids', 'textDates', 'units', 'variable', 'timeStep', 'timeChunk', 'elementChunk'])
+
+resultStoreIndexName = 'store.json'
+
+def ResultChunkFile(storeDir, timeIndex, elementIndex):
+    ''' returns the path of the chunk of values of one block of rows and polygons '''
+    return os.path.join(storeDir, 'values_t{0:05d}_e{1:05d}.npz'.format(timeIndex, elementIndex))
+
+class ResultStoreWriter(object):
+    ''' saves the (dates x polygons) area weighted values of a run to a folder
+        of compressed chunks of timeChunk rows by elementChunk polygons
+
+    The values are kept in the units they were calculated in, so files in any
+    units, date range or subset of polygons can be exported from the store
+    with ExportIWFMFileFromStore without reading the rasters again. Blocks of
+    rows are added in date order with Append and saved once a chunk of rows
+    is complete. The chunks are saved to a temporary folder next to storeDir,
+    which Close completes with the index and swaps in for the store, so an
+    earlier store is kept until the new one is complete and a store
+    interrupted while it was written is never read.
+    '''
+
+    def __init__(self, storeDir, ids, textDates, units, variable='ppt', timeStep='monthly', timeChunk=120, elementChunk=4096):
+        if timeStep not in timeStepNames:
+            raise ValueError("time step must be one of {0}, not {1}".format(timeStepNames, timeStep))
+
+        self.storeDir = storeDir
+        self.ids = np.asarray(ids)
+        self.textDates = [dt if isinstance(dt, str) else FormatIWFMDate(dt) for dt in textDates]
+        self.units = units
+        self.variable = variable
+        self.timeStep = timeStep
+        self.timeChunk = timeChunk
+        self.elementChunk = elementChunk
+        self.pendingBlocks = []
+        self.pendingRows = 0
+        self.rowsSaved = 0
+
+        # the whole folder is replaced by Close, so it may only hold a store
+        if os.path.isdir(storeDir):
+            otherFiles = [fileName for fileName in os.listdir(storeDir)
+                          if fileName != resultStoreIndexName and not re.match(r'values_t\d+_e\d+\.npz$', fileName)]
+            if len(otherFiles) > 0:
+                raise ValueError("{0} is not a result store folder. it holds {1}".format(storeDir, otherFiles[:10]))
+
+        self.tempDir = '{0}.{1}.tmp'.format(os.path.normpath(storeDir), os.getpid())
+        if os.path.isdir(self.tempDir):
+            shutil.rmtree(self.tempDir)
+        os.makedirs(self.tempDir)
+
+    def SaveChunk(self, values):
+        ''' saves one chunk of rows, split into blocks of polygons '''
+        timeIndex = self.rowsSaved // self.timeChunk
+        for elementIndex, elementStart in enumerate(range(0, len(self.ids), self.elementChunk)):
+            chunkFile = ResultChunkFile(self.tempDir, timeIndex, elementIndex)
+            tempFile = '{0}.{1}.tmp.npz'.format(chunkFile, os.getpid())
+            np.savez_compressed(tempFile, values=values[:, elementStart:elementStart + self.elementChunk])
+            os.replace(tempFile, chunkFile)
+        self.rowsSaved += values.shape[0]
+
+    def Append(self, valuesBlock):
+        ''' adds a block of (rows x polygons) values following the rows added before '''
+        valuesBlock = np.asarray(valuesBlock, dtype=np.float64)
+        if valuesBlock.ndim == 1:
+            valuesBlock = valuesBlock.reshape(1, -1)
+        if valuesBlock.shape[1] != len(self.ids):
+            raise ValueError("blocks of {0} polygons were added to a store of {1} polygons".format(valuesBlock.shape[1], len(self.ids)))
+        if self.rowsSaved + self.pendingRows + valuesBlock.shape[0] > len(self.textDates):
+            raise ValueError("more rows were added than the {0} dates of the store".format(len(self.textDates)))
+
+        self.pendingBlocks.append(valuesBlock)
+        self.pendingRows += valuesBlock.shape[0]
+        if self.pendingRows >= self.timeChunk:
+            pendingValues = np.concatenate(self.pendingBlocks)
+            numSaved = (self.pendingRows // self.timeChunk)*self.timeChunk
+            for chunkStart in range(0, numSaved, self.timeChunk):
+                self.SaveChunk(pendingValues[chunkStart:chunkStart + self.timeChunk])
+            self.pendingBlocks = [pendingValues[numSaved:]]
+            self.pendingRows -= numSaved
+
+    def StoreBlocks(self, valueBlocks):
+        ''' yields each block of values after adding it to the store and closes
+            the store after the last one, so the values can be written to a
+            file in the same pass '''
+        for valuesBlock in valueBlocks:
+            self.Append(valuesBlock)
+            yield valuesBlock
+        self.Close()
+
+    def Close(self):
+        ''' saves the last chunk of rows, writes the index of the store and
+            replaces any earlier store with it '''
+        if self.pendingRows > 0:
+            self.SaveChunk(np.concatenate(self.pendingBlocks))
+            self.pendingBlocks = []
+            self.pendingRows = 0
+        if self.rowsSaved != len(self.textDates):
+            raise ValueError("{0} dates were provided for {1} rows of values".format(len(self.textDates), self.rowsSaved))
+
+        with open(os.path.join(self.tempDir, resultStoreIndexName), 'w') as f:
+            json.dump({'version': 1,
+                       'ids': self.ids.tolist(),
+                       'dates': self.textDates,
+                       'units': self.units,
+                       'variable': self.variable,
+                       'timeStep': self.timeStep,
+                       'timeChunk': self.timeChunk,
+                       'elementChunk': self.elementChunk}, f)
+
+        # a folder can only be replaced by another if it is empty, so the
+        # earlier store is moved aside and deleted once the new one is in place
+        oldDir = None
+        if os.path.isdir(self.storeDir):
+            oldDir = '{0}.{1}.old'.format(os.path.normpath(self.storeDir), os.getpid())
+            if os.path.isdir(oldDir):
+                shutil.rmtree(oldDir)
+            os.replace(self.storeDir, oldDir)
+        os.replace(self.tempDir, self.storeDir)
+        if oldDir is not None:
+            shutil.rmtree(oldDir)
+
+        return self.storeDir
+
+def ReadResultStoreIndex(storeDir):
+    ''' returns the ResultStoreIndex of a store saved with ResultStoreWriter '''
+    indexFile = os.path.join(storeDir, resultStoreIndexName)
+    if not os.path.exists(indexFile):
+        raise ValueError("{0} is not a complete result store".format(storeDir))
+    with open(indexFile, 'r') as f:
+        index = json.load(f)
+    if index.get('version') != 1:
+        raise ValueError("{0} has an unsupported result store version {1}".format(storeDir, index.get('version')))
+
+    return ResultStoreIndex(np.array(index['ids']), index['dates'], index['units'], index['variable'],
+                            index['timeStep'], index['timeChunk'], index['elementChunk'])
+
+def ReadResultStore(storeDir, startDate=None, endDate=None, ids=None):
+    ''' returns the IWFM dates of the rows of a ResultStoreWriter store from startDate
+        to endDate and an iterator of their (rows x polygons) blocks of values for
+        ids, reading only the chunks needed '''
+    index = ReadResultStoreIndex(storeDir)
+
+    rowDates = np.array([ParseIWFMDate(textDate) for textDate in index.textDates], dtype='datetime64[D]')
+    keepRows = np.ones(len(rowDates), dtype=bool)
+    if startDate is not None:
+        keepRows &= rowDates >= np.datetime64(startDate, 'D')
+    if endDate is not None:
+        keepRows &= rowDates <= np.datetime64(endDate, 'D')
+    rowIndices = np.flatnonzero(keepRows)
+
+    if ids is None:
+        columns = np.arange(len(index.ids))
+    else:
+        idPositions = {polygonID: position for position, polygonID in enumerate(index.ids.tolist())}
+        missing = [polygonID for polygonID in ids if polygonID not in idPositions]
+        if len(missing) > 0:
+            raise ValueError("{0} polygon(s) are not in {1}: {2}".format(len(missing), storeDir, missing[:10]))
+        columns = np.array([idPositions[polygonID] for polygonID in ids], dtype=np.int64)
+    if len(columns) == 0:
+        raise ValueError("no polygons were selected from {0}".format(storeDir))
+
+    elementIndices = np.unique(columns // index.elementChunk)
+    elementStarts = {elementIndex: position*index.elementChunk for position, elementIndex in enumerate(elementIndices.tolist())}
+    chunkColumns = np.array([elementStarts[column // index.elementChunk] + column % index.elementChunk for column in columns.tolist()],
+                            dtype=np.int64)
+
+    def ValueBlocks():
+        for timeIndex in np.unique(rowIndices // index.timeChunk).tolist():
+            chunkRows = rowIndices[rowIndices // index.timeChunk == timeIndex] - timeIndex*index.timeChunk
+            elementBlocks = []
+            for elementIndex in elementIndices.tolist():
+                with np.load(ResultChunkFile(storeDir, timeIndex, elementIndex), allow_pickle=False) as chunk:
+                    elementBlocks.append(chunk['values'][chunkRows])
+            yield np.concatenate(elementBlocks, axis=1)[:, chunkColumns]
+
+    return [index.textDates[i] for i in rowIndices.tolist()], ValueBlocks()
+
+def ExportIWFMFileFromStore(storeDir, outFile, outUnits=None, startDate=None, endDate=None, ids=None, NSPRN=1, NFQRN=0):
+    ''' writes an IWFM data file in outUnits from a ResultStoreWriter store, one
+        chunk of rows at a time, for the rows and polygons selected as in ReadResultStore '''
+    index = ReadResultStoreIndex(storeDir)
+    if outUnits is None:
+        outUnits = index.units
+    scale, offset = UnitConversion(index.units, outUnits)
+
+    textDates, valueBlocks = ReadResultStore(storeDir, startDate, endDate, ids)
+    if len(textDates) == 0:
+        raise ValueError("{0} has no rows from {1} to {2}".format(storeDir, startDate, endDate))
+
+    convertedBlocks = (valuesBlock*scale + offset for valuesBlock in valueBlocks)
+
+    return WritePrecipFile(outFile, textDates, convertedBlocks, outUnits, NSPRN, NFQRN,
+                           timeUnit='day' if index.timeStep == 'daily' else 'month', variable=index.variable)
+
+def ReadPrecipFile(inFile, startDate=None, endDate=None, stations=None, chunkSize=240, cache=False):
+    ''' returns the datetime64[D] dates and float32 (rows x stations) rainfall rates
+        of an IWFM precipitation file from startDate to endDate. with cache, the
+        rates are saved as .npy files next to the file for later reads '''
+    valuesCacheFile = inFile + '.values.npy'
+    datesCacheFile = inFile + '.dates.npy'
+
+    if cache:
+        cacheIsCurrent = os.path.exists(valuesCacheFile) and os.path.exists(datesCacheFile) and \
+                         os.path.getmtime(valuesCacheFile) >= os.path.getmtime(inFile) and \
+                         os.path.getmtime(datesCacheFile) >= os.path.getmtime(inFile)
+        if not cacheIsCurrent:
+            dates, values = ReadPrecipFile(inFile, chunkSize=chunkSize)
+            # an interrupted read must not leave a partial cache that looks current
+            for cacheFile, cacheValues in ((datesCacheFile, dates), (valuesCacheFile, values)):
+                tempFile = '{0}.{1}.tmp.npy'.format(cacheFile, os.getpid())
+                np.save(tempFile, cacheValues)
+                os.replace(tempFile, cacheFile)
+        dates = np.load(datesCacheFile)
+        values = np.load(valuesCacheFile, mmap_mode='r')
+
+        keepRows = np.ones(len(dates), dtype=bool)
+        if startDate is not None:
+            keepRows &= dates >= np.datetime64(startDate, 'D')
+        if endDate is not None:
+            keepRows &= dates <= np.datetime64(endDate, 'D')
+        rowIndices = np.flatnonzero(keepRows)
+        if stations is None:
+            return dates[rowIndices], np.asarray(values[rowIndices])
+        return dates[rowIndices], np.asarray(values[np.ix_(rowIndices, np.asarray(stations) - 1)])
+
+    specs = ReadPrecipSpecs(inFile)
+
+    # skip the comment lines between the specifications and the first row
+    with open(inFile, 'rb') as f:
+        f.seek(specs.dataOffset)
+        dataOffset = specs.dataOffset
+        for line in f:
+            if line[:1] not in (b'C', b'c', b'*') and line.strip():
+                break
+            dataOffset += len(line)
+
+    if stations is not None:
+        stationColumns = np.asarray(stations, dtype=np.int64) - 1
+
+    dateList = []
+    valueList = []
+    with open(inFile, 'rb') as f:
+        f.seek(dataOffset)
+        while True:
+            rawLines = [f.readline() for i in range(chunkSize)]
+            if not rawLines[0]:
+                break
+            lines = [line for line in rawLines if line.strip() and line[:1] not in (b'C', b'c', b'*')]
+            if len(lines) == 0:
+                continue
+
+            # split the time stamp from the rates and parse all rates of the chunk at once
+            splitLines = [line.split(None, 1) for line in lines]
+            chunkDates = pd.to_datetime([splitLine[0][:10].decode('ascii') for splitLine in splitLines],
+                                        format='%m/%d/%Y').to_numpy().astype('datetime64[D]')
+
+            keepRows = np.ones(len(chunkDates), dtype=bool)
+            if startDate is not None:
+                keepRows &= chunkDates >= np.datetime64(startDate, 'D')
+            if endDate is not None:
+                keepRows &= chunkDates <= np.datetime64(endDate, 'D')
+
+            if np.any(keepRows):
+                keptLines = [splitLine[1] for splitLine, keep in zip(splitLines, keepRows.tolist()) if keep]
+                chunkValues = np.array(b' '.join(keptLines).split(), dtype=np.float32)
+                if len(chunkValues) != len(keptLines)*specs.NRAIN:
+                    raise ValueError("rows of {0} do not all have {1} values".format(inFile, specs.NRAIN))
+                chunkValues = chunkValues.reshape(len(keptLines), specs.NRAIN)
+                if stations is not None:
+                    chunkValues = chunkValues[:, stationColumns]
+                dateList.append(chunkDates[keepRows])
+                valueList.append(chunkValues)
+
+            # rows are in date order so nothing after the end date is needed
+            if endDate is not None and chunkDates[-1] > np.datetime64(endDate, 'D'):
+                break
+
+    numStations = specs.NRAIN if stations is None else len(stations)
+    if len(dateList) == 0:
+        return np.zeros(0, dtype='datetime64[D]'), np.zeros((0, numStations), dtype=np.float32)
+
+    dates = np.concatenate(dateList)
+    values = np.concatenate(valueList)
+
+    return dates, values
+
+def IWFMHeader(fileTitle, fileName, description):
+    ''' returns the header of an IWFM data file with the title, file name and
+        lines of the file description given, without claiming a model '''
     string = """C*******************************************************************************
 C
 C                  INTEGRATED WATER FLOW MODEL (IWFM)
@@ -418,12 +3739,33 @@ C                         *** Version 2015 ***
 C
 C*******************************************************************************
 C
-C                         PRECIPITATION DATA FILE
+C{0}
+C
+C             Filename: {1}
+C
+C*******************************************************************************
+C                             File Description:
+C
+{2}C """
+    return string.format(' '*(36 - len(fileTitle)//2) + fileTitle, fileName,
+                         ''.join(["C   {0}\n".format(line) for line in description]))
+
+def C2VSimFGHeader(fileTitle, fileName, description):
+    ''' returns the header of an IWFM data file of the C2VSimFG model with the
+        title, file name and lines of the file description given '''
+    string = """C*******************************************************************************
+C
+C                  INTEGRATED WATER FLOW MODEL (IWFM)
+C                         *** Version 2015 ***
+C
+C*******************************************************************************
+C
+C{0}
 C               Precipitation and Evapotranspiration Component
 C
 C             Project:  C2VSim Fine Grid (C2VSimFG)
 C                       California Central Valley Groundwater-Surface Water Simulation Model
-C             Filename: C2VSimFG_Precip.dat
+C             Filename: {1}
 C             Version:  C2VSimFG_v1.01     2021-04-01
 C
 C*******************************************************************************
@@ -473,12 +3815,18 @@ C
 C*******************************************************************************
 C                             File Description:
 C
-C   This data file contains the time-series rainfall at each rainfall station used
-C   in the model.
-C """
-    return string
+{2}C """
+    return string.format(' '*(36 - len(fileTitle)//2) + fileTitle, fileName,
+                         ''.join(["C   {0}\n".format(line) for line in description]))
+
+def PrecipHeader(fileName):
+    ''' returns the header of the C2VSimFG precipitation file, which the tools
+        have always written whatever the name of the file '''
+    return C2VSimFGHeader("PRECIPITATION DATA FILE", "C2VSimFG_Precip.dat",
+                          ["This data file contains the time-series rainfall at each rainfall station used",
+                           "in the model."])
 
-def PrecipSpecs(NRAIN, FACTRN, NSPRN, NFQRN):
+def PrecipSpecs(NRAIN, FACTRN, NSPRN, NFQRN, timeUnit='month'):
     string = """
 C*******************************************************************************
 C                         Rainfall Data Specifications
@@ -503,12 +3851,12 @@ C
 C-------------------------------------------------------------------------------
 C         VALUE                                      DESCRIPTION
 C-------------------------------------------------------------------------------
-          {:<43}/ NRAIN 
-          {:<43.5}/ FACTRN  (in/month -> ft/month)         
-          {:<43}/ NSPRN
-          {:<43}/ NFQRN
+          {0:<43}/ NRAIN 
+          {1:<43.5}/ FACTRN  (in/{4} -> ft/{4})         
+          {2:<43}/ NSPRN
+          {3:<43}/ NFQRN
                                                      / DSSFL"""
-    return string.format(NRAIN, FACTRN, NSPRN, NFQRN)
+    return string.format(NRAIN, FACTRN, NSPRN, NFQRN, timeUnit)
 
 def PrecipData(NRAIN):
     string = """
@@ -529,274 +3877,461 @@ C-------------------------------------------------------------------------------
 """
     return string.format('{:>10}'*NRAIN).format(*[i+1 for i in range(NRAIN)])
 
-if __name__ == '__main__':
+def EvapotranspirationHeader(fileName):
+    return IWFMHeader("EVAPOTRANSPIRATION DATA FILE", fileName,
+                      ["This data file contains the time-series reference evapotranspiration rates",
+                       "at each evapotranspiration column."])
+
+def EvapotranspirationSpecs(NCOLET, FACTET, NSPET, NFQET, timeUnit='month'):
+    string = """
+C*******************************************************************************
+C                     Evapotranspiration Data Specifications
+C
+C   NCOLET;  Number of evapotranspiration columns (or pathnames if DSS files
+C             are used) used in the model
+C   FACTET;  Conversion factor for evapotranspiration rate
+C             It is used to convert only the spatial component of the unit; 
+C             DO NOT include the conversion factor for time component of the unit.
+C   NSPET ;  Number of time steps to update the evapotranspiration data
+C             * Enter any number if time-tracking option is on
+C   NFQET ;  Repetition frequency of the evapotranspiration data 
+C             * Enter 0 if full time series data is supplied
+C             * Enter any number if time-tracking option is on
+C   DSSFL ;  The name of the DSS file for data input (maximum 50 characters); 
+C             * Leave blank if DSS file is not used for data input
+C 
+C-------------------------------------------------------------------------------
+C         VALUE                                      DESCRIPTION
+C-------------------------------------------------------------------------------
+          {0:<43}/ NCOLET 
+          {1:<43.5}/ FACTET  (in/{4} -> ft/{4})         
+          {2:<43}/ NSPET
+          {3:<43}/ NFQET
+                                                     / DSSFL"""
+    return string.format(NCOLET, FACTET, NSPET, NFQET, timeUnit)
+
+def EvapotranspirationData(NCOLET):
+    string = """
+C-------------------------------------------------------------------------------
+C                          Evapotranspiration Data 
+C                         (READ FROM THIS FILE)
+C
+C   List the evapotranspiration rates for each column below, if it will 
+C   not be read from a DSS file (i.e. DSSFL is left blank above).
+C
+C   ITET ;   Time 
+C   ARET ;   Evapotranspiration rate at the corresponding column; [L/T]
+C
+C-------------------------------------------------------------------------------     
+C   ITET           ARET(1)   ARET(2)   ARET(3) ...
+C   TIME        {}
+C-------------------------------------------------------------------------------
+"""
+    return string.format('{:>10}'*NCOLET).format(*[i+1 for i in range(NCOLET)])
+
+def TemperatureHeader(fileName):
+    return IWFMHeader("TEMPERATURE DATA FILE", fileName,
+                      ["This data file contains the time-series mean air temperature at each",
+                       "temperature column."])
+
+def TemperatureSpecs(NCOLT, FACTT, NSPT, NFQT, timeUnit='month'):
+    string = """
+C*******************************************************************************
+C                         Temperature Data Specifications
+C
+C   NCOLT ;  Number of temperature columns (or pathnames if DSS files are used)
+C             used in the model 
+C   FACTT ;  Conversion factor for temperature
+C   NSPT  ;  Number of time steps to update the temperature data
+C             * Enter any number if time-tracking option is on
+C   NFQT  ;  Repetition frequency of the temperature data 
+C             * Enter 0 if full time series data is supplied
+C             * Enter any number if time-tracking option is on
+C   DSSFL ;  The name of the DSS file for data input (maximum 50 characters); 
+C             * Leave blank if DSS file is not used for data input
+C 
+C-------------------------------------------------------------------------------
+C         VALUE                                      DESCRIPTION
+C-------------------------------------------------------------------------------
+          {0:<43}/ NCOLT 
+          {1:<43.5}/ FACTT   (mean over each {4})         
+          {2:<43}/ NSPT
+          {3:<43}/ NFQT
+                                                     / DSSFL"""
+    return string.format(NCOLT, FACTT, NSPT, NFQT, timeUnit)
+
+def TemperatureData(NCOLT):
+    string = """
+C-------------------------------------------------------------------------------
+C                              Temperature Data 
+C                         (READ FROM THIS FILE)
+C
+C   List the mean temperature for each column below, if it will 
+C   not be read from a DSS file (i.e. DSSFL is left blank above).
+C
+C   ITT  ;   Time 
+C   ATEMP;   Mean temperature at the corresponding column
+C
+C-------------------------------------------------------------------------------     
+C   ITT           ATEMP(1)  ATEMP(2)  ATEMP(3) ...
+C   TIME        {}
+C-------------------------------------------------------------------------------
+"""
+    return string.format('{:>10}'*NCOLT).format(*[i+1 for i in range(NCOLT)])
+
+# templates of the IWFM data file written for each variable, and how daily
+# values of the variable are combined into a month
+IWFMVariable = namedtuple('IWFMVariable', ['header', 'specs', 'data', 'aggregation'])
+iwfmVariables = {'ppt': IWFMVariable(PrecipHeader, PrecipSpecs, PrecipData, 'sum'),
+                 'et': IWFMVariable(EvapotranspirationHeader, EvapotranspirationSpecs, EvapotranspirationData, 'sum'),
+                 'tmean': IWFMVariable(TemperatureHeader, TemperatureSpecs, TemperatureData, 'mean')}
+
+# settings of a job run from the command line and their defaults. settings
+# without a default are required. e.g. a job.toml of
+#
+#   inWorkspace = ['D:/ppt/2015', 'D:/ppt/2016']
+#   aoiFeature = 'D:/C2VSimFG/C2VSimFG_Elements_GCS.shp'
+#   aoiIDField = 'ModelID'
+#   outWorkspace = 'D:/C2VSimFG/PRISMPrecip'
+#   outFileName = 'C2VSimFG_Precip.dat'
+#   memoryBudgetGB = 32
+#
+# is checked with 'python PrecipProcessingTools.py plan job.toml' and processed
+# with 'python PrecipProcessingTools.py run job.toml'
+jobDefaults = {'inWorkspace': None,
+               'aoiFeature': None,
+               'aoiIDField': None,
+               'outWorkspace': None,
+               'outFileName': None,
+               'inUnits': 'millimeters',
+               'outUnits': 'inches',
+               'method': 'weights',
+               'blockSize': 120,
+               'appendToExisting': False,
+               'outTimeStep': None,
+               'allowGaps': False,
+               'numTiles': 1,
+               'numWorkers': None,
+               'backend': None,
+               'memoryBudgetGB': None,
+               'diskBudgetGB': None,
+               'scratchWorkspace': None,
+               'keepIntermediates': False,
+               'rasterListFileName': None,
+               'storeDir': None,
+               'reportFileName': 'RunReport.json',
+               'benchmarkFile': None}
+jobRequired = ['inWorkspace', 'aoiFeature', 'aoiIDField', 'outWorkspace', 'outFileName']
+jobMethods = ('weights', 'intersect')
 
-    # store time processing begins
-    startTime = time.time()
-
-    ##############################################################
-    # Define explicit variables
-    ##############################################################
-    # rasterList is for testing purposes only
-    rasterList = [r'D:\ppt\2015\prism_ppt_us_30s_201509.bil', r'D:\ppt\2015\prism_ppt_us_30s_201510.bil', r'D:\ppt\2015\prism_ppt_us_30s_201511.bil', r'D:\ppt\2015\prism_ppt_us_30s_201512.bil']
-    ##############################################################
-    # inWorkspace could be a geodatabase, folder, list of folders, or a text file
-    inWorkspace = r'F:\Tyler\DWR\SGMP\Modeling\C2VSimFG\PRISMPrecip\RastersToProcess.txt'
-    writeToFileFlag = False
-    outRasterListFileName = 'RastersToProcess.txt'
-    writeToFileOnly = False
-    inUnits = 'millimeters'
-    outUnits = 'inches'
-    aoiFeature = r'F:\Tyler\DWR\SGMP\Modeling\C2VSimFG\PRISMPrecip\C2VSimFG_Elements_SmallWatersheds_GCS.shp'
-    aoiIDField = 'ModelID'
-    outWorkspace = r'F:\Tyler\DWR\SGMP\Modeling\C2VSimFG\PRISMPrecip'
-    outFileName = 'C2VSimFG_Precip.dat'
-    mode = 'process'
-    ##############################################################
-    # Define derived variables
-    ##############################################################
-    if mode == 'test':
-        inRastersList = rasterList
+def ReadJobConfig(configFile):
+    ''' reads the settings of a job from a TOML, YAML or JSON file and fills in
+        the defaults of jobDefaults. inWorkspace may be one folder, geodatabase
+        or text file of rasters, or a list of them '''
+    configExt = os.path.splitext(configFile)[1].lower()
+    if configExt == '.toml':
+        if tomllib is None:
+            raise ValueError("tomllib (python 3.11) or tomli is required to read {0}".format(configFile))
+        with open(configFile, 'rb') as f:
+            settings = tomllib.load(f)
+    elif configExt in ('.yaml', '.yml'):
+        if yaml is None:
+            raise ValueError("pyyaml is required to read {0}".format(configFile))
+        with open(configFile, 'r') as f:
+            settings = yaml.safe_load(f) or {}
+    elif configExt == '.json':
+        with open(configFile, 'r') as f:
+            settings = json.load(f)
     else:
-        # Generate a list of rasters from inWorkspace
-        inRastersList = []
-        for wkspace in [inWorkspace]:
-            print(wkspace)
-            if IsGeodatabase(wkspace):
-                if inRastersList == None:
-                    inRastersList = GetAllRastersFromGeodatabase(wkspace)
-                else:
-                    inRastersList.extend(GetAllRastersFromGeodatabase(wkspace))
-            elif IsFolder(inWorkspace):
-                if inRastersList == None:
-                    inRastersList = GetAllRastersFromFolders(wkspace)
-                else:
-                    inRastersList.extend(GetAllRastersFromFolders(wkspace))
-            elif IsTextFile(inWorkspace):
-                if inRastersList == None:
-                    inRastersList = GetAllRastersFromFile(wkspace)
-                else:
-                    inRastersList.extend(GetAllRastersFromFile(wkspace))
-            else:
-                print('format of inWorkspace was not compatible. Must contain one or more folders, geodatabases, or text files')
-                sys.exit(1)
-
-    # Determine the length of the list of rasters
-    lenRasterList = len(inRastersList)
-
-    # Check to see that there is at least one raster to process
-    if lenRasterList <= 0:
-        print('There are no rasters to process in the locations provided.')
-        sys.exit(0)
-            
-    print('There are {0} rasters to process.'.format(lenRasterList))
-    
-    if writeToFileFlag:
-        if writeToFileOnly:
-            print("Writing rasters to {0} only.".format(os.path.join(outWorkspace, outRasterListFileName)))
-            WriteRastersToFile(inRastersList, outWorkspace, outRasterListFileName)
+        raise ValueError("job configuration must be a .toml, .yaml or .json file, not {0}".format(configFile))
+
+    unknown = sorted(set(settings) - set(jobDefaults))
+    if len(unknown) > 0:
+        raise ValueError("unknown setting(s) in {0}: {1}".format(configFile, unknown))
+    missing = [name for name in jobRequired if settings.get(name) is None]
+    if len(missing) > 0:
+        raise ValueError("{0} is missing the required setting(s) {1}".format(configFile, missing))
+
+    config = dict(jobDefaults)
+    config.update(settings)
+    if isinstance(config['inWorkspace'], str):
+        config['inWorkspace'] = [config['inWorkspace']]
+    if config['method'] not in jobMethods:
+        raise ValueError("method must be one of {0}, not {1}".format(jobMethods, config['method']))
+    if config['appendToExisting'] and config['method'] != 'weights':
+        raise ValueError("appendToExisting requires the 'weights' method")
+    for unitName in ('inUnits', 'outUnits'):
+        UnitConversion(config[unitName], config[unitName])
+
+    return config
+
+def GetJobRasters(config):
+    ''' returns the rasters of all of the workspaces of a job '''
+    inRastersList = []
+    for wkspace in config['inWorkspace']:
+        dataType = DescribeWorkspace(wkspace)
+        if dataType == "Folder":
+            # the catalog in the output workspace only lists subfolders changed since the last run
+            catalogFile = os.path.join(config['outWorkspace'], 'RasterCatalog.json')
+            inRastersList.extend(ScanRasterCatalog(wkspace, catalogFile)['FileNames'].tolist())
         else:
-            print("Writing rasters to {0}.".format(os.path.join(outWorkspace, outRasterListFileName)))
-            WriteRastersToFile(inRastersList, outWorkspace, outRasterListFileName)
-            
-            # Count number of polygons in aoi feature class
-            featureCount = int(arcpy.GetCount_management(aoiFeature)[0])
-
-            # Make a directory called Clipped to hold the clipped rasters for later processing
-            clippedDir = MakeDirectory(outWorkspace, "Clipped")
-
-            # Make a directory called Points to hold the point features for later processing
-            pointsDir = MakeDirectory(outWorkspace, "Points")
-
-            # Make a directory called Fishnet to hold the fishnet line features for later processing
-            fishnetDir = MakeDirectory(outWorkspace, "Fishnet")
-
-            # Make a directory called Polygons to hold the polygon features for later processing
-            polygonDir = MakeDirectory(outWorkspace, "Polygon")
-
-            # Make a directory called Polygons to hold the polygon features for later processing
-            intersectDir = MakeDirectory(outWorkspace, "Intersect")
-
-            #################################################################
-            # multiprocessing
-            #################################################################
-
-            print("Clipping Rasters")
-
-            # zip input data for Clip function into a tuple of tuples for each raster being processed
-            aoiFeatureList = [aoiFeature for i in range(lenRasterList)]
-            clippedDirList = [clippedDir for i in range(lenRasterList)]
-            inClipRasterData = tuple(zip(inRastersList, aoiFeatureList, clippedDirList))
-
-            # clip rasters using multiprocessing
-            clipRasterList = MultiProcess(ClipRasterMulti, inClipRasterData)
-
-            print("Converting Clipped Rasters to Points")
-            
-            # zip input data for Raster to Points function into a tuple of tuples for each raster being processed
-            pointsDirList = [pointsDir for i in range(len(clipRasterList))]    
-            inRasterToPointsData = tuple(zip(clipRasterList, pointsDirList))
-
-            # convert rasters to points using multiprocessing
-            pointFeatureList = MultiProcess(ConvertRasterToPointsMulti, inRasterToPointsData)
-
-            print("Creating Fishnets for Rasters")
-
-            # zip input data for fishnet conversion into a tuple of tuples for each raster being processed
-            fishnetDirList = [fishnetDir for i in range(len(clipRasterList))]
-            inFishnetData = tuple(zip(clipRasterList, fishnetDirList))
-
-            # create fishnet using multiprocessing
-            fishnetList = MultiProcess(CreateFishnetFeatureMulti, inFishnetData)
-
-            print("Converting Fishnets to Polygon Features")
-            
-            # zip input data for fishnet to polygon into a tuple of tuples for each fishnet being converted to a polygon  
-            polygonDirList = [polygonDir for i in range(len(fishnetList))]
-            inFishnetToPolygonData = tuple(zip(sorted(fishnetList), sorted(pointFeatureList), polygonDirList))
-
-            # convert fishnets to polygons using multiprocessing
-            polygonFeatures = MultiProcess(ConvertFishnetToPolygonMulti, inFishnetToPolygonData)
-
-            print("Intersecting AOI with Vectorized Raster Polygons")
-            
-            # zip input data for intersecting vectorized rasters and the area of interest polygon feature class
-            intersectDirList = [intersectDir for i in range(len(polygonFeatures))]
-            intersectData = tuple(zip(aoiFeatureList, polygonFeatures, intersectDirList))
-
-            # intersect features using multiprocessing
-            intersectFeatureList = MultiProcess(IntersectFeaturesMulti, intersectData)
-
-            #################################################################
-            # single processing
-            #################################################################
-            
-            # prepare features for writing to file
-            outputFeatures = OrderFilesByDate(intersectFeatureList)
-
-            # Create output file
-            outFile = os.path.join(outWorkspace, outFileName)
-
-            # Write output file    
-            with open(outFile, 'w') as f:
-                f.write(PrecipHeader())
-                f.write(PrecipSpecs(featureCount, FACTRN(outUnits), 1, 0))
-                f.write(PrecipData(featureCount))
-                for dt in outputFeatures['TextDate'].to_list():
-                    # get name of feature class
-                    fc = outputFeatures[outputFeatures['TextDate'] == dt]['FileNames'].to_numpy()[0]
-
-                    # convert feature class table to array for processing
-                    values = AreaWeightValuesFromFeatureClass(fc, inUnits, outUnits, aoiIDField, 'grid_code', 'SHAPE@AREA')
-                    
-                    if len(values) == featureCount:
-                        f.write(dt)
-                        f.write(('{:>10.3}'*len(values)).format(*values))
-                        f.write('\n')
-                    else:
-                        raise arcpy.ExecuteError
-    else:
-        # Count number of polygons in aoi feature class
-        featureCount = int(arcpy.GetCount_management(aoiFeature)[0])
+            inRastersList.extend(ListWorkspaceRasters(wkspace, dataType))
 
-        # Make a directory called Clipped to hold the clipped rasters for later processing
-        clippedDir = MakeDirectory(outWorkspace, "Clipped")
+    return inRastersList
 
-        # Make a directory called Points to hold the point features for later processing
-        pointsDir = MakeDirectory(outWorkspace, "Points")
+def GetWindowBytes(gridHeader, window):
+    ''' returns the bytes of one band of a raster read for a window of pixels '''
+    rowStart, rowEnd, colStart, colEnd = window
+    return (rowEnd - rowStart)*(colEnd - colStart)*gridHeader.dtype.itemsize
 
-        # Make a directory called Fishnet to hold the fishnet line features for later processing
-        fishnetDir = MakeDirectory(outWorkspace, "Fishnet")
+def FindDateGaps(dates, timeStep):
+    ''' returns the dates of a series that have more than one raster and the
+        (start, end) of each run of days or months without a raster '''
+    periods = pd.DatetimeIndex(dates).to_period('D' if timeStep == 'daily' else 'M')
+    duplicated = sorted(set([str(period) for period in periods[periods.duplicated()]]))
+    uniquePeriods = periods.unique().sort_values()
+    periodSteps = np.diff(uniquePeriods.asi8)
+    gaps = [(str(start + 1), str(end - 1)) for start, end in zip(uniquePeriods[:-1][periodSteps > 1], uniquePeriods[1:][periodSteps > 1])]
 
-        # Make a directory called Polygons to hold the polygon features for later processing
-        polygonDir = MakeDirectory(outWorkspace, "Polygon")
+    return duplicated, gaps
 
-        # Make a directory called Polygons to hold the polygon features for later processing
-        intersectDir = MakeDirectory(outWorkspace, "Intersect")
+def FindRasterDateGaps(orderedRasters):
+    ''' returns the time steps of rasters ordered with OrderFilesByDate, the
+        dates with more than one raster and the gaps without rasters as text '''
+    timeSteps = []
+    duplicated = []
+    gaps = []
+    for timeStep, stepRasters in orderedRasters.groupby('TimeStep', sort=False):
+        stepDuplicated, stepGaps = FindDateGaps(stepRasters['Date'], timeStep)
+        timeSteps.append(timeStep)
+        duplicated.extend(stepDuplicated)
+        gaps.extend(["{0} to {1}".format(start, end) if start != end else start for start, end in stepGaps])
 
-        #################################################################
-        # multiprocessing
-        #################################################################
+    return timeSteps, duplicated, gaps
 
-        print("Clipping Rasters")
+def EstimateJobRuntime(benchmarkFile, plan):
+    ''' estimates the seconds each stage of a job takes from the throughput
+        measured by PrecipBenchmark.py for the case with the nearest number
+        of elements, or returns None if the benchmark has no such case
 
-        # zip input data for Clip function into a tuple of tuples for each raster being processed
-        aoiFeatureList = [aoiFeature for i in range(lenRasterList)]
-        clippedDirList = [clippedDir for i in range(lenRasterList)]
-        inClipRasterData = tuple(zip(inRastersList, aoiFeatureList, clippedDirList))
+    Area weighting is estimated from the bytes read per second, writing from
+    the values written per second and the weights from the time taken per
+    element, assuming the weights are not cached yet.
+    '''
+    with open(benchmarkFile, 'r') as f:
+        benchmark = json.load(f)
 
-        # clip rasters using multiprocessing
-        clipRasterList = MultiProcess(ClipRasterMulti, inClipRasterData)
+    cases = [case for case in benchmark['cases'].values() if case.get('bytesPerRaster')]
+    if len(cases) == 0 or plan['featureCount'] is None:
+        return None
+    case = min(cases, key=lambda case: abs(np.log(case['elements']) - np.log(max(plan['featureCount'], 1))))
+    stages = case['stages']
 
-        print("Converting Clipped Rasters to Points")
-        
-        # zip input data for Raster to Points function into a tuple of tuples for each raster being processed
-        pointsDirList = [pointsDir for i in range(len(clipRasterList))]    
-        inRasterToPointsData = tuple(zip(clipRasterList, pointsDirList))
+    readRate = case['months']*case['bytesPerRaster']/stages['areaWeighting']['wall']
+    writeRate = case['months']*case['elements']/stages['writing']['wall']
+    weightsRate = case['elements']/stages['weights']['wall']
 
-        # convert rasters to points using multiprocessing
-        pointFeatureList = MultiProcess(ConvertRasterToPointsMulti, inRasterToPointsData)
+    estimate = {'weights': len(plan['grids'])*plan['featureCount']/weightsRate,
+                'areaWeighting': plan['bytesToRead']/readRate,
+                'writing': plan['numRows']*plan['featureCount']/writeRate}
+    estimate['total'] = sum(estimate.values())
+    estimate['benchmarkCase'] = "{0}_{1}".format(case['resolution'], case['elements'])
 
-        print("Creating Fishnets for Rasters")
+    return estimate
 
-        # zip input data for fishnet conversion into a tuple of tuples for each raster being processed
-        fishnetDirList = [fishnetDir for i in range(len(clipRasterList))]
-        inFishnetData = tuple(zip(clipRasterList, fishnetDirList))
+def PlanJob(config):
+    ''' returns the plan of a job without processing any rasters: the rasters, their
+        dates, gaps and grids, the bytes read and, with a benchmark, the runtime '''
+    inRastersList = GetJobRasters(config)
+    plan = {'rasterCount': len(inRastersList), 'method': config['method'], 'firstDate': None, 'lastDate': None,
+            'timeSteps': [], 'duplicateDates': [], 'gaps': [], 'grids': [], 'aoiExtent': None, 'featureCount': None,
+            'numRows': 0, 'bytesToRead': 0, 'runtime': None}
+    if len(inRastersList) == 0:
+        return plan
 
-        # create fishnet using multiprocessing
-        fishnetList = MultiProcess(CreateFishnetFeatureMulti, inFishnetData)
+    orderedRasters = OrderFilesByDate(inRastersList)
+    plan['firstDate'] = orderedRasters['Date'].iloc[0].strftime('%Y-%m-%d')
+    plan['lastDate'] = orderedRasters['Date'].iloc[-1].strftime('%Y-%m-%d')
+    plan['timeSteps'], plan['duplicateDates'], plan['gaps'] = FindRasterDateGaps(orderedRasters)
 
-        print("Converting Fishnets to Polygon Features")
-        
-        # zip input data for fishnet to polygon into a tuple of tuples for each fishnet being converted to a polygon  
-        polygonDirList = [polygonDir for i in range(len(fishnetList))]
-        inFishnetToPolygonData = tuple(zip(sorted(fishnetList), sorted(pointFeatureList), polygonDirList))
+    # daily rasters summed into months are written as one row per month
+    rasterDates = pd.DatetimeIndex(orderedRasters['Date'])
+    dailyRows = (orderedRasters['TimeStep'].values == 'daily') & (config['outTimeStep'] != 'monthly')
+    plan['numRows'] = len(np.unique(np.where(dailyRows, rasterDates.strftime('%Y-%m-%d'), rasterDates.strftime('%Y-%m'))))
 
-        # convert fishnets to polygons using multiprocessing
-        polygonFeatures = MultiProcess(ConvertFishnetToPolygonMulti, inFishnetToPolygonData)
+    aoiExtent = GetFeatureExtent(config['aoiFeature'])
+    plan['aoiExtent'] = [float(value) for value in aoiExtent]
+    plan['featureCount'] = GetFeatureCount(config['aoiFeature'])
 
-        print("Intersecting AOI with Vectorized Raster Polygons")
-        
-        # zip input data for intersecting vectorized rasters and the area of interest polygon feature class
-        intersectDirList = [intersectDir for i in range(len(polygonFeatures))]
-        intersectData = tuple(zip(aoiFeatureList, polygonFeatures, intersectDirList))
-
-        # intersect features using multiprocessing
-        intersectFeatureList = MultiProcess(IntersectFeaturesMulti, intersectData)
-
-        #################################################################
-        # single processing
-        #################################################################
-
-        # prepare features for writing to file
-        outputFeatures = OrderFilesByDate(intersectFeatureList)
-
-        # Create output file
-        outFile = os.path.join(outWorkspace, outFileName)
-
-        # Write output file    
-        with open(outFile, 'w') as f:
-            f.write(PrecipHeader())
-            f.write(PrecipSpecs(featureCount, FACTRN(outUnits), 1, 0))
-            f.write(PrecipData(featureCount))
-            for dt in outputFeatures['TextDate'].to_list():
-                # get name of feature class
-                fc = outputFeatures[outputFeatures['TextDate'] == dt]['FileNames'].to_numpy()[0]
-
-                # convert feature class table to array for processing
-                values = AreaWeightValuesFromFeatureClass(fc, inUnits, outUnits, aoiIDField, 'grid_code', 'SHAPE@AREA')
-                    
-                if len(values) == featureCount:
-                    f.write(dt)
-                    f.write(('{:>10.3}'*len(values)).format(*values))
-                    f.write('\n')
-                else:
-                    raise arcpy.ExecuteError
+    grids = {}
+    for raster in orderedRasters['FileNames']:
+        if IsNativeRaster(raster):
+            header = ReadBilHeader(raster)
+            grid = GetGridDefinition(header)
+            if grid not in grids:
+                window = GetPixelWindow(header, aoiExtent)
+                grids[grid] = {'numRows': header.numRows, 'numCols': header.numCols,
+                               'cellSize': header.cellSizeX, 'rasterCount': 0,
+                               'window': list(window),
+                               'windowBytes': GetWindowBytes(header, window)}
+            gridPlan = grids[grid]
+            # the geoprocessing intersect reads the whole raster
+            rasterBytes = gridPlan['windowBytes'] if config['method'] == 'weights' else GetDatasetBytes(raster)
+        else:
+            rasterName, numRows, numCols, xMin, yMin, xMax, yMax = GetPropertiesFromRaster(raster)
+            grid = (numRows, numCols, xMin, yMax)
+            if grid not in grids:
+                grids[grid] = {'numRows': numRows, 'numCols': numCols, 'cellSize': (xMax - xMin)/numCols,
+                               'rasterCount': 0, 'window': None, 'windowBytes': None}
+            gridPlan = grids[grid]
+            rasterBytes = GetDatasetBytes(raster)
+        gridPlan['rasterCount'] += 1
+        plan['bytesToRead'] += rasterBytes
+    plan['grids'] = list(grids.values())
+
+    benchmarkFile = config['benchmarkFile']
+    if benchmarkFile is None:
+        benchmarkFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PrecipBenchmarkBaseline.json')
+        if not os.path.exists(benchmarkFile):
+            benchmarkFile = None
+    if benchmarkFile is not None and config['method'] == 'weights':
+        plan['runtime'] = EstimateJobRuntime(benchmarkFile, plan)
+
+    return plan
 
+def FormatJobPlan(plan):
+    ''' returns the lines of a plan made with PlanJob as text '''
+    lines = ["Method:           {0}".format(plan['method']),
+             "Rasters:          {0}".format(plan['rasterCount'])]
+    if plan['rasterCount'] == 0:
+        return "\n".join(lines)
+
+    lines.append("Dates:            {0} to {1} ({2}), {3} rows".format(plan['firstDate'], plan['lastDate'],
+                                                                   ", ".join(plan['timeSteps']), plan['numRows']))
+    lines.append("Gaps:             {0}{1}".format(len(plan['gaps']), ": " + ", ".join(plan['gaps'][:10]) if plan['gaps'] else ""))
+    if plan['duplicateDates']:
+        lines.append("Duplicate dates:  {0}: {1}".format(len(plan['duplicateDates']), ", ".join(plan['duplicateDates'][:10])))
+    lines.append("Area of interest: {0} features, extent {1}".format(plan['featureCount'],
+                                                                    ", ".join(["{0:.4f}".format(value) for value in plan['aoiExtent']])))
+    for gridPlan in plan['grids']:
+        if gridPlan['window'] is not None:
+            rowStart, rowEnd, colStart, colEnd = gridPlan['window']
+            windowText = "window {0} x {1} ({2:.1f} MB)".format(rowEnd - rowStart, colEnd - colStart, gridPlan['windowBytes']/1e6)
+        else:
+            windowText = "window not known without a .hdr file"
+        lines.append("Grid:             {0} x {1}, cell size {2:.6g}, {3} rasters, {4}".format(
+            gridPlan['numRows'], gridPlan['numCols'], gridPlan['cellSize'], gridPlan['rasterCount'], windowText))
+    lines.append("Bytes to read:    {0:.1f} MB".format(plan['bytesToRead']/1e6))
+
+    runtime = plan['runtime']
+    if runtime is None:
+        lines.append("Runtime:          no benchmark to estimate it from")
+    else:
+        lines.append("Runtime:          about {0} ({1} weights, {2} area weighting, {3} writing, from benchmark {4})".format(
+            FormatDuration(runtime['total']), FormatDuration(runtime['weights']), FormatDuration(runtime['areaWeighting']),
+            FormatDuration(runtime['writing']), runtime['benchmarkCase']))
 
-    print("Processing Complete!")
+    return "\n".join(lines)
 
-    # store time processing ends
-    endTime = time.time()
+def RunJob(config, report=None):
+    ''' processes the rasters of a job into an IWFM precipitation file and
+        returns the path of the file written, or None if there were no rasters.
+        the gaps and duplicate dates found by PlanJob fail the job, unless
+        allowGaps is set, which only allows the gaps '''
+    if report is None:
+        report = RunReport()
+    if config['backend'] is not None:
+        SetBackend(config['backend'])
 
-    print("The program took {0}".format(endTime - startTime))
+    outWorkspace = config['outWorkspace']
+    outFile = os.path.join(outWorkspace, config['outFileName'])
+    memoryBudget = config['memoryBudgetGB']*1e9 if config['memoryBudgetGB'] else None
+    diskBudget = config['diskBudgetGB']*1e9 if config['diskBudgetGB'] else None
+
+    with report.Stage('discovery'):
+        inRastersList = GetJobRasters(config)
+    if len(inRastersList) == 0:
+        print("There are no rasters to process in the locations provided.")
+        return None
+    print("There are {0} rasters to process.".format(len(inRastersList)))
+
+    timeSteps, duplicated, gaps = FindRasterDateGaps(OrderFilesByDate(inRastersList))
+    if len(duplicated) > 0:
+        raise ValueError("{0} date(s) have more than one raster: {1}".format(len(duplicated), duplicated[:10]))
+    if len(gaps) > 0:
+        message = "{0} gap(s) in the dates of the rasters: {1}".format(len(gaps), gaps[:10])
+        if not config['allowGaps']:
+            raise ValueError(message + ". set allowGaps to process them anyway")
+        report.Warn(message)
+
+    if config['rasterListFileName'] is not None:
+        print("Writing rasters to {0}.".format(os.path.join(outWorkspace, config['rasterListFileName'])))
+        WriteRastersToFile(inRastersList, outWorkspace, config['rasterListFileName'])
+
+    # area weights can only be applied directly to BIL rasters with a header file
+    method = config['method']
+    if method == 'weights' and not all([IsNativeRaster(raster) for raster in inRastersList]):
+        if config['appendToExisting']:
+            raise ValueError("appending to an existing output file requires BIL rasters with .hdr files")
+        print("Area weights require BIL rasters with .hdr files. Using the geoprocessing intersect.")
+        method = 'intersect'
+
+    if method == 'weights':
+        # Make a directory called Weights to cache the area weights between runs
+        weightsDir = MakeDirectory(outWorkspace, "Weights")
+        if config['appendToExisting'] and os.path.exists(outFile):
+            UpdatePrecipFileFromRasters(inRastersList, config['aoiFeature'], config['aoiIDField'], config['inUnits'], config['outUnits'],
+                                        outFile, config['blockSize'], weightsDir, report, config['numTiles'], config['outTimeStep'],
+                                        memoryBudget, config['allowGaps'])
+        else:
+            WritePrecipFileFromRasters(inRastersList, config['aoiFeature'], config['aoiIDField'], config['inUnits'], config['outUnits'],
+                                       outFile, config['blockSize'], weightsDir, report, config['numTiles'], config['outTimeStep'],
+                                       config['storeDir'], memoryBudget, config['allowGaps'])
+    else:
+        print("Clipping, Vectorizing and Intersecting Rasters with {0}.".format(config['aoiFeature']))
+        WritePrecipFileFromIntersect(inRastersList, config['aoiFeature'], config['aoiIDField'], config['inUnits'], config['outUnits'],
+                                     outWorkspace, outFile, config['numWorkers'], report, config['scratchWorkspace'],
+                                     config['keepIntermediates'], diskBudget, memoryBudget)
+
+    return outFile
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="process rasters into an IWFM precipitation file from a job configuration file")
+    subparsers = parser.add_subparsers(dest='command')
+
+    runParser = subparsers.add_parser('run', help="process the rasters of a job")
+    runParser.add_argument('config', help="TOML, YAML or JSON job configuration file")
+
+    planParser = subparsers.add_parser('plan', help="report the work of a job without processing it")
+    planParser.add_argument('config', help="TOML, YAML or JSON job configuration file")
+    planParser.add_argument('--output', help="also write the plan to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        config = ReadJobConfig(args.config)
+
+        # time each stage of the run and write a report to the output workspace
+        report = RunReport(os.path.join(config['outWorkspace'], config['reportFileName']))
+        outFile = RunJob(config, report)
+
+        # stop the worker processes shared by the parallel steps
+        CloseProcessPool()
+
+        if outFile is not None:
+            print("Processing Complete! Wrote {0}".format(outFile))
+
+        # summarize the time, CPU use and data read and written by each stage
+        print(report.Summary())
+        print("Run report written to {0}".format(report.Write()))
+
+    elif args.command == 'plan':
+        plan = PlanJob(ReadJobConfig(args.config))
+        print(FormatJobPlan(plan))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(plan, f, indent=2)
+
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,72 @@
+''' processes a raster series in shards of consecutive months that can run on
+    several machines sharing a file system, and merges the shards into one IWFM
+    precipitation file
+
+usage:
+    python PrecipShards.py process --shard 0 --shards 4 --rasters rasterlist.txt --aoi mesh.shp --id-field ElementID
+                                   --in-units millimeters --out-units inches --output-dir shards
+    python PrecipShards.py merge --shards 4 --output-dir shards --output C2VSimFG_Input.dat
+'''
+import os, sys, glob, argparse
+
+from PrecipProcessingTools import (GetAllRastersFromFile, GetAllRastersFromFolders, MakeDirectory, RunReport,
+                                   ProcessPrecipShard, MergePrecipShards)
+
+unitChoices = ['feet', 'inches', 'meters', 'millimeters']
+
+def ShardFileName(outputDir, shardIndex, numShards):
+    ''' returns the path of the file of a shard '''
+    return os.path.join(outputDir, 'shard_{0:04d}_of_{1:04d}.npz'.format(shardIndex, numShards))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="process rasters in shards and merge them into an IWFM precipitation file")
+    subparsers = parser.add_subparsers(dest='command')
+
+    processParser = subparsers.add_parser('process', help="area weight the rasters of one shard")
+    processParser.add_argument('--shard', type=int, required=True, help="index of the shard to process, from 0")
+    processParser.add_argument('--shards', type=int, required=True, help="number of shards the rasters are split into")
+    processParser.add_argument('--rasters', required=True, help="text file listing the rasters, or a folder of rasters")
+    processParser.add_argument('--aoi', required=True, help="polygon feature class of the area of interest")
+    processParser.add_argument('--id-field', required=True, help="field identifying each polygon")
+    processParser.add_argument('--in-units', default='millimeters', choices=unitChoices)
+    processParser.add_argument('--out-units', default='inches', choices=unitChoices)
+    processParser.add_argument('--output-dir', required=True, help="shared folder of the shard files")
+    processParser.add_argument('--block-size', type=int, default=120, help="rasters area weighted in each matrix product")
+
+    mergeParser = subparsers.add_parser('merge', help="write the IWFM precipitation file from the shard files")
+    mergeParser.add_argument('--output-dir', required=True, help="shared folder of the shard files")
+    mergeParser.add_argument('--output', required=True, help="IWFM precipitation file to write")
+    mergeParser.add_argument('--shards', type=int, help="number of shards the rasters were split into. shard files "
+                                                          "of other runs in the folder are left out")
+    args = parser.parse_args()
+
+    if args.command == 'process':
+        if os.path.isdir(args.rasters):
+            inRastersList = GetAllRastersFromFolders(args.rasters)
+        else:
+            inRastersList = GetAllRastersFromFile(args.rasters)
+
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        weightsDir = MakeDirectory(args.output_dir, "Weights")
+
+        shardFile = ShardFileName(args.output_dir, args.shard, args.shards)
+        report = RunReport(os.path.splitext(shardFile)[0] + '_RunReport.json')
+        ProcessPrecipShard(inRastersList, args.shard, args.shards, args.aoi, args.id_field, args.in_units, args.out_units,
+                           shardFile, args.block_size, weightsDir, report)
+        print(report.Summary())
+        report.Write()
+
+    elif args.command == 'merge':
+        # temporary files of shards still being saved are left out. every
+        # shard of the run must be there, which MergePrecipShards checks
+        shardPattern = 'shard_*_of_{0:04d}.npz'.format(args.shards) if args.shards else 'shard_*_of_*.npz'
+        shardFiles = sorted([shardFile for shardFile in glob.glob(os.path.join(args.output_dir, shardPattern))
+                             if not shardFile.endswith('.tmp.npz')])
+        MergePrecipShards(shardFiles, args.output)
+        print("Merged {0} shards into {1}".format(len(shardFiles), args.output))
+
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,1000 @@
+''' tests of the native precipitation processing steps, run with
+
+    python -m pytest test_PrecipProcessingTools.py
+'''
+import os
+import json
+import types
+import math
+import time
+import threading
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+import PrecipProcessingTools
+from PrecipProcessingTools import (FormatPrecipValues, WriteBilRaster, ReadBilHeader, ReadBilRaster, ReadBilWindow,
+                                   GetPixelWindow, GetPixelWindowFromIndices, WritePolygonShapefile, CalculateAreaWeightMatrix,
+                                   AreaWeightValuesFromRaster, AreaWeightValuesFromRasters, UnitConversion,
+                                   GetAreaWeightMatrix, WritePrecipFile, ReadPrecipFile, ReadLastPrecipDate, ReadLastPrecipDates,
+                                   AppendToPrecipFile, WritePrecipFileFromRasters, UpdatePrecipFileFromRasters, ReadPrecipSpecs,
+                                   PipelineMap, MultiProcess, GetProcessPool, CloseProcessPool, StageReport, RasterizeZones,
+                                   ZonalStatisticsFromLabels, WritePrecipFileFromZonalStatistics, ScanRasterCatalog,
+                                   IntermediateFiles, IntersectRaster, GetStageManifest, RunStep, SavePrecipShard,
+                                   MergePrecipShards, OrderFilesByDate, GetOutputPeriods, RunReport, WriteIWFMFilesFromRasters,
+                                   ResultStoreWriter, ReadResultStore, ExportIWFMFileFromStore, MemoryBudget, ReadJobConfig,
+                                   PlanJob, FormatJobPlan, RunJob, WorkspaceScanCache)
+
+@pytest.fixture(autouse=True)
+def nativeBackend(monkeypatch):
+    ''' runs every test with the native backend whether or not arcpy is installed '''
+    monkeypatch.setenv('PRECIP_BACKEND', 'native')
+
+# FormatPrecipValues
+
+def test_FormatPrecipValuesMatchesPython():
+    edgeValues = [0.0, -0.0, 1.0, -1.0, 99.95, 99.949999, 999.5, 9.995, 0.0005, 0.00105, 1.005, 2.675,
+                  0.125, 0.1235, -1.235, 1e-5, 1.5e-7, 123456.0, 1e10, 5e-324, 1.7976931348623157e308,
+                  float('nan'), float('inf'), float('-inf')]
+    rng = np.random.default_rng(0)
+    # values rounded to a few decimals are often exactly on a rounding tie
+    randomValues = np.concatenate([np.round(rng.uniform(0.0, 50.0, 2000), 4),
+                                   rng.lognormal(0.0, 4.0, 2000),
+                                   -rng.uniform(0.0, 1.0, 500)])
+    values = np.concatenate([edgeValues, randomValues])
+
+    formatted = FormatPrecipValues(values)
+
+    assert formatted.shape == values.shape
+    assert [text.decode('ascii') for text in formatted] == ['{:>10.3}'.format(value) for value in values]
+
+def test_FormatPrecipValuesKeepsShape():
+    values = np.array([[0.0, 99.95], [1.005, 12.5]])
+    formatted = FormatPrecipValues(values)
+
+    assert formatted.shape == (2, 2)
+    assert formatted[0, 1].decode('ascii') == '{:>10.3}'.format(99.95) == '     1e+02'
+
+# BIL rasters
+
+def WriteBilFile(outRaster, bands, layout='BIL', byteOrder='I', pixelType='SIGNEDINT', numBits=16):
+    ''' writes a (bands x rows x columns) array as a raster of the given layout with
+        a minimal .hdr file and returns its path '''
+    bands = np.asarray(bands)
+    numBands, numRows, numCols = bands.shape
+    dtype = np.dtype('{0}{1}{2}'.format('>' if byteOrder == 'M' else '<', 'f' if pixelType == 'FLOAT' else 'i', numBits//8))
+    if layout == 'BSQ':
+        pixels = bands
+    elif layout == 'BIP':
+        pixels = bands.transpose(1, 2, 0)
+    else:
+        pixels = bands.transpose(1, 0, 2)
+    pixels.astype(dtype).tofile(outRaster)
+    with open(os.path.splitext(outRaster)[0] + '.hdr', 'w') as f:
+        f.write("BYTEORDER {0}\nLAYOUT {1}\nNROWS {2}\nNCOLS {3}\nNBANDS {4}\nNBITS {5}\nPIXELTYPE {6}\n"
+                "ULXMAP 10.5\nULYMAP 19.5\nXDIM 1\nYDIM 1\nNODATA -9999\n".format(byteOrder, layout, numRows, numCols, numBands,
+                                                                              numBits, pixelType))
+    return outRaster
+
+def test_ReadBilHeaderOfWrittenRaster(tmp_path):
+    rasterFile = WriteBilRaster(str(tmp_path / 'ppt_200001.bil'), np.zeros((3, 5)), -120.0, 40.0, 0.5, prjText='GEOGCS["test"]')
+    header = ReadBilHeader(rasterFile)
+
+    assert (header.numRows, header.numCols, header.numBands) == (3, 5, 1)
+    assert header.dtype == np.dtype('<f4')
+    assert (header.xMin, header.yMin, header.xMax, header.yMax) == (-120.0, 38.5, -117.5, 40.0)
+    assert (header.cellSizeX, header.cellSizeY, header.noData) == (0.5, 0.5, -9999.0)
+    assert header.spatialReference == 'GEOGCS["test"]'
+
+def test_ReadBilHeaderWorldFileOverridesHeader(tmp_path):
+    rasterFile = WriteBilRaster(str(tmp_path / 'ppt_200001.bil'), np.zeros((2, 2)), 0.0, 2.0, 1.0)
+    (tmp_path / 'ppt_200001.blw').write_text("0.25\n0\n0\n-0.25\n100.125\n50.875\n")
+    header = ReadBilHeader(rasterFile)
+
+    assert (header.xMin, header.yMax, header.xMax, header.yMin) == (100.0, 51.0, 100.5, 50.5)
+
+@pytest.mark.parametrize('layout', ['BIL', 'BSQ', 'BIP'])
+@pytest.mark.parametrize('byteOrder', ['I', 'M'])
+def test_ReadBilRasterLayouts(tmp_path, layout, byteOrder):
+    bands = np.arange(2*4*6).reshape(2, 4, 6) - 10
+    rasterFile = WriteBilFile(str(tmp_path / 'grid.bil'), bands, layout, byteOrder)
+    header = ReadBilHeader(rasterFile)
+
+    assert header.dtype == np.dtype('>i2' if byteOrder == 'M' else '<i2')
+    for band in (1, 2):
+        np.testing.assert_array_equal(ReadBilRaster(rasterFile, band), bands[band - 1])
+        # whole rows are read at once and partial rows one span at a time
+        for window in [(0, 4, 0, 6), (1, 3, 2, 5), (3, 4, 0, 1), (2, 2, 0, 6)]:
+            rowStart, rowEnd, colStart, colEnd = window
+            windowValues = ReadBilWindow(rasterFile, window, band, header)
+            np.testing.assert_array_equal(windowValues, bands[band - 1, rowStart:rowEnd, colStart:colEnd])
+            assert windowValues.dtype.isnative
+
+    with pytest.raises(ValueError, match="band 3"):
+        ReadBilRaster(rasterFile, 3)
+
+def test_GetPixelWindowIsClippedToTheRaster(tmp_path):
+    header = ReadBilHeader(WriteBilRaster(str(tmp_path / 'grid.bil'), np.zeros((10, 20)), 0.0, 10.0, 1.0))
+
+    assert GetPixelWindow(header, (2.5, 3.5, 5.0, 7.0)) == (3, 7, 2, 5)
+    assert GetPixelWindow(header, (-5.0, -5.0, 50.0, 50.0)) == (0, 10, 0, 20)
+    assert GetPixelWindow(header, (30.0, 0.0, 40.0, 5.0)) == (5, 10, 20, 20)
+    assert GetPixelWindowFromIndices(np.array([21, 43, 25]), 20) == (1, 3, 1, 6)
+
+# CalculateAreaWeightMatrix
+
+def Square(xMin, yMin, size):
+    ''' returns the clockwise ring of a square as the only ring of a polygon '''
+    return [np.array([[xMin, yMin], [xMin, yMin + size], [xMin + size, yMin + size], [xMin + size, yMin], [xMin, yMin]])]
+
+def WriteTestMesh(outShapefile):
+    ''' writes a mesh on the 4 x 4 grid of unit pixels from (0, 0) to (4, 4). element 1
+        covers one whole pixel, four half pixels and four quarter pixels and element 2
+        is split in two polygons covering four whole pixels '''
+    polygons = [Square(0.5, 0.5, 2.0),
+                [np.array([[2.0, 2.0], [2.0, 4.0], [3.0, 4.0], [3.0, 2.0], [2.0, 2.0]])],
+                [np.array([[3.0, 2.0], [3.0, 4.0], [4.0, 4.0], [4.0, 2.0], [3.0, 2.0]])]]
+    return WritePolygonShapefile(outShapefile, [1, 2, 2], polygons, 'ElementID')
+
+def test_AreaWeightRowsAreNormalized(tmp_path):
+    rasterFile = WriteBilRaster(str(tmp_path / 'grid_200001.bil'), np.ones((4, 4), dtype=np.float32), 0.0, 4.0, 1.0)
+    header = ReadBilHeader(rasterFile)
+
+    weights = CalculateAreaWeightMatrix(WriteTestMesh(str(tmp_path / 'mesh.shp')), 'ElementID', header)
+
+    assert weights.ids.tolist() == [1, 2]
+    np.testing.assert_allclose(np.asarray(weights.matrix.sum(axis=1)).ravel(), [1.0, 1.0])
+
+    firstRow = weights.matrix.getrow(0).data
+    secondRow = weights.matrix.getrow(1).data
+    np.testing.assert_allclose(sorted(firstRow[firstRow > 0]), [1.0/16]*4 + [1.0/8]*4 + [1.0/4])
+    np.testing.assert_allclose(secondRow[secondRow > 0], [0.25]*4)
+
+def test_AreaWeightValuesSkipNoData(tmp_path):
+    values = np.arange(16, dtype=np.float32).reshape(4, 4)
+    values[0, 2] = -9999
+    rasterFile = WriteBilRaster(str(tmp_path / 'grid_200001.bil'), values, 0.0, 4.0, 1.0)
+    weights = CalculateAreaWeightMatrix(WriteTestMesh(str(tmp_path / 'mesh.shp')), 'ElementID', ReadBilHeader(rasterFile))
+
+    # element 1 covers rows 1 to 3 and columns 0 to 2, with the center pixel counted fully
+    element1 = (values[1:4, 0:3]*np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]])/16.0).sum()
+    # the nodata pixel of element 2 is left out and the other three are weighted equally
+    element2 = (values[0, 3] + values[1, 2] + values[1, 3])/3.0
+    np.testing.assert_allclose(AreaWeightValuesFromRaster(rasterFile, weights, 'millimeters', 'millimeters'), [element1, element2])
+    scale, offset = UnitConversion('millimeters', 'inches')
+    np.testing.assert_allclose(AreaWeightValuesFromRaster(rasterFile, weights, 'millimeters', 'inches'),
+                               np.array([element1, element2])*scale + offset)
+
+def test_BlocksOfRastersMatchSingleRasters(tmp_path):
+    rng = np.random.default_rng(1)
+    rasterFiles = []
+    for i in range(5):
+        values = rng.uniform(0.0, 100.0, (4, 4)).astype(np.float32)
+        # the rasters of a block may use different nodata values
+        noData = -9999 if i % 2 == 0 else -1
+        values[i % 4, (i + 1) % 4] = noData
+        rasterFiles.append(WriteBilRaster(str(tmp_path / 'ppt_20000{0}.bil'.format(i + 1)), values, 0.0, 4.0, 1.0, noData))
+    weights = CalculateAreaWeightMatrix(WriteTestMesh(str(tmp_path / 'mesh.shp')), 'ElementID', ReadBilHeader(rasterFiles[0]))
+
+    blocks = list(AreaWeightValuesFromRasters(rasterFiles, weights, 'millimeters', 'inches', blockSize=2, numReaders=2))
+
+    assert [len(block) for block in blocks] == [2, 2, 1]
+    np.testing.assert_allclose(np.concatenate(blocks),
+                               [AreaWeightValuesFromRaster(rasterFile, weights, 'millimeters', 'inches') for rasterFile in rasterFiles])
+
+# GetAreaWeightMatrix
+
+def test_WeightCacheIsReusedUntilMeshOrGridChanges(tmp_path, monkeypatch):
+    calculated = []
+    calculateWeights = PrecipProcessingTools.CalculateAreaWeightMatrix
+    monkeypatch.setattr(PrecipProcessingTools, 'CalculateAreaWeightMatrix',
+                        lambda *args: calculated.append(args[2]) or calculateWeights(*args))
+    cacheDir = tmp_path / 'Weights'
+    cacheDir.mkdir()
+    meshFile = WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    header = ReadBilHeader(WriteBilRaster(str(tmp_path / 'grid.bil'), np.zeros((4, 4)), 0.0, 4.0, 1.0))
+
+    weights = GetAreaWeightMatrix(meshFile, 'ElementID', header, str(cacheDir))
+    cachedWeights = GetAreaWeightMatrix(meshFile, 'ElementID', header, str(cacheDir))
+
+    assert len(calculated) == 1 and len(os.listdir(str(cacheDir))) == 1
+    assert (cachedWeights.matrix != weights.matrix).nnz == 0
+    assert cachedWeights.ids.tolist() == weights.ids.tolist()
+    assert (cachedWeights.grid, cachedWeights.window) == (weights.grid, weights.window)
+
+    # moving an element or using another grid calculates and caches new weights
+    WritePolygonShapefile(meshFile, [1, 2], [Square(0.0, 0.0, 2.0), Square(2.0, 2.0, 2.0)], 'ElementID')
+    movedWeights = GetAreaWeightMatrix(meshFile, 'ElementID', header, str(cacheDir))
+    otherHeader = ReadBilHeader(WriteBilRaster(str(tmp_path / 'grid2.bil'), np.zeros((8, 8)), 0.0, 4.0, 0.5))
+    GetAreaWeightMatrix(meshFile, 'ElementID', otherHeader, str(cacheDir))
+
+    assert movedWeights.matrix.getrow(0).nnz == 4
+    assert len(calculated) == 3 and len(os.listdir(str(cacheDir))) == 3
+
+def test_WeightsOnlyReadTheWindowOfTheMesh(tmp_path):
+    values = np.arange(64, dtype=np.float32).reshape(8, 8)
+    rasterFile = WriteBilRaster(str(tmp_path / 'grid_200001.bil'), values, 0.0, 8.0, 1.0)
+    meshFile = WritePolygonShapefile(str(tmp_path / 'mesh.shp'), [7], [Square(1.0, 2.0, 2.0)], 'ElementID')
+    weights = CalculateAreaWeightMatrix(meshFile, 'ElementID', ReadBilHeader(rasterFile))
+
+    # rows count down from the top of the raster at y = 8
+    assert weights.window == (4, 6, 1, 3)
+    np.testing.assert_allclose(AreaWeightValuesFromRaster(rasterFile, weights, 'millimeters', 'millimeters'),
+                               [values[4:6, 1:3].mean()])
+
+# ReadLastPrecipDate, AppendToPrecipFile and UpdatePrecipFileFromRasters
+
+def MonthEnds(startMonth, numMonths):
+    ''' returns the IWFM dates of numMonths months from startMonth '''
+    months = pd.period_range(startMonth, periods=numMonths, freq='M')
+    return months.to_timestamp(how='end').strftime('%m/%d/%Y_24:00').tolist()
+
+def WriteMonthlyRasters(outDir, months, shape=(4, 4)):
+    ''' writes a raster of the mesh grid for each 'YYYY-MM' month, with every pixel
+        set to the number of the month, and returns their paths '''
+    rasterFiles = []
+    for month in months:
+        rasterFile = str(outDir / 'PRISM_ppt_stable_4kmM3_{0}_bil.bil'.format(month.replace('-', '')))
+        rasterFiles.append(WriteBilRaster(rasterFile, np.full(shape, float(month[5:])), 0.0, 4.0, 4.0/shape[0]))
+
+    return rasterFiles
+
+def test_ReadLastPrecipDate(tmp_path):
+    textDates = MonthEnds('1999-10', 30)
+    values = np.arange(30*4, dtype=np.float64).reshape(30, 4)
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), textDates, values, 'inches')
+
+    # small blocks split the lines of the dates between reads
+    for blockSize in (7, 64, 2**16):
+        assert ReadLastPrecipDate(outFile, blockSize) == datetime.datetime(2002, 3, 31)
+        assert ReadLastPrecipDates(outFile, 3, blockSize) == [datetime.datetime(2002, 1, 31), datetime.datetime(2002, 2, 28),
+                                                              datetime.datetime(2002, 3, 31)]
+
+def test_ReadLastPrecipDateWithoutRows(tmp_path):
+    inFile = tmp_path / 'precip.dat'
+    inFile.write_text("C  header only\nC\n    1    / NRAIN\n")
+
+    assert ReadLastPrecipDate(str(inFile)) is None
+    assert ReadLastPrecipDates(str(inFile), 2) == []
+
+def test_AppendToPrecipFile(tmp_path):
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2015-01', 3), np.ones((3, 2)), 'inches')
+
+    rowsAppended = AppendToPrecipFile(outFile, MonthEnds('2015-04', 3), iter([np.full((2, 2), 2.0), np.full((1, 2), 3.0)]))
+
+    dates, values = ReadPrecipFile(outFile)
+    assert rowsAppended == 3
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2015-01', 6)
+    np.testing.assert_allclose(values[:, 0], [1.0, 1.0, 1.0, 2.0, 2.0, 3.0])
+
+def test_FailedAppendLeavesTheFileUnchanged(tmp_path):
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2015-01', 3), np.ones((3, 2)), 'inches')
+    with open(outFile, 'rb') as f:
+        contents = f.read()
+
+    def FailingBlocks():
+        yield np.full((1, 2), 2.0)
+        raise IOError("the raster could not be read")
+
+    # a block with the wrong number of stations, or a block that cannot be made,
+    # after rows were already written
+    with pytest.raises(ValueError, match="has 2 stations"):
+        AppendToPrecipFile(outFile, MonthEnds('2015-04', 2), iter([np.full((1, 2), 2.0), np.full((1, 3), 3.0)]))
+    with pytest.raises(IOError):
+        AppendToPrecipFile(outFile, MonthEnds('2015-04', 2), FailingBlocks())
+
+    with open(outFile, 'rb') as f:
+        assert f.read() == contents
+
+def test_UpdatePrecipFileAppendsNewMonths(tmp_path):
+    meshFile = WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01', '2015-02', '2015-03', '2015-04', '2015-05'])
+    outFile = str(tmp_path / 'precip.dat')
+    WritePrecipFileFromRasters(rasterFiles[:3], meshFile, 'ElementID', 'inches', 'inches', outFile)
+
+    assert UpdatePrecipFileFromRasters(rasterFiles, meshFile, 'ElementID', 'inches', 'inches', outFile) == 2
+    assert UpdatePrecipFileFromRasters(rasterFiles, meshFile, 'ElementID', 'inches', 'inches', outFile) == 0
+
+    dates, values = ReadPrecipFile(outFile)
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2015-01', 5)
+    np.testing.assert_allclose(values, np.repeat(np.arange(1.0, 6.0)[:, np.newaxis], 2, axis=1))
+
+def test_UpdatePrecipFileRejectsGaps(tmp_path):
+    meshFile = WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01', '2015-02', '2015-03', '2015-05', '2015-06', '2015-08'])
+    outFile = str(tmp_path / 'precip.dat')
+    WritePrecipFileFromRasters(rasterFiles[:3], meshFile, 'ElementID', 'inches', 'inches', outFile)
+    with open(outFile, 'rb') as f:
+        contents = f.read()
+
+    # april is missing between the file and the new rasters, and july between the new rasters
+    with pytest.raises(ValueError, match=r"gap\(s\) in the rows appended .*2015-04 to 2015-04"):
+        UpdatePrecipFileFromRasters(rasterFiles[:4], meshFile, 'ElementID', 'inches', 'inches', outFile)
+    with pytest.raises(ValueError, match=r"gap\(s\).*2015-07"):
+        UpdatePrecipFileFromRasters([rasterFiles[4], rasterFiles[5]], meshFile, 'ElementID', 'inches', 'inches', outFile)
+
+    with open(outFile, 'rb') as f:
+        assert f.read() == contents
+
+def test_UpdatePrecipFileRejectsOtherStationsAndTimeSteps(tmp_path):
+    meshFile = WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01', '2015-02', '2015-03'])
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2014-11', 2), np.ones((2, 3)), 'inches')
+    with pytest.raises(ValueError, match="has 3 stations"):
+        UpdatePrecipFileFromRasters(rasterFiles, meshFile, 'ElementID', 'inches', 'inches', outFile)
+
+    dailyFile = WritePrecipFile(str(tmp_path / 'daily.dat'), ['12/30/2014_24:00', '12/31/2014_24:00'], np.ones((2, 2)), 'inches',
+                                timeUnit='day')
+    with pytest.raises(ValueError, match="has daily rows"):
+        UpdatePrecipFileFromRasters(rasterFiles, meshFile, 'ElementID', 'inches', 'inches', dailyFile)
+
+# ReadPrecipFile
+
+def test_ReadPrecipFileRoundTrip(tmp_path):
+    values = np.arange(12*5, dtype=np.float64).reshape(12, 5)*0.25
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2000-01', 12), values, 'inches', chunkSize=5)
+
+    specs = ReadPrecipSpecs(outFile)
+    dates, readValues = ReadPrecipFile(outFile, chunkSize=4)
+
+    assert (specs.NRAIN, specs.NSPRN, specs.NFQRN) == (5, 1, 0)
+    assert dates.dtype == np.dtype('datetime64[D]')
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2000-01', 12)
+    np.testing.assert_allclose(readValues, [[float('{:.3}'.format(value)) for value in row] for row in values])
+
+def test_ReadPrecipFileSelectsRowsAndStations(tmp_path):
+    values = np.arange(12*5, dtype=np.float64).reshape(12, 5)
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2000-01', 12), values, 'inches')
+
+    dates, readValues = ReadPrecipFile(outFile, datetime.datetime(2000, 3, 1), datetime.datetime(2000, 6, 30), [5, 1], chunkSize=3)
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2000-03', 4)
+    np.testing.assert_allclose(readValues, values[2:6][:, [4, 0]])
+
+    dates, readValues = ReadPrecipFile(outFile, datetime.datetime(2001, 1, 1))
+    assert len(dates) == 0 and readValues.shape == (0, 5)
+
+def test_ReadPrecipFileCache(tmp_path):
+    outFile = WritePrecipFile(str(tmp_path / 'precip.dat'), MonthEnds('2000-01', 3), np.ones((3, 2)), 'inches')
+
+    dates, values = ReadPrecipFile(outFile, cache=True)
+    assert os.path.exists(outFile + '.values.npy') and os.path.exists(outFile + '.dates.npy')
+    cachedDates, cachedValues = ReadPrecipFile(outFile, datetime.datetime(2000, 2, 1), stations=[2], cache=True)
+    np.testing.assert_array_equal(cachedDates, dates[1:])
+    np.testing.assert_array_equal(cachedValues, values[1:, [1]])
+
+    # the cache is read again from the file once the file is newer than the cache
+    WritePrecipFile(outFile, MonthEnds('2000-01', 4), np.full((4, 2), 2.0), 'inches')
+    cacheTime = os.path.getmtime(outFile + '.values.npy')
+    os.utime(outFile, (cacheTime + 10, cacheTime + 10))
+    dates, values = ReadPrecipFile(outFile, cache=True)
+    assert len(dates) == 4
+    np.testing.assert_array_equal(values, np.full((4, 2), 2.0))
+
+# PipelineMap and MultiProcess
+
+@pytest.fixture
+def processPool():
+    ''' closes the shared processing pool started by a test '''
+    yield
+    CloseProcessPool()
+
+def SlowRead(item):
+    ''' reads later items faster than earlier ones so they finish out of order '''
+    time.sleep(0.002*(10 - item % 10))
+    return item
+
+def test_PipelineMapYieldsInOrder():
+    results = list(PipelineMap(None, range(40), SlowRead, numReaders=4, maxPending=8))
+
+    assert results == list(range(40))
+
+def test_PipelineMapBoundsThePendingItems():
+    pulled = []
+
+    def Items():
+        for item in range(100):
+            pulled.append(item)
+            yield item
+
+    stage = StageReport('reading')
+    results = PipelineMap(None, Items(), SlowRead, numReaders=2, maxPending=5, stage=stage)
+
+    # the consumer holds back the reads: one item replaces each result taken
+    assert next(results) == 0
+    assert len(pulled) == 6
+    assert next(results) == 1
+    assert len(pulled) == 7
+
+    assert list(results) == list(range(2, 100))
+    assert stage.maxQueueDepth == 5
+
+def test_PipelineMapComputesInProcesses(processPool):
+    stage = StageReport('weighting')
+    results = list(PipelineMap(math.sqrt, range(30), SlowRead, numReaders=3, numWorkers=2, maxPending=6, stage=stage))
+
+    assert results == [math.sqrt(item) for item in range(30)]
+    assert stage.taskCPU >= 0.0 and stage.maxQueueDepth <= 6
+
+def test_MultiProcessKeepsOrderAndReusesThePool(processPool):
+    assert MultiProcess(math.sqrt, range(50), numWorkers=2, chunksize=3) == [math.sqrt(item) for item in range(50)]
+    pool = GetProcessPool(2)
+    assert MultiProcess(math.factorial, [5, 3, 0], numWorkers=2) == [120, 6, 1]
+    assert GetProcessPool(2) is pool
+
+    # another number of workers restarts the pool
+    assert GetProcessPool(1) is not pool
+    assert MultiProcess(abs, [], numWorkers=1) == []
+
+# zonal statistics
+
+def WriteTestZones(outShapefile):
+    ''' writes three zones on the 4 x 4 grid of unit pixels from (0, 0) to (4, 4). zone 1
+        holds four pixel centers, zone 2 the right half without the pixel in its
+        hole and zone 3 is too small to hold a pixel center '''
+    rightHalf = np.array([[2.0, 0.0], [2.0, 4.0], [4.0, 4.0], [4.0, 0.0], [2.0, 0.0]])
+    hole = Square(3.0, 1.0, 1.0)[0][::-1]
+    polygons = [Square(0.0, 0.0, 2.0), [rightHalf, hole], Square(0.1, 3.1, 0.2)]
+    return WritePolygonShapefile(outShapefile, [1, 2, 3], polygons, 'ZoneID')
+
+def test_RasterizeZonesLabelsPixelCenters(tmp_path):
+    header = ReadBilHeader(WriteBilRaster(str(tmp_path / 'grid.bil'), np.zeros((4, 4)), 0.0, 4.0, 1.0))
+    zones = RasterizeZones(WriteTestZones(str(tmp_path / 'zones.shp')), 'ZoneID', header)
+
+    assert zones.ids.tolist() == [1, 2, 3]
+    assert zones.window == (0, 4, 0, 4)
+    np.testing.assert_array_equal(zones.labels, [[-1, -1, 1, 1],
+                                                 [-1, -1, 1, 1],
+                                                 [0, 0, 1, -1],
+                                                 [0, 0, 1, 1]])
+    # the small zone uses the upper left pixel it lies in
+    assert zones.extraZones.tolist() == [2] and zones.extraPixels.tolist() == [0]
+
+def test_ZonalStatisticsFromLabels(tmp_path):
+    header = ReadBilHeader(WriteBilRaster(str(tmp_path / 'grid.bil'), np.zeros((4, 4)), 0.0, 4.0, 1.0))
+    zones = RasterizeZones(WriteTestZones(str(tmp_path / 'zones.shp')), 'ZoneID', header)
+    values = np.arange(16, dtype=np.float64).reshape(4, 4)
+    values[3, 3] = -9999
+
+    statistics = ZonalStatisticsFromLabels(zones, values, -9999, ['MEAN', 'MIN', 'MAX', 'SUM', 'COUNT', 'STD'])
+
+    zoneValues = [values[2:4, 0:2].ravel(), np.array([2.0, 3.0, 6.0, 7.0, 10.0, 14.0]), np.array([0.0])]
+    np.testing.assert_allclose(statistics['MEAN'], [np.mean(v) for v in zoneValues])
+    np.testing.assert_allclose(statistics['MIN'], [np.min(v) for v in zoneValues])
+    np.testing.assert_allclose(statistics['MAX'], [np.max(v) for v in zoneValues])
+    np.testing.assert_allclose(statistics['SUM'], [np.sum(v) for v in zoneValues])
+    np.testing.assert_allclose(statistics['STD'], [np.std(v) for v in zoneValues])
+    assert statistics['COUNT'].tolist() == [4, 6, 1]
+
+    # a zone without data has no statistics
+    values[0, 0] = -9999
+    statistics = ZonalStatisticsFromLabels(zones, values, -9999, ['MEAN', 'COUNT'])
+    assert np.isnan(statistics['MEAN'][2]) and statistics['COUNT'][2] == 0
+    with pytest.raises(ValueError, match="MEDIAN"):
+        ZonalStatisticsFromLabels(zones, values, -9999, ['MEDIAN'])
+
+def test_WritePrecipFileFromZonalStatistics(tmp_path):
+    zoneFile = WriteTestZones(str(tmp_path / 'zones.shp'))
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01', '2015-02'])
+    outFile = str(tmp_path / 'precip.dat')
+
+    WritePrecipFileFromZonalStatistics(rasterFiles, zoneFile, 'ZoneID', 'inches', 'inches', outFile, numReaders=2)
+
+    dates, values = ReadPrecipFile(outFile)
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2015-01', 2)
+    np.testing.assert_allclose(values, [[1.0]*3, [2.0]*3])
+
+    # the small zone only has a nodata pixel in this raster
+    values = np.ones((4, 4))
+    values[0, 0] = -9999
+    WriteBilRaster(rasterFiles[1], values, 0.0, 4.0, 1.0)
+    with pytest.raises(ValueError, match=r"only have nodata pixels .*\[3\]"):
+        WritePrecipFileFromZonalStatistics(rasterFiles, zoneFile, 'ZoneID', 'inches', 'inches', outFile, numReaders=2)
+    assert not os.path.exists(outFile)
+
+# ScanRasterCatalog
+
+def test_ScanRasterCatalogOnlyReadsChangedRasters(tmp_path, monkeypatch):
+    read = []
+    readHeader = PrecipProcessingTools.ReadBilHeader
+    monkeypatch.setattr(PrecipProcessingTools, 'ReadBilHeader', lambda path: read.append(path) or readHeader(path))
+    inDir = tmp_path / 'PRISM'
+    (inDir / '2016').mkdir(parents=True)
+    rasterFiles = WriteMonthlyRasters(inDir, ['2015-11', '2015-12']) + WriteMonthlyRasters(inDir / '2016', ['2016-01'])
+    catalogFile = str(tmp_path / 'RasterCatalog.json')
+
+    df = ScanRasterCatalog(str(inDir), catalogFile)
+
+    assert df['FileNames'].tolist() == rasterFiles
+    assert df['TextDate'].tolist() == MonthEnds('2015-11', 3)
+    assert df['NumRows'].tolist() == [4, 4, 4] and df['CellSize'].tolist() == [1.0, 1.0, 1.0]
+    assert sorted(read) == sorted(rasterFiles)
+
+    # an unchanged archive is not read again and a new raster is the only one read
+    read.clear()
+    assert ScanRasterCatalog(str(inDir), catalogFile)['FileNames'].tolist() == rasterFiles
+    assert read == []
+    newFiles = WriteMonthlyRasters(inDir / '2016', ['2016-02'])
+    assert ScanRasterCatalog(str(inDir), catalogFile)['FileNames'].tolist() == rasterFiles + newFiles
+    assert read == newFiles
+
+    # without a catalog every raster is read
+    read.clear()
+    assert ScanRasterCatalog(str(inDir))['FileNames'].tolist() == rasterFiles + newFiles
+    assert len(read) == 4
+
+def test_ScanRasterCatalogWithUnwritableCatalog(tmp_path, capsys):
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-11', '2015-12'])
+    catalogFile = str(tmp_path / 'missing' / 'RasterCatalog.json')
+
+    assert ScanRasterCatalog(str(tmp_path), catalogFile)['FileNames'].tolist() == rasterFiles
+    assert "could not be written" in capsys.readouterr().out
+    assert not os.path.exists(catalogFile)
+
+def test_ScanRasterCatalogRejectsUndatedRasters(tmp_path):
+    WriteMonthlyRasters(tmp_path, ['2015-11'])
+    WriteBilRaster(str(tmp_path / 'elevation.bil'), np.zeros((4, 4)), 0.0, 4.0, 1.0)
+    catalogFile = str(tmp_path / 'RasterCatalog.json')
+
+    for _ in range(2):
+        with pytest.raises(ValueError, match="do not contain a date"):
+            ScanRasterCatalog(str(tmp_path), catalogFile)
+
+# IntermediateFiles and IntersectRaster
+
+def WriteDataset(outFile, numBytes):
+    ''' writes a file of numBytes bytes and returns its path '''
+    with open(outFile, 'wb') as f:
+        f.write(b'x'*numBytes)
+    return outFile
+
+def test_IntermediateFilesDeletesAfterLastConsumer(tmp_path):
+    clipRaster = WriteDataset(str(tmp_path / 'clip.bil'), 100)
+    WriteDataset(str(tmp_path / 'clip.hdr'), 10)
+    pointFeature = WriteDataset(str(tmp_path / 'points.shp'), 50)
+    intermediates = IntermediateFiles()
+
+    intermediates.Add(clipRaster, 2)
+    intermediates.Add(pointFeature, 1)
+    assert (intermediates.bytesInUse, intermediates.peakBytes) == (160, 160)
+
+    intermediates.Release(clipRaster)
+    assert os.path.exists(clipRaster)
+    intermediates.Release(clipRaster)
+    assert not os.path.exists(clipRaster) and not os.path.exists(str(tmp_path / 'clip.hdr'))
+    intermediates.Release(pointFeature)
+    assert not os.path.exists(pointFeature)
+    assert (intermediates.bytesInUse, intermediates.peakBytes) == (0, 160)
+
+    keptIntermediates = IntermediateFiles(keep=True)
+    keptIntermediates.Add(WriteDataset(clipRaster, 100), 1)
+    keptIntermediates.Release(clipRaster)
+    assert os.path.exists(clipRaster) and keptIntermediates.bytesInUse == 0
+
+def test_IntersectRasterKeepsValuesOfDeletedIntermediates(tmp_path, monkeypatch):
+    # the geoprocessing steps need arcpy, so each one writes a stand-in dataset
+    steps = []
+    def Step(name):
+        def RunGeoprocessingStep(*args):
+            steps.append(name)
+            return WriteDataset(str(tmp_path / '{0}.shp'.format(name)), 10)
+        return RunGeoprocessingStep
+    for name in ['ClipRaster', 'ConvertRasterToPoints', 'CreateFishnetFeature', 'ConvertFishnetToPolygon', 'IntersectFeatures']:
+        monkeypatch.setattr(PrecipProcessingTools, name, Step(name))
+    monkeypatch.setattr(PrecipProcessingTools, 'UseArcpy', lambda: True)
+    monkeypatch.setattr(PrecipProcessingTools, 'arcpy', types.SimpleNamespace(Exists=lambda dataset: False))
+    monkeypatch.setattr(PrecipProcessingTools, 'AreaWeightValuesFromFeatureClass', lambda *args: np.array([1.5, 2.5]))
+    rasterFile = WriteMonthlyRasters(tmp_path, ['2015-01'])[0]
+    aoiFile = WriteDataset(str(tmp_path / 'aoi.dat'), 10)
+    manifestDir = str(tmp_path)
+
+    values = IntersectRaster(rasterFile, aoiFile, 'ElementID', 'inches', 'inches', str(tmp_path), manifestDir)
+    assert len(steps) == 5 and not os.path.exists(str(tmp_path / 'IntersectFeatures.shp'))
+
+    # the values are still valid after the intermediates were deleted
+    assert IntersectRaster(rasterFile, aoiFile, 'ElementID', 'inches', 'inches', str(tmp_path), manifestDir).tolist() == values.tolist() == [1.5, 2.5]
+    assert len(steps) == 5
+
+    # other units or a changed raster redo the steps
+    IntersectRaster(rasterFile, aoiFile, 'ElementID', 'inches', 'millimeters', str(tmp_path), manifestDir)
+    assert len(steps) == 10
+    WriteBilRaster(rasterFile, np.zeros((2, 2)), 0.0, 4.0, 2.0)
+    IntersectRaster(rasterFile, aoiFile, 'ElementID', 'inches', 'millimeters', str(tmp_path), manifestDir)
+    assert len(steps) == 15
+
+# StageManifest and RunStep
+
+def test_RunStepSkipsOnlyValidSteps(tmp_path):
+    inFile = WriteDataset(str(tmp_path / 'in.dat'), 10)
+    outFile = str(tmp_path / 'out.dat')
+    manifest = GetStageManifest(str(tmp_path), inFile)
+    runs = []
+    def Step():
+        runs.append(outFile)
+        WriteDataset(outFile, 20)
+
+    RunStep(manifest, 'copy', [inFile], {'factor': 1}, outFile, Step)
+    assert manifest.IsComplete('copy', [inFile], {'factor': 1}, outFile)
+
+    # an unchanged rerun, also from a new manifest read from the file, is skipped
+    RunStep(GetStageManifest(str(tmp_path), inFile), 'copy', [inFile], {'factor': 1}, outFile, Step)
+    assert len(runs) == 1
+
+    # other parameters, a changed input or a deleted output redo the step
+    assert not manifest.IsComplete('copy', [inFile], {'factor': 2}, outFile)
+    WriteDataset(inFile, 11)
+    assert not manifest.IsComplete('copy', [inFile], {'factor': 1}, outFile)
+    RunStep(manifest, 'copy', [inFile], {'factor': 1}, outFile, Step)
+    assert len(runs) == 2
+    os.remove(outFile)
+    assert not manifest.IsComplete('copy', [inFile], {'factor': 1}, outFile)
+    RunStep(manifest, 'copy', [inFile], {'factor': 1}, outFile, Step)
+    assert len(runs) == 3 and os.path.getsize(outFile) == 20
+
+def test_RunStepRedoesHalfWrittenOutput(tmp_path):
+    inFile = WriteDataset(str(tmp_path / 'in.dat'), 10)
+    outFile = str(tmp_path / 'out.dat')
+    manifest = GetStageManifest(str(tmp_path), inFile)
+    def InterruptedStep():
+        WriteDataset(outFile, 5)
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        RunStep(manifest, 'copy', [inFile], {}, outFile, InterruptedStep)
+
+    # the step was never recorded, so its partial output is replaced
+    manifest = GetStageManifest(str(tmp_path), inFile)
+    assert not manifest.IsComplete('copy', [inFile], {}, outFile)
+    RunStep(manifest, 'copy', [inFile], {}, outFile, lambda: WriteDataset(outFile, 20))
+    assert os.path.getsize(outFile) == 20
+
+    # an output cut short after the step was recorded is not complete either
+    WriteDataset(outFile, 5)
+    assert not manifest.IsComplete('copy', [inFile], {}, outFile)
+
+def test_StageManifestInvalidate(tmp_path):
+    inFile = WriteDataset(str(tmp_path / 'in.dat'), 10)
+    outFile = str(tmp_path / 'out.dat')
+    manifest = GetStageManifest(str(tmp_path), inFile)
+    RunStep(manifest, 'copy', [inFile], {}, outFile, lambda: WriteDataset(outFile, 20))
+
+    manifest.Invalidate('copy')
+    assert not GetStageManifest(str(tmp_path), inFile).IsComplete('copy', [inFile], {}, outFile)
+
+    # a manifest that cannot be read is treated as empty
+    with open(manifest.manifestFile, 'w') as f:
+        f.write('{"version": 1, "ste')
+    assert GetStageManifest(str(tmp_path), inFile).GetSteps() == {}
+
+# MergePrecipShards
+
+def SaveShards(tmp_path, shardMonths, numShards=None, aoiHash='aoi', ids=(1, 2, 3)):
+    ''' saves a shard for each (shardIndex, startMonth, numMonths) and returns their paths '''
+    numShards = numShards if numShards is not None else len(shardMonths)
+    shardFiles = []
+    for shardIndex, startMonth, numMonths in shardMonths:
+        textDates = MonthEnds(startMonth, numMonths)
+        values = np.full((numMonths, len(ids)), float(shardIndex))
+        shardFile = str(tmp_path / 'shard_{0:04d}_of_{1:04d}_{2}.npz'.format(shardIndex, numShards, startMonth))
+        shardFiles.append(SavePrecipShard(shardFile, textDates, values, np.array(ids), 'inches',
+                                          ['raster_{0}.bil'.format(i) for i in range(numMonths)], shardIndex, numShards, aoiHash))
+
+    return shardFiles
+
+def test_MergeShardsInDateOrder(tmp_path):
+    shardFiles = SaveShards(tmp_path, [(0, '2000-01', 2), (1, '2000-03', 2), (2, '2000-05', 1)])
+    outFile = MergePrecipShards(shardFiles[::-1], str(tmp_path / 'precip.dat'))
+
+    assert ReadLastPrecipDates(outFile, 5) == [datetime.datetime(2000, month, day) for month, day in
+                                               [(1, 31), (2, 29), (3, 31), (4, 30), (5, 31)]]
+
+def test_MergeShardsRejectsMissingShard(tmp_path):
+    shardFiles = SaveShards(tmp_path, [(0, '2000-01', 2), (1, '2000-03', 2), (2, '2000-05', 1)])
+
+    with pytest.raises(ValueError, match=r"shards \[1\] of 3 are missing"):
+        MergePrecipShards([shardFiles[0], shardFiles[2]], str(tmp_path / 'precip.dat'))
+
+def test_MergeShardsRejectsShardsOfAnotherRun(tmp_path):
+    (tmp_path / 'stale').mkdir()
+    (tmp_path / 'other').mkdir()
+    shardFiles = SaveShards(tmp_path, [(0, '2000-01', 2), (1, '2000-03', 2)])
+    staleFiles = SaveShards(tmp_path / 'stale', [(1, '2000-03', 3)], numShards=3)
+    otherAOIFiles = SaveShards(tmp_path / 'other', [(1, '2000-03', 2)], numShards=2, aoiHash='other')
+
+    with pytest.raises(ValueError, match="one of 3 shards"):
+        MergePrecipShards(shardFiles + staleFiles, str(tmp_path / 'precip.dat'))
+    with pytest.raises(ValueError, match="different area of interest"):
+        MergePrecipShards([shardFiles[0]] + otherAOIFiles, str(tmp_path / 'precip.dat'))
+
+def test_MergeShardsRejectsOverlapsAndGaps(tmp_path):
+    (tmp_path / 'overlap').mkdir()
+    (tmp_path / 'gap').mkdir()
+    overlapping = SaveShards(tmp_path / 'overlap', [(0, '2000-01', 3), (1, '2000-03', 2)])
+    gapped = SaveShards(tmp_path / 'gap', [(0, '2000-01', 2), (1, '2000-04', 2)])
+
+    with pytest.raises(ValueError, match="more than one shard"):
+        MergePrecipShards(overlapping, str(tmp_path / 'precip.dat'))
+    with pytest.raises(ValueError, match="gap"):
+        MergePrecipShards(gapped, str(tmp_path / 'precip.dat'))
+    assert not (tmp_path / 'precip.dat').exists()
+
+# GetOutputPeriods
+
+def DailyRasters(startDate, endDate):
+    ''' returns daily raster file names from startDate to endDate ordered with OrderFilesByDate '''
+    days = pd.date_range(startDate, endDate, freq='D')
+    return OrderFilesByDate(['PRISM_ppt_stable_4kmD2_{0}_bil.bil'.format(day.strftime('%Y%m%d')) for day in days])
+
+def test_OutputPeriodsSumCompleteMonths():
+    rasters = DailyRasters('2000-01-01', '2000-03-31')
+    outputRasters, rowIndices, textDates, timeStep = GetOutputPeriods(rasters, 'monthly')
+
+    assert timeStep == 'monthly'
+    assert textDates == MonthEnds('2000-01', 3)
+    assert np.bincount(rowIndices).tolist() == [31, 29, 31]
+
+def test_OutputPeriodsDropPartialFirstAndLastMonths():
+    rasters = DailyRasters('2000-01-15', '2000-04-10')
+    report = RunReport()
+    outputRasters, rowIndices, textDates, timeStep = GetOutputPeriods(rasters, 'monthly', report)
+
+    assert textDates == MonthEnds('2000-02', 2)
+    assert len(outputRasters) == len(rowIndices) == 29 + 31
+    assert rowIndices.min() == 0 and rowIndices.max() == 1
+    assert report.warnings == ["Leaving out 2000-01, which only has 17 of 31 daily rasters",
+                               "Leaving out 2000-04, which only has 10 of 30 daily rasters"]
+
+def test_OutputPeriodsRejectMissingDays():
+    rasters = DailyRasters('2000-01-01', '2000-03-31')
+    rasters = rasters[rasters['Date'] != pd.Timestamp('2000-02-10')]
+
+    with pytest.raises(ValueError, match="missing daily rasters"):
+        GetOutputPeriods(rasters, 'monthly')
+    with pytest.raises(ValueError, match=r"1 gap\(s\) of daily rows without rasters: \['2000-02-10'\]"):
+        GetOutputPeriods(rasters)
+
+def test_OutputPeriodsRejectMissingMonths():
+    rasters = pd.concat([DailyRasters('2000-01-01', '2000-01-31'), DailyRasters('2000-03-01', '2000-03-31')])
+
+    with pytest.raises(ValueError, match="gap"):
+        GetOutputPeriods(rasters, 'monthly')
+
+    monthlyRasters = OrderFilesByDate(['PRISM_ppt_stable_4kmM3_{0}_bil.bil'.format(month) for month in ['200001', '200002', '200005']])
+    with pytest.raises(ValueError, match=r"1 gap\(s\) of monthly rows without rasters: \['2000-03 to 2000-04'\]"):
+        GetOutputPeriods(monthlyRasters)
+
+def test_OutputPeriodsRejectDuplicateDates():
+    rasters = DailyRasters('2000-01-01', '2000-01-31')
+    rasters = OrderFilesByDate(rasters['FileNames'].tolist() + ['other_20000115.bil'])
+
+    with pytest.raises(ValueError, match="share a date"):
+        GetOutputPeriods(rasters, 'monthly')
+
+# WriteIWFMFilesFromRasters
+
+def test_WriteIWFMFilesFromRasters(tmp_path):
+    meshFile = WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    days = pd.date_range('2000-01-01', '2000-02-29', freq='D')
+    variableRasters = {}
+    for variable in ['ppt', 'tmean']:
+        (tmp_path / variable).mkdir()
+        variableRasters[variable] = [WriteBilRaster(str(tmp_path / variable / 'PRISM_{0}_stable_4kmD2_{1}_bil.bil'.format(variable, day.strftime('%Y%m%d'))),
+                                                    np.full((4, 4), float(day.day)), 0.0, 4.0, 1.0) for day in days]
+    outFiles = {'ppt': str(tmp_path / 'Precip.dat'), 'tmean': str(tmp_path / 'MeanTemperature.dat')}
+
+    WriteIWFMFilesFromRasters(variableRasters, meshFile, 'ElementID', {'ppt': ('inches', 'inches'), 'tmean': ('celsius', 'celsius')},
+                              outFiles, outTimeStep='monthly')
+
+    # daily precipitation is summed and daily temperature averaged by month
+    dates, values = ReadPrecipFile(outFiles['ppt'])
+    assert pd.DatetimeIndex(dates).strftime('%m/%d/%Y_24:00').tolist() == MonthEnds('2000-01', 2)
+    np.testing.assert_allclose(values, [[496.0]*2, [435.0]*2])
+    dates, values = ReadPrecipFile(outFiles['tmean'])
+    np.testing.assert_allclose(values, [[16.0]*2, [15.0]*2])
+
+    # only the precipitation file has the header of the C2VSimFG model
+    with open(outFiles['tmean'], 'r') as f:
+        header = f.read(2000)
+    assert "TEMPERATURE DATA FILE" in header and "Filename: MeanTemperature.dat" in header
+    assert "C2VSimFG" not in header and "Component" not in header
+    assert ReadPrecipSpecs(outFiles['tmean']).FACTRN == 1.0
+
+# ResultStoreWriter
+
+def test_ResultStoreRoundTrip(tmp_path):
+    storeDir = str(tmp_path / 'Store')
+    textDates = MonthEnds('2000-01', 5)
+    values = np.arange(5*3, dtype=np.float64).reshape(5, 3)
+    writer = ResultStoreWriter(storeDir, [10, 20, 30], textDates, 'millimeters', timeChunk=2, elementChunk=2)
+    assert len(list(writer.StoreBlocks([values[:3], values[3:]]))) == 2
+
+    storeDates, valueBlocks = ReadResultStore(storeDir, startDate=datetime.datetime(2000, 2, 1), ids=[30, 10])
+    assert storeDates == textDates[1:]
+    np.testing.assert_allclose(np.concatenate(list(valueBlocks)), values[1:][:, [2, 0]])
+
+    outFile = ExportIWFMFileFromStore(storeDir, str(tmp_path / 'precip.dat'), 'inches')
+    scale, offset = UnitConversion('millimeters', 'inches')
+    np.testing.assert_allclose(ReadPrecipFile(outFile)[1], values*scale + offset, rtol=5e-3)
+
+def test_ResultStoreKeepsEarlierStoreUntilClosed(tmp_path):
+    storeDir = str(tmp_path / 'Store')
+    textDates = MonthEnds('2000-01', 2)
+    list(ResultStoreWriter(storeDir, [1, 2], textDates, 'inches').StoreBlocks([np.ones((2, 2))]))
+
+    # a run that fails before closing its store leaves the earlier one
+    failedWriter = ResultStoreWriter(storeDir, [1, 2], textDates, 'inches')
+    failedWriter.Append(np.full((1, 2), 5.0))
+    np.testing.assert_allclose(np.concatenate(list(ReadResultStore(storeDir)[1])), np.ones((2, 2)))
+
+    failedWriter.Append(np.full((1, 2), 5.0))
+    failedWriter.Close()
+    np.testing.assert_allclose(np.concatenate(list(ReadResultStore(storeDir)[1])), np.full((2, 2), 5.0))
+    assert sorted(os.listdir(str(tmp_path))) == ['Store']
+
+    # a folder holding other files is not replaced
+    with pytest.raises(ValueError, match="is not a result store folder"):
+        ResultStoreWriter(str(tmp_path), [1, 2], textDates, 'inches')
+
+# MemoryBudget
+
+def test_AreaWeightingBlocksFitTheMemoryBudget(tmp_path, monkeypatch, capsys):
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-{0:02d}'.format(month) for month in range(1, 9)])
+    weights = CalculateAreaWeightMatrix(WriteTestMesh(str(tmp_path / 'mesh.shp')), 'ElementID', ReadBilHeader(rasterFiles[0]))
+    rasterBytes = 16*len(weights.pixels)
+
+    # the blocks fit in the budget besides the memory in use now, not the peak of the process
+    monkeypatch.setattr(PrecipProcessingTools, 'CurrentMemory', lambda: 10**6)
+    monkeypatch.setattr(PrecipProcessingTools, 'PeakMemory', lambda: 10**9)
+    stage = StageReport('weighting')
+    blocks = list(AreaWeightValuesFromRasters(rasterFiles, weights, 'inches', 'inches', blockSize=8, numReaders=2, stage=stage,
+                                              budget=MemoryBudget(10**6 + 4*rasterBytes)))
+    assert [len(block) for block in blocks] == [4, 4]
+    assert (stage.blockSize, stage.blockSizeReduced) == (4, False)
+
+    # each new peak over the budget halves the blocks, which is recorded in the stage
+    peaks = iter(range(2*10**9, 3*10**9, 10**6))
+    monkeypatch.setattr(PrecipProcessingTools, 'PeakMemory', lambda: next(peaks))
+    report = RunReport()
+    stage = report.GetStage('weighting')
+    blocks = list(AreaWeightValuesFromRasters(rasterFiles, weights, 'inches', 'inches', blockSize=8, numReaders=2, stage=stage,
+                                              budget=MemoryBudget(10**6 + 4*rasterBytes)))
+    assert [len(block) for block in blocks] == [4, 2, 1, 1]
+    np.testing.assert_allclose(np.concatenate(blocks)[:, 0], np.arange(1.0, 9.0))
+    assert (stage.blockSize, stage.blockSizeReduced) == (1, True)
+    assert "over the memory budget, 1 at once" in report.Summary()
+    assert capsys.readouterr().out == ""
+
+# ReadJobConfig, PlanJob and RunJob
+
+def WriteJobConfig(tmp_path, **settings):
+    ''' writes a JSON job of the test mesh and the rasters of tmp_path/PRISM and returns its path '''
+    job = {'inWorkspace': str(tmp_path / 'PRISM'), 'aoiFeature': str(tmp_path / 'mesh.shp'), 'aoiIDField': 'ElementID',
+           'outWorkspace': str(tmp_path / 'Output'), 'outFileName': 'Precip.dat', 'inUnits': 'inches'}
+    job.update(settings)
+    configFile = str(tmp_path / 'job.json')
+    with open(configFile, 'w') as f:
+        json.dump({name: value for name, value in job.items() if value is not None}, f)
+    return configFile
+
+def test_ReadJobConfig(tmp_path):
+    config = ReadJobConfig(WriteJobConfig(tmp_path))
+    assert config['inWorkspace'] == [str(tmp_path / 'PRISM')]
+    assert (config['method'], config['outUnits'], config['allowGaps']) == ('weights', 'inches', False)
+
+    with pytest.raises(ValueError, match=r"unknown setting\(s\) .*\['numThreads'\]"):
+        ReadJobConfig(WriteJobConfig(tmp_path, numThreads=4))
+    with pytest.raises(ValueError, match=r"missing the required setting\(s\) \['aoiIDField'\]"):
+        ReadJobConfig(WriteJobConfig(tmp_path, aoiIDField=None))
+    with pytest.raises(ValueError, match="method must be one of"):
+        ReadJobConfig(WriteJobConfig(tmp_path, method='zonal'))
+    with pytest.raises(ValueError, match="appendToExisting requires the 'weights' method"):
+        ReadJobConfig(WriteJobConfig(tmp_path, method='intersect', appendToExisting=True))
+    with pytest.raises(ValueError):
+        ReadJobConfig(WriteJobConfig(tmp_path, outUnits='furlongs'))
+    with pytest.raises(ValueError, match="must be a .toml, .yaml or .json file"):
+        ReadJobConfig(str(tmp_path / 'job.ini'))
+
+def test_PlanJob(tmp_path):
+    WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    (tmp_path / 'PRISM' / 'provisional').mkdir(parents=True)
+    (tmp_path / 'Output').mkdir()
+    WriteMonthlyRasters(tmp_path / 'PRISM', ['2015-01', '2015-02', '2015-05'])
+    WriteBilRaster(str(tmp_path / 'PRISM' / 'provisional' / 'PRISM_ppt_provisional_4kmM3_201505_bil.bil'), np.ones((4, 4)), 0.0, 4.0, 1.0)
+
+    plan = PlanJob(ReadJobConfig(WriteJobConfig(tmp_path)))
+
+    assert (plan['rasterCount'], plan['firstDate'], plan['lastDate']) == (4, '2015-01-01', '2015-05-01')
+    assert (plan['timeSteps'], plan['gaps'], plan['duplicateDates']) == (['monthly'], ['2015-03 to 2015-04'], ['2015-05'])
+    assert (plan['numRows'], plan['featureCount']) == (3, 3)
+    assert [(grid['rasterCount'], grid['window']) for grid in plan['grids']] == [(4, [0, 4, 0, 4])]
+    assert plan['bytesToRead'] == 4*16*4
+    assert "Gaps:             1: 2015-03 to 2015-04" in FormatJobPlan(plan)
+
+def test_RunJobFailsOnGapsUnlessAllowed(tmp_path):
+    WriteTestMesh(str(tmp_path / 'mesh.shp'))
+    (tmp_path / 'PRISM').mkdir()
+    (tmp_path / 'Output').mkdir()
+    WriteMonthlyRasters(tmp_path / 'PRISM', ['2015-01', '2015-02', '2015-05'])
+    outFile = str(tmp_path / 'Output' / 'Precip.dat')
+
+    for method in ['weights', 'intersect']:
+        with pytest.raises(ValueError, match=r"1 gap\(s\) in the dates of the rasters: \['2015-03 to 2015-04'\]"):
+            RunJob(ReadJobConfig(WriteJobConfig(tmp_path, method=method)))
+        assert not os.path.exists(outFile)
+
+    report = RunReport()
+    assert RunJob(ReadJobConfig(WriteJobConfig(tmp_path, allowGaps=True)), report) == outFile
+    assert "1 gap(s) in the dates of the rasters: ['2015-03 to 2015-04']" in report.warnings
+    dates, values = ReadPrecipFile(outFile)
+    assert pd.DatetimeIndex(dates).month.tolist() == [1, 2, 5]
+
+    # a date with two rasters fails whether or not gaps are allowed
+    WriteBilRaster(str(tmp_path / 'PRISM' / 'PRISM_ppt_provisional_4kmM3_201505_bil.bil'), np.ones((4, 4)), 0.0, 4.0, 1.0)
+    with pytest.raises(ValueError, match=r"1 date\(s\) have more than one raster: \['2015-05'\]"):
+        RunJob(ReadJobConfig(WriteJobConfig(tmp_path, allowGaps=True)))
+
+# WorkspaceScanCache
+
+def test_WorkspaceScanCacheKeepsListingUntilModified(tmp_path, monkeypatch):
+    scanned = []
+    listRasters = PrecipProcessingTools.ListWorkspaceRasters
+    monkeypatch.setattr(PrecipProcessingTools, 'ListWorkspaceRasters',
+                        lambda inWorkspace, dataType: scanned.append(inWorkspace) or listRasters(inWorkspace, dataType))
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01', '2015-02'])
+    cache = WorkspaceScanCache(recheckSeconds=0.0)
+
+    assert cache.GetRasters([str(tmp_path), str(tmp_path / 'missing')], wait=True) == (rasterFiles, True)
+    assert cache.GetRasters([str(tmp_path)], wait=True) == (rasterFiles, True)
+    assert scanned == [str(tmp_path)]
+
+    # a new raster modifies the folder, which is scanned again
+    newFiles = WriteMonthlyRasters(tmp_path, ['2015-03'])
+    os.utime(str(tmp_path), (time.time() + 10, time.time() + 10))
+    assert cache.GetRasters([str(tmp_path)], wait=True) == (rasterFiles + newFiles, True)
+    assert len(scanned) == 2
+
+    # modified times are only checked every recheckSeconds
+    cache.recheckSeconds = 3600.0
+    os.utime(str(tmp_path), (time.time() + 20, time.time() + 20))
+    assert cache.GetRasters([str(tmp_path)], wait=True) == (rasterFiles + newFiles, True)
+    assert len(scanned) == 2
+    cache.scanPool.terminate()
+
+def test_WorkspaceScanCacheScansInBackground(tmp_path, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    listRasters = PrecipProcessingTools.ListWorkspaceRasters
+    def SlowList(inWorkspace, dataType):
+        started.set()
+        release.wait(10)
+        return listRasters(inWorkspace, dataType)
+    monkeypatch.setattr(PrecipProcessingTools, 'ListWorkspaceRasters', SlowList)
+    rasterFiles = WriteMonthlyRasters(tmp_path, ['2015-01'])
+    cache = WorkspaceScanCache()
+
+    # the dialog is not blocked while the folder is listed
+    assert cache.GetRasters([str(tmp_path)]) == ([], False)
+    assert started.wait(10)
+    assert cache.GetRasters([str(tmp_path)]) == ([], False)
+    release.set()
+    assert cache.GetRasters([str(tmp_path)], wait=True) == (rasterFiles, True)
+    cache.scanPool.terminate()
+
+def test_WorkspaceScanCacheReportsFailedScans(tmp_path, monkeypatch):
+    scanned = []
+    def FailingList(inWorkspace, dataType):
+        scanned.append(inWorkspace)
+        raise ValueError("cannot read {0}".format(inWorkspace))
+    monkeypatch.setattr(PrecipProcessingTools, 'ListWorkspaceRasters', FailingList)
+    cache = WorkspaceScanCache(recheckSeconds=0.0)
+
+    assert cache.GetRasters([str(tmp_path)], wait=True) == ([], True)
+    assert cache.GetScanErrors([str(tmp_path)]) == ["{0}: cannot read {0}".format(tmp_path)]
+
+    # the failure is kept until the folder is modified
+    assert cache.GetRasters([str(tmp_path)], wait=True) == ([], True)
+    assert len(scanned) == 1
+    monkeypatch.setattr(PrecipProcessingTools, 'ListWorkspaceRasters', lambda inWorkspace, dataType: [])
+    os.utime(str(tmp_path), (time.time() + 10, time.time() + 10))
+    assert cache.GetRasters([str(tmp_path)], wait=True) == ([], True)
+    assert cache.GetScanErrors([str(tmp_path)]) == []
+    cache.scanPool.terminate()